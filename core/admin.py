@@ -3,10 +3,32 @@ Django admin configuration.
 """
 
 from django.contrib import admin
-from core.models import Player, Match, MatchPlayer, Guest, WeeklyMatchSchedule
+from core.models import (Player, Match, MatchPlayer, WaitingPlayer, Guest, WeeklyMatchSchedule, OutboundEmail,
+    SentEmail, SiteStatistics)
+from core import seats
+
+
+class MatchAdmin(admin.ModelAdmin):
+    """
+    Waiting players are given the seats added by raising the capacity, and
+    the players in the match are notified.
+    The counters, version and modification date are kept by core.signals, and
+    not saved by Match.save, so they are read only.
+    """
+    readonly_fields = Match.COUNTER_FIELDS + ('modified',)
+
+    def save_model(self, request, obj, form, change):
+        super(MatchAdmin, self).save_model(request, obj, form, change)
+        if change and 'capacity' in form.changed_data:
+            seats.notify_promoted(obj, seats.promote(obj))
+
 
 admin.site.register(Player)
-admin.site.register(Match)
+admin.site.register(Match, MatchAdmin)
 admin.site.register(MatchPlayer)
+admin.site.register(WaitingPlayer)
 admin.site.register(Guest)
 admin.site.register(WeeklyMatchSchedule)
+admin.site.register(OutboundEmail)
+admin.site.register(SentEmail)
+admin.site.register(SiteStatistics)
@@ -3,9 +3,14 @@ RESTful API module.
 """
 
 import logging
+from datetime import datetime
 from django.contrib.auth.models import User
-from rest_framework import serializers, viewsets, routers, permissions
+from django.views.decorators.http import condition
+from rest_framework import serializers, viewsets, mixins, routers, permissions, status
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.response import Response
 from core.models import Player, Match, MatchPlayer, Guest, WeeklyMatchSchedule
+from core import mailer, seats
 
 
 LOGGER = logging.getLogger(__name__)
@@ -28,6 +33,15 @@ class PlayerSerializer(serializers.HyperlinkedModelSerializer):
         return player
 
 
+class LeaderboardSerializer(serializers.HyperlinkedModelSerializer):
+    """
+    Serializer class for players in the leaderboard, with their match counters.
+    """
+    class Meta:
+        model = Player
+        fields = ('url', 'id', 'name', 'match_count', 'played', 'left')
+
+
 class GuestSerializer(serializers.HyperlinkedModelSerializer):
     """
     Serializer class for the Guest model.
@@ -53,7 +67,7 @@ class MatchSerializer(serializers.HyperlinkedModelSerializer):
     guests = GuestSerializer(many=True, read_only=True)
     class Meta:
         model = Match
-        fields = ('url', 'id', 'date', 'place', 'players', 'guests')
+        fields = ('url', 'id', 'date', 'place', 'capacity', 'players', 'guests')
 
 
 class MatchPlayerSerializer(serializers.HyperlinkedModelSerializer):
@@ -61,11 +75,11 @@ class MatchPlayerSerializer(serializers.HyperlinkedModelSerializer):
     Serializer class for the MatchPlayer model.
     """
     match = serializers.HyperlinkedRelatedField(
-        read_only=True,
+        queryset=Match.objects.all(),
         view_name='match-detail'
     )
     player = serializers.HyperlinkedRelatedField(
-        read_only=True,
+        queryset=Player.objects.all(),
         view_name='player-detail'
     )
     class Meta:
@@ -135,6 +149,32 @@ class PlayerPermissions(permissions.BasePermission):
 # ViewSets define the view behavior.
 
 
+class ConditionalRetrieveMixin(object):
+    """
+    View set mixin supporting conditional requests (If-None-Match and
+    If-Modified-Since) when retrieving a resource. Unchanged resources return
+    304 after a single lookup of the validators returned by validators(pk).
+    """
+
+    def validators(self, pk):
+        """
+        Returns the ETag and last modified date of the resource with the given
+        pk, or None to retrieve it without conditional handling (the default,
+        and for resources that don't exist).
+        """
+        return None
+
+    def retrieve(self, request, *args, **kwargs):
+        found = self.validators(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        if found == None:
+            return super(ConditionalRetrieveMixin, self).retrieve(request, *args, **kwargs)
+        # the same resource is rendered differently by each renderer
+        etag = '%s-%s' % (found[0], request.accepted_renderer.format)
+        retrieve = condition(etag_func=lambda *args, **kwargs: etag, last_modified_func=lambda *args, **kwargs: found[1])(
+            super(ConditionalRetrieveMixin, self).retrieve)
+        return retrieve(request, *args, **kwargs)
+
+
 class PlayerViewSet(viewsets.ModelViewSet):
     """
     View set class for the Player model.
@@ -144,7 +184,17 @@ class PlayerViewSet(viewsets.ModelViewSet):
     permission_classes = [PlayerPermissions]
 
 
-class MatchViewSet(viewsets.ModelViewSet):
+class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Read only view set for players ordered by match_count, most frequent players
+    first.
+    """
+    queryset = Player.leaderboard()
+    serializer_class = LeaderboardSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+
+class MatchViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     """
     View set class for the Match model.
     """
@@ -152,24 +202,77 @@ class MatchViewSet(viewsets.ModelViewSet):
     serializer_class = MatchSerializer
     permission_classes = [permissions.IsAuthenticated, IsAdminOrReadOnly]
 
+    def validators(self, pk):
+        match = Match.objects.only('id', 'version', 'modified').filter(pk=pk).first()
+        if match != None:
+            return (match.etag(), match.modified)
+
 
-class MatchPlayerViewSet(viewsets.ModelViewSet):
+class MatchPlayerViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
     """
     View set class for the MatchPlayer model.
+    Players join and leave matches through core.seats, like the match views:
+    players joining a full match wait for a seat (202 without a match player),
+    and the seat of a leaving player is given to the first waiting one. Match
+    players can't be updated.
     """
     queryset = MatchPlayer.objects.all()
     serializer_class = MatchPlayerSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
-
-class GuestViewSet(viewsets.ModelViewSet):
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        match = serializer.validated_data['match']
+        player = serializer.validated_data['player']
+        if player.owner() != request.user and not request.user.is_staff:
+            raise PermissionDenied()
+        if datetime.now() >= match.date:
+            raise ValidationError({'match': ['The match has already been played.']})
+
+        joined = seats.join(match, player)
+        if joined == seats.JOINED:
+            sent_mails = mailer.send_join_mails(match, player)
+            LOGGER.info('%s joined %s, sent %i email(s)' % (player, match, sent_mails))
+            serializer.instance = MatchPlayer.objects.get(match=match, player=player)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        if joined == seats.WAITING:
+            LOGGER.info('%s is waiting for %s' % (player, match))
+            return Response({'detail': 'The match is full, the player is waiting for a seat.'},
+                status=status.HTTP_202_ACCEPTED)
+        raise ValidationError({'player': ['The player is already in the match or waiting.']})
+
+    def perform_destroy(self, instance):
+        left, promoted = seats.leave(instance.match, instance.player)
+        if left == seats.LEFT:
+            sent_mails = mailer.send_leave_mails(instance.match, instance.player)
+            LOGGER.info('%s left %s, sent %i email(s)' % (instance.player, instance.match, sent_mails))
+        seats.notify_promoted(instance.match, promoted)
+
+
+class GuestViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     """
     View set class for the Guest model.
+    Changes to guests bump the version of their match, and the seat of a
+    removed guest is given to the first waiting player (see core.seats).
     """
     queryset = Guest.objects.all()
     serializer_class = GuestSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
+    def perform_destroy(self, instance):
+        removed, promoted = seats.remove_guest(instance)
+        if removed:
+            sent_mails = mailer.send_remove_guest_mails(instance)
+            LOGGER.info('%s uninvited %s from %s, sent %i email(s)' % (
+                instance.inviting_player, instance, instance.match, sent_mails))
+            seats.notify_promoted(instance.match, promoted)
+
+    def validators(self, pk):
+        guest = Guest.objects.filter(pk=pk).values_list('id', 'match__version', 'match__modified').first()
+        if guest != None:
+            return ('guest-%i-%i' % guest[:2], guest[2])
+
 
 class WeeklyMatchScheduleViewSet(viewsets.ModelViewSet):
     """
@@ -183,6 +286,7 @@ class WeeklyMatchScheduleViewSet(viewsets.ModelViewSet):
 # Routers provide a way of automatically determining the URL conf.
 router = routers.DefaultRouter()
 router.register(r'players', PlayerViewSet)
+router.register(r'leaderboard', LeaderboardViewSet, base_name='leaderboard')
 router.register(r'matches', MatchViewSet)
 router.register(r'matchplayers', MatchPlayerViewSet)
 router.register(r'guests', GuestViewSet)
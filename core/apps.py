@@ -0,0 +1,12 @@
+"""
+Django app configuration for the core app.
+"""
+
+from django.apps import AppConfig
+
+
+class CoreConfig(AppConfig):
+    name = 'core'
+
+    def ready(self):
+        from core import signals
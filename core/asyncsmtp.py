@@ -0,0 +1,390 @@
+"""
+asyncio based SMTP email backend.
+All SMTP sessions of the process live in a single event loop thread, and every
+batch of messages is spread over at most MAILER_ASYNC_CONCURRENCY sessions,
+pipelining the envelope commands of each message when the server supports it.
+Select it with EMAIL_BACKEND = 'core.asyncsmtp.EmailBackend'.
+
+Upgrading a connection with STARTTLS is not supported by asyncio in the Python
+versions we run, so use EMAIL_USE_SSL (implicit TLS, port 465) or plain SMTP.
+"""
+
+import asyncio
+import atexit
+import base64
+import concurrent.futures
+import re
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+from core.ratelimit import SendScheduler, send_scheduler, is_throttled
+
+
+class AsyncSMTPSession(object):
+    """
+    A single SMTP session, driven from the event loop.
+    Every read and write fails with asyncio.TimeoutError after `timeout` seconds.
+    """
+
+    def __init__(self, loop, timeout):
+        self.loop = loop
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.extensions = set()
+        self.last_used = time.time()
+
+    def _wait(self, coroutine):
+        return asyncio.wait_for(coroutine, self.timeout, loop=self.loop)
+
+    @asyncio.coroutine
+    def connect(self, host, port, use_ssl=False, username='', password=''):
+        """
+        Opens the session: greeting, EHLO and authentication if a username is given.
+        """
+        context = ssl.create_default_context() if use_ssl else None
+        self.reader, self.writer = yield from self._wait(
+            asyncio.open_connection(host, port, ssl=context, loop=self.loop))
+        # pipelined commands are small writes, don't let Nagle's algorithm delay them
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        code, message = yield from self.reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+
+        code, message = yield from self.command('EHLO %s' % DNS_NAME.get_fqdn())
+        if code == 250:
+            self.extensions = set(line.split(' ')[0].upper() for line in message.split('\n')[1:])
+        else:
+            code, message = yield from self.command('HELO %s' % DNS_NAME.get_fqdn())
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+
+        if username:
+            credentials = base64.b64encode(('\0%s\0%s' % (username, password)).encode('utf-8'))
+            code, message = yield from self.command('AUTH PLAIN %s' % credentials.decode('ascii'))
+            if code != 235:
+                raise smtplib.SMTPAuthenticationError(code, message)
+
+    @asyncio.coroutine
+    def reply(self):
+        """
+        Reads a (possibly multiline) reply, returns its code and text.
+        """
+        lines = []
+        while True:
+            line = yield from self._wait(self.reader.readline())
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(line[4:])
+            if line[3:4] != '-':
+                try:
+                    return int(line[:3]), '\n'.join(lines)
+                except ValueError:
+                    raise smtplib.SMTPResponseException(-1, line)
+
+    @asyncio.coroutine
+    def write(self, data):
+        self.writer.write(data)
+        yield from self._wait(self.writer.drain())
+
+    @asyncio.coroutine
+    def command(self, line):
+        yield from self.write(('%s\r\n' % line).encode('utf-8'))
+        return (yield from self.reply())
+
+    @asyncio.coroutine
+    def send(self, email_message):
+        """
+        Sends the given EmailMessage, raising the smtplib exception matching
+        the first rejected step. The session can still be used after a
+        rejected message.
+        """
+        from_email = sanitize_address(email_message.from_email, email_message.encoding)
+        recipients = [sanitize_address(address, email_message.encoding) for address in email_message.recipients()]
+        commands = ['MAIL FROM:<%s>' % from_email] + ['RCPT TO:<%s>' % recipient for recipient in recipients] + ['DATA']
+
+        replies = []
+        if 'PIPELINING' in self.extensions:
+            yield from self.write(''.join('%s\r\n' % command for command in commands).encode('utf-8'))
+            for command in commands:
+                replies.append((yield from self.reply()))
+        else:
+            for command in commands:
+                replies.append((yield from self.command(command)))
+                if len(replies) == 1 and replies[0][0] != 250:
+                    break
+
+        mail_reply, rcpt_replies, data_reply = replies[0], replies[1:len(commands) - 1], replies[-1]
+        if data_reply[0] == 354 and mail_reply[0] == 250 and any(code in (250, 251) for code, _ in rcpt_replies):
+            data = email_message.message().as_bytes(linesep='\r\n')
+            data = re.sub(br'(?m)^\.', b'..', data)
+            if not data.endswith(b'\r\n'):
+                data += b'\r\n'
+            yield from self.write(data + b'.\r\n')
+            code, message = yield from self.reply()
+            if code != 250:
+                raise smtplib.SMTPDataError(code, message)
+            return
+
+        if data_reply[0] == 354:
+            # pipelined DATA was accepted for a rejected envelope, send an empty message
+            yield from self.write(b'.\r\n')
+            yield from self.reply()
+        yield from self.command('RSET')
+        if mail_reply[0] != 250:
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_email)
+        if not any(code in (250, 251) for code, _ in rcpt_replies):
+            raise smtplib.SMTPRecipientsRefused(dict(zip(recipients, rcpt_replies)))
+        raise smtplib.SMTPDataError(*data_reply)
+
+    @asyncio.coroutine
+    def quit(self):
+        try:
+            yield from self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer != None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncSMTPSender(object):
+    """
+    Sends batches of messages to an SMTP server from its own event loop thread,
+    over at most `concurrency` sessions at a time for all batches. Idle sessions
+    are reused unless idle for more than max_idle seconds.
+    Messages are sent within the rate limits of the given SendScheduler, and
+    retried when the server throttles them, up to `retries` times.
+    """
+
+    def __init__(self, host, port, username='', password='', use_ssl=False, timeout=30, concurrency=4, max_idle=60,
+                 scheduler=None, retries=0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_idle = max_idle
+        self.scheduler = scheduler or SendScheduler(concurrency)
+        self.retries = retries
+        self.handshakes = 0
+        self.sent = 0
+        self.loop = asyncio.new_event_loop()
+        self._sessions = asyncio.Semaphore(concurrency, loop=self.loop)
+        self._idle = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stats(self):
+        return {'handshakes': self.handshakes, 'sent': self.sent}
+
+    def submit(self, messages):
+        """
+        Schedules sending the given messages, from any thread.
+        Returns a concurrent.futures.Future with the number of messages sent and
+        the list of (message, exception) pairs of the ones that failed.
+        """
+        future = concurrent.futures.Future()
+
+        def done(task):
+            if task.exception() != None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            if future.set_running_or_notify_cancel():
+                self.loop.create_task(self._send_batch(list(messages))).add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(start)
+        return future
+
+    @asyncio.coroutine
+    def _send_batch(self, messages):
+        pending = deque((message, 0) for message in messages)
+        errors = []
+        self.scheduler.submitted(len(messages))
+        try:
+            workers = [self.loop.create_task(self._worker(pending, errors))
+                       for i in range(min(self.concurrency, len(messages)))]
+            if len(workers) > 0:
+                yield from asyncio.wait(workers, loop=self.loop)
+        finally:
+            self.scheduler.done(len(messages))
+        return len(messages) - len(errors), errors
+
+    @asyncio.coroutine
+    def _session(self):
+        """
+        An idle session if there is a fresh one, or a new one.
+        Returns the session and whether it was reused.
+        """
+        while len(self._idle) > 0:
+            session = self._idle.pop()
+            if time.time() - session.last_used <= self.max_idle:
+                return session, True
+            yield from session.quit()
+        session = AsyncSMTPSession(self.loop, self.timeout)
+        yield from session.connect(self.host, self.port, self.use_ssl, self.username, self.password)
+        self.handshakes += 1
+        return session, False
+
+    @asyncio.coroutine
+    def _worker(self, pending, errors):
+        """
+        Sends messages from pending over a single session until none are left.
+        A reused session that turns out to be stale is replaced and its first
+        message retried.
+        """
+        while len(pending) > 0:
+            yield from self._sessions.acquire()
+            try:
+                try:
+                    session, reused = yield from self._session()
+                except (smtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                    # server unavailable, fail the rest of the batch
+                    errors.extend((message, e) for message, attempt in pending)
+                    pending.clear()
+                    return
+                first = True
+                while len(pending) > 0:
+                    message, attempt = pending.popleft()
+                    # the scheduler blocks until the concurrency and rate limits
+                    # allow the send, wait for it off the event loop
+                    yield from self.loop.run_in_executor(None, self.scheduler.acquire)
+                    broken = None
+                    backoff = 0
+                    try:
+                        yield from session.send(message)
+                        self.sent += 1
+                        self.scheduler.success()
+                    except smtplib.SMTPServerDisconnected as e:
+                        broken = e
+                    except smtplib.SMTPException as e:
+                        if is_throttled(e) and attempt < self.retries:
+                            # slow down and retry the message later
+                            self.scheduler.throttle()
+                            pending.append((message, attempt + 1))
+                            backoff = self.scheduler.backoff(attempt + 1)
+                        else:
+                            # rejected message, the session is still usable
+                            errors.append((message, e))
+                    except (OSError, asyncio.TimeoutError) as e:
+                        broken = e
+                    finally:
+                        self.scheduler.release()
+                    if backoff > 0:
+                        yield from asyncio.sleep(backoff, loop=self.loop)
+                    if broken != None:
+                        session.close()
+                        session = None
+                        if reused and first:
+                            pending.appendleft((message, attempt))
+                        else:
+                            errors.append((message, broken))
+                        break
+                    first = False
+                if session != None:
+                    session.last_used = time.time()
+                    self._idle.append(session)
+            finally:
+                self._sessions.release()
+
+    def close(self):
+        """
+        Quits idle sessions and stops the event loop thread.
+        """
+        @asyncio.coroutine
+        def shutdown():
+            while len(self._idle) > 0:
+                yield from self._idle.pop().quit()
+            self.loop.stop()
+
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(lambda: self.loop.create_task(shutdown()))
+            self._thread.join(self.timeout)
+
+
+_SENDERS = {}
+_SENDERS_LOCK = threading.Lock()
+
+
+def sender(host, port, username, password, use_ssl, timeout):
+    """
+    Process-wide sender for the given server and credentials, created on first
+    use with MAILER_ASYNC_CONCURRENCY sessions and rate limited according to
+    the MAILER_RATE_* and MAILER_THROTTLE_* settings.
+    """
+    key = (host, port, username, password, use_ssl, timeout, settings.MAILER_ASYNC_CONCURRENCY)
+    with _SENDERS_LOCK:
+        if key not in _SENDERS:
+            _SENDERS[key] = AsyncSMTPSender(
+                host, port, username, password, use_ssl, timeout,
+                settings.MAILER_ASYNC_CONCURRENCY, settings.MAILER_CONNECTION_MAX_IDLE,
+                send_scheduler(settings.MAILER_ASYNC_CONCURRENCY), settings.MAILER_THROTTLE_RETRIES)
+            atexit.register(_SENDERS[key].close)
+        return _SENDERS[key]
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Django email backend sending through the process-wide AsyncSMTPSender for
+    the configured server. Connections are owned by the sender, so open() and
+    close() do nothing.
+    A failed message doesn't stop the rest of the batch from being sent, the
+    first failure is raised once the batch is done unless fail_silently.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, fail_silently=False, use_ssl=None, timeout=None, **kwargs):
+        BaseEmailBackend.__init__(self, fail_silently=fail_silently)
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username == None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password == None else password
+        self.use_ssl = settings.EMAIL_USE_SSL if use_ssl == None else use_ssl
+        self.timeout = settings.MAILER_ASYNC_TIMEOUT if timeout == None else timeout
+        if (settings.EMAIL_USE_TLS if use_tls == None else use_tls) and not self.use_ssl:
+            raise ImproperlyConfigured('The asyncio email backend does not support STARTTLS, use EMAIL_USE_SSL instead')
+
+    def sender(self):
+        return sender(self.host, self.port, self.username, self.password, self.use_ssl, self.timeout)
+
+    def submit(self, email_messages):
+        """
+        Schedules sending the given messages without waiting for them.
+        See AsyncSMTPSender.submit.
+        """
+        return self.sender().submit(email_messages)
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return
+        sent, errors = self.submit(email_messages).result()
+        if len(errors) > 0 and not self.fail_silently:
+            error = errors[0][1]
+            # messages that weren't sent, see ConnectionPool.send_messages
+            error.unsent = [message for message, e in errors]
+            raise error
+        return sent
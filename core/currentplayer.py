@@ -0,0 +1,136 @@
+"""
+Resolution of the current player of a request.
+
+The current player is identified by the player_id GET parameter of email links,
+and remembered in a signed cookie (or in the session if CURRENT_PLAYER_STORAGE
+is 'session'). Players are loaded from a compact snapshot (id, name and user id)
+cached until the player is saved or deleted, so most requests don't query the
+player nor the session. Snapshots are only cached if CURRENT_PLAYER_CACHE_TIMEOUT
+is positive, which needs a cache shared by all workers for saves to invalidate
+them everywhere.
+"""
+
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from core.models import Player
+
+
+LOGGER = logging.getLogger(__name__)
+
+COOKIE_NAME = 'fobal_player'
+COOKIE_SALT = 'core.currentplayer'
+CACHE_KEY = 'player_snapshot:%i'
+
+_UNRESOLVED = object()
+
+
+def snapshot(player_id):
+    """
+    Returns the (id, name, user_id) of the player with the given id, or None if
+    it doesn't exist.
+    """
+    if settings.CURRENT_PLAYER_CACHE_TIMEOUT <= 0:
+        return Player.objects.filter(id=player_id).values_list('id', 'name', 'user_id').first()
+    key = CACHE_KEY % player_id
+    values = cache.get(key)
+    if values == None:
+        values = Player.objects.filter(id=player_id).values_list('id', 'name', 'user_id').first()
+        if values == None:
+            return None
+        cache.set(key, values, settings.CURRENT_PLAYER_CACHE_TIMEOUT)
+    return values
+
+
+def invalidate(player_id):
+    """
+    Drops the cached snapshot of the player with the given id.
+    """
+    cache.delete(CACHE_KEY % player_id)
+
+
+def stored_player_id(request):
+    """
+    Returns the id of the player remembered for the request, or None.
+    The session is only read if there is a session cookie, players remembered in
+    the session before switching to cookies are moved to the cookie.
+    """
+    if settings.CURRENT_PLAYER_STORAGE == 'session':
+        return request.session.get('player_id', None)
+
+    player_id = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT)
+    if player_id == None and settings.SESSION_COOKIE_NAME in request.COOKIES:
+        player_id = request.session.pop('player_id', None)
+        if player_id != None:
+            remember(request, player_id)
+    return int(player_id) if player_id != None else None
+
+
+def remember(request, player_id):
+    """
+    Remembers the player with the given id for the following requests.
+    The cookie is set by CurrentPlayerMiddleware.
+    """
+    if settings.CURRENT_PLAYER_STORAGE == 'session':
+        request.session['player_id'] = player_id
+    else:
+        request.player_cookie = player_id
+    request.current_player = _UNRESOLVED
+
+
+def forget(request):
+    """
+    Forgets the player remembered for the request.
+    """
+    if settings.CURRENT_PLAYER_STORAGE == 'session':
+        request.session.pop('player_id', None)
+    else:
+        request.player_cookie = None
+    request.current_player = None
+
+
+def resolve(request):
+    """
+    Returns the current player of the request, or None.
+    If player_id is in the GET parameters that player is remembered, otherwise
+    the one remembered by previous requests is used.
+    The player only has its id, name and user id loaded, and is resolved once
+    per request.
+    """
+    if getattr(request, 'current_player', _UNRESOLVED) != _UNRESOLVED:
+        return request.current_player
+
+    if 'player_id' in request.GET:
+        player_id = int(request.GET['player_id'])
+        remember(request, player_id)
+    else:
+        player_id = stored_player_id(request)
+
+    player = None
+    if player_id != None:
+        values = snapshot(player_id)
+        if values != None:
+            player = Player(id=values[0], name=values[1], user_id=values[2])
+        else:
+            LOGGER.info('Player does not exist, forgetting it: %s' % player_id)
+            forget(request)
+    request.current_player = player
+    return player
+
+
+class CurrentPlayerMiddleware(object):
+    """
+    Sets or deletes the current player cookie when the request changed the
+    current player.
+    """
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'player_cookie'):
+            return response
+        if request.player_cookie != None:
+            response.set_signed_cookie(
+                COOKIE_NAME, request.player_cookie, salt=COOKIE_SALT,
+                max_age=settings.CURRENT_PLAYER_COOKIE_AGE, httponly=True)
+        else:
+            response.delete_cookie(COOKIE_NAME)
+        return response
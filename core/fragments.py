@@ -0,0 +1,106 @@
+"""
+Cached fragments of the match page that are the same for all players.
+"""
+
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from core.models import MatchPlayer, WaitingPlayer, Guest
+
+
+FRAGMENT_KEY = 'match_fragment:%i:%i:%s'
+FILL_KEY = 'match_fragment_fill:%i'
+
+
+class MatchFragment(namedtuple('MatchFragment', [
+        'roster', 'guests', 'waitlist', 'player_ids', 'guest_players', 'waiting_ids'])):
+    """
+    Rendered roster, guests and waitlist of a match, with the ids of the
+    players in the match, the inviting player id of every guest and the ids of
+    the waiting players, to render the personal parts of the page without
+    querying the roster.
+    """
+
+    def has_player(self, player):
+        return player.id in self.player_ids
+
+    def is_waiting(self, player):
+        return player.id in self.waiting_ids
+
+    def guests_for(self, player):
+        """
+        Rendered guests with links for removing the guests invited by the given
+        player.
+        """
+        guests = self.guests
+        for guest_id, inviting_player_id in self.guest_players.items():
+            if inviting_player_id == player.id:
+                link = render_to_string('core/partial_remove_guest.html', {'guest_id': guest_id})
+                guests = guests.replace('<!-- remove guest %i -->' % guest_id, link)
+        return mark_safe(guests)
+
+
+def fragment_key(match):
+    """
+    Cache key of the fragment of the given match as loaded. The version and
+    modification date are bumped in the same transaction as every roster
+    change (see core.signals), so a fragment is never cached under a version
+    older than its roster.
+    """
+    return FRAGMENT_KEY % (match.id, match.version, match.modified.isoformat())
+
+
+def render(match):
+    """
+    Renders the fragment of the given match, in three queries.
+    """
+    roster = list(MatchPlayer.objects.filter(match=match).select_related('player'))
+    guests = list(Guest.objects.filter(match=match).select_related('inviting_player'))
+    waitlist = list(WaitingPlayer.objects.filter(match=match).select_related('player'))
+    return MatchFragment(
+        mark_safe(render_to_string('core/partial_match_roster.html', {'roster': roster})),
+        mark_safe(render_to_string('core/partial_match_guests.html', {'guests': guests})),
+        mark_safe(render_to_string('core/partial_match_waitlist.html', {'waitlist': waitlist}) if waitlist else ''),
+        set(mp.player_id for mp in roster),
+        dict((guest.id, guest.inviting_player_id) for guest in guests),
+        set(waiting.player_id for waiting in waitlist))
+
+
+def match_fragment(match):
+    """
+    Returns the fragment of the given match from the cache, rendering it if
+    needed. The match must have been loaded in the current request, its
+    version tells which fragment is current.
+    Only one worker renders a missing fragment (as long as the cache is shared
+    by all of them), the others wait up to MATCH_CACHE_FILL_WAIT seconds for it
+    before rendering it themselves.
+    """
+    if settings.MATCH_CACHE_TIMEOUT <= 0:
+        return render(match)
+
+    key = fragment_key(match)
+    fragment = cache.get(key)
+    if fragment != None:
+        return fragment
+
+    fill_key = FILL_KEY % match.id
+    deadline = time.time() + settings.MATCH_CACHE_FILL_WAIT
+    while not cache.add(fill_key, True, settings.MATCH_CACHE_FILL_WAIT):
+        time.sleep(0.05)
+        fragment = cache.get(key)
+        if fragment != None:
+            return fragment
+        if time.time() > deadline:
+            break
+
+    try:
+        # the version was loaded before the roster, so changes made since
+        # leave the fragment under a stale key
+        fragment = render(match)
+        cache.set(key, fragment, settings.MATCH_CACHE_TIMEOUT)
+    finally:
+        cache.delete(fill_key)
+    return fragment
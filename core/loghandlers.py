@@ -0,0 +1,180 @@
+"""
+Logging handlers that don't block the logging thread.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from django.conf import settings
+from django.utils import log
+from django.utils.encoding import force_text
+from django.utils.module_loading import import_string
+from django.views.debug import ExceptionReporter, get_exception_reporter_filter
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that waits for room in a bounded queue when stopping, so
+    pending records are always flushed.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class AdminEmailHandler(log.AdminEmailHandler):
+    """
+    AdminEmailHandler that can render the request details of a record ahead of
+    time, so the email can be sent from another thread once the request is
+    gone (see BackgroundHandler).
+    """
+
+    def render_request(self, record):
+        """
+        Adds the IP label, the representation and, if include_html is set, the
+        HTML report of the request of the given record to it.
+        """
+        request = record.request
+        try:
+            record.request_ip = 'internal' if request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS else 'EXTERNAL'
+            filter = get_exception_reporter_filter(request)
+            record.request_repr = '\n%s' % force_text(filter.get_request_repr(request))
+        except Exception:
+            record.request_ip = None
+            record.request_repr = 'unavailable'
+            request = None
+        record.html_message = None
+        if self.include_html:
+            exc_info = record.exc_info or (None, record.getMessage(), None)
+            record.html_message = ExceptionReporter(request, is_email=True, *exc_info).get_traceback_html()
+
+    def emit(self, record):
+        if not hasattr(record, 'request_repr'):
+            log.AdminEmailHandler.emit(self, record)
+            return
+        if record.request_ip != None:
+            subject = '%s (%s IP): %s' % (record.levelname, record.request_ip, record.getMessage())
+        else:
+            subject = '%s: %s' % (record.levelname, record.getMessage())
+        message = '%s\n\nRequest repr(): %s' % (self.format(record), record.request_repr)
+        self.send_mail(self.format_subject(subject), message, fail_silently=True,
+                       html_message=record.html_message)
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Handler that hands records to a `target` handler (class or dotted path,
+    built with the remaining keyword arguments) running on a background thread,
+    so slow handlers like AdminEmailHandler don't block the logging thread.
+
+    At most `capacity` records are buffered, further records are dropped until
+    the target catches up. Records logged from the same place within `window`
+    seconds of each other are only handled once, the next one handled after the
+    window tells how many were suppressed.
+    Pending records are flushed when the handler is closed, which happens at
+    exit.
+    """
+
+    def __init__(self, target, capacity=100, window=300, **kwargs):
+        logging.Handler.__init__(self)
+        if isinstance(target, str):
+            target = import_string(target)
+        self.target = target(**kwargs)
+        self.capacity = capacity
+        self.window = window
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0
+        self.suppressed = {}
+        self._last_seen = {}
+        self._listener = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def start(self):
+        """
+        Starts the listener thread, again if the process was forked.
+        """
+        with self.lock:
+            if self._listener == None or self._pid != os.getpid():
+                self.queue = queue.Queue(self.capacity)
+                self._listener = QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Flushes the pending records and stops the listener thread.
+        """
+        with self.lock:
+            listener, self._listener = self._listener, None
+        if listener != None and self._pid == os.getpid():
+            listener.stop()
+
+    def key(self, record):
+        """
+        Records with the same key are duplicates.
+        """
+        return (record.name, record.levelno, record.pathname, record.lineno, str(record.msg),
+                record.exc_info[0] if record.exc_info else None)
+
+    def duplicate(self, record):
+        """
+        Whether an identical record was handled less than `window` seconds ago.
+        Otherwise the record is tagged with the number of suppressed duplicates.
+        """
+        key = self.key(record)
+        now = time.time()
+        with self.lock:
+            if now - self._last_seen.get(key, -self.window) < self.window:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return True
+            self._last_seen[key] = now
+            record.suppressed = self.suppressed.pop(key, 0)
+            if len(self._last_seen) > self.capacity:
+                for old in [k for k, seen in self._last_seen.items() if now - seen >= self.window]:
+                    del self._last_seen[old]
+        return False
+
+    def prepare(self, record):
+        """
+        Copy of the record with the message merged, so it doesn't depend on
+        arguments that could change before the record is handled. Exception info
+        is kept for the target. The request is not safe to use once the
+        response is sent, targets with a render_request method (like
+        AdminEmailHandler) render it on the logging thread, and it's dropped.
+        """
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, 'request', None) != None and hasattr(self.target, 'render_request'):
+            self.target.render_request(record)
+        record.__dict__.pop('request', None)
+        if record.suppressed > 0:
+            record.msg += ' (%i similar errors suppressed)' % record.suppressed
+        return record
+
+    def emit(self, record):
+        try:
+            if self.duplicate(record):
+                return
+            if self._listener == None or self._pid != os.getpid():
+                self.start()
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        logging.Handler.close(self)
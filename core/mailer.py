@@ -5,37 +5,749 @@ Mailer module for sending emails.
 from django.core.mail import get_connection, EmailMultiAlternatives
 from django.template.loader import get_template
 from django.template import Context
-from core.urlhelper import absolute_url, join_match_url, leave_match_url, match_url
+from django.utils.html import conditional_escape
+from django.utils.formats import date_format
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Sum, Case, When, IntegerField
+from django.db.models.query import QuerySet
+from core.models import OutboundEmail, RosterEvent, SentEmail
+from core.asyncsmtp import EmailBackend as AsyncioEmailBackend
+from core.ratelimit import SendScheduler, send_scheduler, is_throttled
+from core.urlhelper import absolute_url, join_match_url, leave_match_url, match_url, match_landing_url
+import smtplib
 import threading
+import multiprocessing
 import logging
+import atexit
+import time
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+from collections import namedtuple, OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+PHASES = ('query', 'render', 'queue', 'connect', 'transmit')
+"""
+Phases of sending a batch of emails that are timed:
+- query: loading the match and recipients from the database
+- render: rendering the templates and creating the messages
+- queue: waiting for a sender thread or connection, or inserting in the queue
+- connect: opening SMTP connections
+- transmit: transmitting messages over SMTP
+"""
+
+
+class MailerStats(object):
+    """
+    Thread-safe totals of batch timings and counters per message kind,
+    since the process started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}
+
+    def record(self, timer):
+        """
+        Adds the timings and counters of the given finished batch timer.
+        """
+        with self._lock:
+            totals = self._kinds.setdefault(timer.kind, {
+                'batches': 0,
+                'messages': 0,
+                'failures': 0,
+                'seconds': dict((phase, 0.0) for phase in PHASES),
+            })
+            totals['batches'] += 1
+            totals['messages'] += timer.messages
+            totals['failures'] += timer.failures
+            for phase in PHASES:
+                totals['seconds'][phase] += timer.seconds[phase]
+            totals['last_batch'] = timer.as_dict()
+
+    def snapshot(self):
+        """
+        Copy of the totals per message kind.
+        """
+        with self._lock:
+            return dict((kind, dict(totals, seconds=dict(totals['seconds']))) for kind, totals in self._kinds.items())
+
+
+STATS = MailerStats()
+
+
+class BatchTimer(object):
+    """
+    Timings and counters for a batch of emails of the given kind (invite,
+    status, join, leave, guest...), which can be sent from several threads.
+    The batch is finished when finish() has been called and every sender
+    thread holding it has released it, then it is added to STATS and logged.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.seconds = dict((phase, 0.0) for phase in PHASES)
+        self.messages = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._holds = 1
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent in it to the given phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.add(name, elapsed)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+
+    def count(self, messages=0, failures=0):
+        with self._lock:
+            self.messages += messages
+            self.failures += failures
+
+    def hold(self):
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            finished = self._holds == 0
+        if finished:
+            STATS.record(self)
+            batch = self.as_dict()
+            LOGGER.info(
+                'mail_batch kind=%s messages=%i failures=%i ' % (self.kind, self.messages, self.failures) +
+                ' '.join('%s_ms=%.1f' % (phase, batch['ms'][phase]) for phase in PHASES),
+                extra={'mail_batch': batch})
+
+    def finish(self):
+        """
+        Marks the batch as fully produced.
+        """
+        self.release()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'kind': self.kind,
+                'messages': self.messages,
+                'failures': self.failures,
+                'ms': dict((phase, self.seconds[phase] * 1000) for phase in PHASES),
+            }
+
+
+class NullTimer(object):
+    """
+    Batch timer that records nothing, for untracked sends.
+    """
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, messages=0, failures=0):
+        pass
+
+    def hold(self):
+        pass
+
+    def release(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of long-lived email backend connections.
+    At most `size` connections are used at the same time, so concurrent batches
+    wait for a free connection instead of opening new SMTP sessions.
+    Idle connections are reused across batches, and reopened when they have been
+    idle for more than `max_idle` seconds or the server dropped them.
+    Every message is sent within the limits of the given SendScheduler, and
+    retried when the server throttles it, up to `retries` times.
+    Any extra keyword arguments are passed to django.core.mail.get_connection.
+    """
+
+    def __init__(self, size, max_idle, scheduler=None, retries=0, **connection_kwargs):
+        self.size = size
+        self.max_idle = max_idle
+        self.scheduler = scheduler or SendScheduler(size)
+        self.retries = retries
+        self.connection_kwargs = connection_kwargs
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.handshakes = 0
+        self.sent = 0
+
+    def stats(self):
+        """
+        Counters for measuring the pool: handshakes (connections opened) and
+        messages sent since the pool was created.
+        """
+        with self._lock:
+            return {'handshakes': self.handshakes, 'sent': self.sent}
+
+    def _open(self, connection):
+        # backends return True only when a new connection was actually opened
+        if connection.open():
+            with self._lock:
+                self.handshakes += 1
+
+    def _acquire(self, timer):
+        with timer.phase('queue'):
+            self._semaphore.acquire()
+        connection = None
+        with self._lock:
+            if len(self._idle) > 0:
+                connection, last_used = self._idle.pop()
+        if connection != None and time.time() - last_used > self.max_idle:
+            # the server has probably dropped it already
+            self._close(connection)
+        elif connection == None:
+            connection = get_connection(**self.connection_kwargs)
+        try:
+            with timer.phase('connect'):
+                self._open(connection)
+        except:
+            self._semaphore.release()
+            raise
+        return connection
+
+    def _release(self, connection, broken=False):
+        if broken:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, time.time()))
+        self._semaphore.release()
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            LOGGER.exception('Error closing mail connection')
+
+    def send_messages(self, messages, timer=NULL_TIMER):
+        """
+        Sends the given email messages over a pooled connection, blocking until
+        a connection is available, and each message until the scheduler allows it.
+        Stale connections are reopened and the failed message is retried once.
+        Time spent is added to the given BatchTimer.
+        Returns the number of messages sent. If sending fails the exception is
+        raised with the list of messages that weren't sent in its unsent
+        attribute (missing if none could be sent).
+        """
+        self.scheduler.submitted(len(messages))
+        done = 0
+        try:
+            connection = self._acquire(timer)
+            sent = 0
+            try:
+                for message in messages:
+                    sent += self._send(connection, message, timer)
+                    done += 1
+                    self.scheduler.done()
+            except BaseException as e:
+                timer.count(failures=1)
+                self._release(connection, broken=True)
+                e.unsent = messages[done:]
+                raise
+            finally:
+                with self._lock:
+                    self.sent += sent
+            self._release(connection)
+            return sent
+        finally:
+            self.scheduler.done(len(messages) - done)
+
+    def _send(self, connection, message, timer):
+        """
+        Sends a single message when the scheduler allows it, reconnecting once
+        if the connection went stale, and retrying with backoff if throttled.
+        """
+        attempt = 0
+        while True:
+            try:
+                with timer.phase('queue'):
+                    self.scheduler.acquire()
+                try:
+                    count = self._transmit(connection, message, timer)
+                finally:
+                    self.scheduler.release()
+            except smtplib.SMTPException as e:
+                if not is_throttled(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.scheduler.throttle()
+                LOGGER.warning('Mail server throttled us (%s), retrying in %is with concurrency %s, backlog %i' % (
+                    e, self.scheduler.backoff(attempt), int(self.scheduler.concurrency), self.scheduler.backlog))
+                with timer.phase('queue'):
+                    time.sleep(self.scheduler.backoff(attempt))
+                continue
+            self.scheduler.success()
+            return count or 0
+
+    def _transmit(self, connection, message, timer):
+        try:
+            with timer.phase('transmit'):
+                return connection.send_messages([message])
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            LOGGER.info('Mail connection went stale, reconnecting')
+            self._close(connection)
+            with timer.phase('connect'):
+                self._open(connection)
+            with timer.phase('transmit'):
+                return connection.send_messages([message])
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            self._close(connection)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def connection_pool():
+    """
+    Process-wide connection pool for the default email backend, created on
+    first use according to the MAILER_POOL_SIZE and MAILER_CONNECTION_MAX_IDLE
+    settings, rate limited according to the MAILER_RATE_* and MAILER_THROTTLE_*
+    settings.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL == None:
+            _POOL = ConnectionPool(
+                settings.MAILER_POOL_SIZE,
+                settings.MAILER_CONNECTION_MAX_IDLE,
+                scheduler=send_scheduler(settings.MAILER_POOL_SIZE),
+                retries=settings.MAILER_THROTTLE_RETRIES)
+            atexit.register(_POOL.close)
+        return _POOL
+
+
+def use_connection_pool(pool):
+    """
+    Replaces the process-wide connection pool with the given one, for sending
+    to another server. Returns the previous pool (if any), which is left open.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        previous, _POOL = _POOL, pool
+        return previous
+
+
 class EmailThread(threading.Thread):
     """
     Thread subclass for sending email asynchronously.
+    The optional done callback is called once the messages have been sent (or
+    failed to), and the given BatchTimer is held until then. Failures are
+    logged, and the optional failed callback is called with the messages that
+    weren't sent.
     """
 
-    def __init__(self, messages):
+    def __init__(self, messages, done=None, timer=NULL_TIMER, failed=None):
         self.messages = messages
+        self.done = done
+        self.failed = failed
+        self.timer = timer
+        self.timer.hold()
         threading.Thread.__init__(self)
 
     def run (self):
-        get_connection().send_messages(self.messages)
-        LOGGER.info('Sent %i emails in background' % len(self.messages))
+        try:
+            sent = connection_pool().send_messages(self.messages, self.timer)
+            LOGGER.info('Sent %i emails in background' % sent)
+        except Exception as e:
+            unsent = getattr(e, 'unsent', self.messages)
+            LOGGER.warning('Failed to send %i emails in background: %r' % (len(unsent), e))
+            background_failure(unsent, self.failed)
+        finally:
+            if self.done != None:
+                self.done()
+            self.timer.release()
 
 
-def send_mails(messages, async=True):
+def asyncio_backend():
     """
-    Sends the given email messages using the default email backend.
-    The operation is asynchronous by default.
+    Instance of the default email backend if it is the asyncio backend, which
+    sends from its own event loop thread and sessions instead of the pool.
     """
+    connection = get_connection()
+    return connection if isinstance(connection, AsyncioEmailBackend) else None
+
+
+def background_failure(messages, failed):
+    """
+    Calls the given failed callback, if any, with the messages that failed to
+    send in the background.
+    """
+    if failed == None:
+        return
+    try:
+        failed(messages)
+    except Exception:
+        LOGGER.exception('Error handling %i emails that failed to send' % len(messages))
+
+
+def send_in_background(messages, done=None, timer=NULL_TIMER, failed=None):
+    """
+    Sends the given email messages without waiting for them, from the event
+    loop of the asyncio backend if it is the default one, or from an
+    EmailThread otherwise.
+    The optional done callback is called once the messages have been sent (or
+    failed to), the optional failed callback is called with the messages that
+    failed, if any.
+    """
+    backend = asyncio_backend()
+    if backend == None:
+        EmailThread(messages, done, timer, failed).start()
+        return
+
+    timer.hold()
+    start = time.time()
+
+    def sent(future):
+        try:
+            try:
+                count, errors = future.result()
+            except Exception as e:
+                count, errors = 0, [(message, e) for message in messages]
+            LOGGER.info('Sent %i emails in background' % count)
+            if len(errors) > 0:
+                timer.count(failures=len(errors))
+                LOGGER.warning('Failed to send %i emails in background: %s' % (len(errors), errors[0][1]))
+                background_failure([message for message, e in errors], failed)
+        finally:
+            timer.add('transmit', time.time() - start)
+            if done != None:
+                done()
+            timer.release()
+
+    backend.submit(messages).add_done_callback(sent)
+
+
+def send_mails(messages, async=True, timer=NULL_TIMER):
+    """
+    Sends the given email messages using the pooled connections of the default
+    email backend (or the sessions of the asyncio backend), recording time spent
+    in the given BatchTimer.
+    The operation is asynchronous by default, in which case messages are stored
+    in the outbound email queue if MAILER_QUEUE is set, or sent in the
+    background otherwise.
+    """
+    timer.count(messages=len(messages))
     if async == True:
-        EmailThread(messages).start()
+        if settings.MAILER_QUEUE:
+            with timer.phase('queue'):
+                queue_mails(messages)
+        else:
+            send_in_background(messages, timer=timer)
     else:
-        get_connection().send_messages(messages)
+        backend = asyncio_backend()
+        if backend != None:
+            with timer.phase('transmit'):
+                backend.send_messages(messages)
+        else:
+            connection_pool().send_messages(messages, timer)
+
+
+def chunked(players, size):
+    """
+    Generator splitting the given players into lists of at most size players.
+    QuerySets are paginated by primary key, so only one chunk of players is
+    loaded in memory at a time.
+    """
+    if isinstance(players, QuerySet):
+        last_id = None
+        while True:
+            page = players.order_by('pk')
+            if last_id != None:
+                page = page.filter(pk__gt=last_id)
+            chunk = list(page[:size])
+            if len(chunk) == 0:
+                return
+            yield chunk
+            last_id = chunk[-1].pk
+    else:
+        players = iter(players)
+        while True:
+            chunk = list(islice(players, size))
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def send_mail_chunks(chunks, async=True, timer=NULL_TIMER, failed=None):
+    """
+    Sends each chunk (list) of email messages as soon as it is produced by the
+    given iterable, so only a few chunks are kept in memory at a time.
+    In async mode each chunk is sent in the background, and the producer blocks
+    while MAILER_MAX_PENDING_CHUNKS chunks are waiting to be sent.
+    The optional failed callback is called with the messages of every chunk
+    that weren't sent (or queued) because sending failed.
+    The given BatchTimer is finished once all chunks have been produced.
+    Returns the number of recipients.
+    """
+    pending = threading.BoundedSemaphore(settings.MAILER_MAX_PENDING_CHUNKS)
+    count = 0
+    try:
+        for messages in chunks:
+            count += sum(len(message.recipients()) for message in messages)
+            if async == True and not settings.MAILER_QUEUE:
+                with timer.phase('queue'):
+                    pending.acquire()
+                timer.count(messages=len(messages))
+                send_in_background(messages, pending.release, timer, failed)
+            else:
+                try:
+                    send_mails(messages, async, timer)
+                except Exception as e:
+                    if failed != None:
+                        failed(getattr(e, 'unsent', messages))
+                    raise
+    finally:
+        timer.finish()
+    return count
+
+
+def message_chunks(template, players, timer=NULL_TIMER, ledger=None):
+    """
+    Generator of lists of email messages created from the given template for
+    the given players, MAILER_CHUNK_SIZE messages at a time.
+    Messages are created in a pool of MAILER_RENDER_PROCESSES processes if set.
+    If a SendLedger is given, every chunk of players is recorded in it before
+    rendering, leaving out players a concurrent send got to first.
+    Time spent loading players and creating messages is added to the given
+    BatchTimer.
+    """
+    chunks = chunked(players, settings.MAILER_CHUNK_SIZE)
+    if ledger != None:
+        chunks = ledger.record(chunks)
+    if settings.MAILER_RENDER_PROCESSES > 0:
+        chunks = pooled_message_chunks(template, chunks, settings.MAILER_RENDER_PROCESSES)
+        while True:
+            with timer.phase('render'):
+                messages = next(chunks, None)
+            if messages == None:
+                return
+            yield messages
+    else:
+        while True:
+            with timer.phase('query'):
+                chunk = next(chunks, None)
+            if chunk == None:
+                return
+            with timer.phase('render'):
+                messages = [template.message(player) for player in chunk]
+            yield messages
+
+
+def broadcast_chunks(template, players, timer=NULL_TIMER, ledger=None):
+    """
+    Generator of lists with a single BCC email message created from the given
+    BroadcastTemplate for every MAILER_BROADCAST_CHUNK players.
+    If a SendLedger is given, every chunk of players is recorded in it first.
+    """
+    chunks = chunked(players, settings.MAILER_BROADCAST_CHUNK)
+    if ledger != None:
+        chunks = ledger.record(chunks)
+    while True:
+        with timer.phase('query'):
+            chunk = next(chunks, None)
+        if chunk == None:
+            return
+        with timer.phase('render'):
+            messages = [template.message(chunk)]
+        yield messages
+
+
+_WORKER_TEMPLATE = None
+
+
+def _init_render_worker(template):
+    # each worker process keeps its own copy of the batch template
+    global _WORKER_TEMPLATE
+    _WORKER_TEMPLATE = template
+
+
+def _render_chunk(players):
+    return [_WORKER_TEMPLATE.message(player) for player in players]
+
+
+def pooled_message_chunks(template, chunks, processes):
+    """
+    Generator of lists of email messages created from the given template for
+    the given chunks (lists) of players in a pool of worker processes, in order.
+    The template is sent once to every worker, and at most two chunks per
+    worker are in flight so memory stays flat for large batches.
+    """
+    pool = multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(template,))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+Unsent = namedtuple('Unsent', ['players', 'count', 'skipped'])
+
+
+class SendLedger(object):
+    """
+    Ledger of the `kind` emails sent to players about the match on the given
+    day, so sending them again (a retried trigger, for example) skips players
+    that already got one. Players that got any of the also_skip kinds that day
+    are skipped too.
+    Players are recorded before their emails are sent, so concurrent sends
+    don't both email them, and released if sending fails so the next send
+    retries them. Emails that were being sent by a process that died are not
+    retried.
+    """
+
+    def __init__(self, match, kind, day, also_skip=()):
+        self.match = match
+        self.kind = kind
+        self.day = day
+        self.kinds = (kind,) + tuple(also_skip)
+
+    def entries(self):
+        return SentEmail.objects.filter(match=self.match.id, kind__in=self.kinds, day=self.day)
+
+    def unsent(self, players):
+        """
+        Returns an Unsent tuple with the given players that weren't sent an
+        email yet, how many they are, and the number of players skipped.
+        QuerySets are counted and filtered in the database with a single query,
+        so players that were already sent an email are never loaded.
+        """
+        sent_ids = self.entries().values('player')
+        if isinstance(players, QuerySet):
+            counts = players.aggregate(
+                total=Count('id'),
+                skipped=Sum(Case(When(id__in=sent_ids, then=1), default=0, output_field=IntegerField())))
+            skipped = counts['skipped'] or 0
+            return Unsent(players.exclude(id__in=sent_ids), counts['total'] - skipped, skipped)
+        sent_ids = set(sent_ids.values_list('player', flat=True))
+        unsent = [player for player in players if player.id not in sent_ids]
+        return Unsent(unsent, len(unsent), len(players) - len(unsent))
+
+    def record(self, chunks):
+        """
+        Generator recording every given chunk (list) of players in the ledger.
+        Yields the players in each chunk that weren't recorded already by a
+        concurrent send.
+        """
+        for players in chunks:
+            try:
+                with transaction.atomic():
+                    self._create(players)
+            except IntegrityError:
+                sent_ids = set(self.entries().filter(
+                    player__in=[player.id for player in players]).values_list('player', flat=True))
+                players = [player for player in players if player.id not in sent_ids]
+                with transaction.atomic():
+                    self._create(players)
+            if len(players) > 0:
+                yield players
+
+    def release(self, messages):
+        """
+        Removes the recipients of the given messages, which failed to send, from
+        the ledger.
+        """
+        emails = set(parseaddr(address)[1] for message in messages for address in message.recipients())
+        SentEmail.objects.filter(match=self.match.id, kind=self.kind, day=self.day, player__email__in=emails).delete()
+        LOGGER.warning('%i %s emails about %s failed to send, they will be retried' % (
+            len(emails), self.kind, self.match))
+
+    def _create(self, players):
+        SentEmail.objects.bulk_create([
+            SentEmail(match_id=self.match.id, player_id=player.id, kind=self.kind, day=self.day)
+            for player in players])
+
+
+def queue_mails(messages):
+    """
+    Stores the given email messages in the outbound email queue, to be sent
+    later by the sendqueuedmail command.
+    """
+    OutboundEmail.objects.bulk_create([OutboundEmail.from_message(m) for m in messages])
+
+
+def send_queued_mails(batch_size, pool=None):
+    """
+    Sends up to batch_size pending queued emails that are due, oldest first.
+    Failed emails are scheduled for retry with exponential backoff according to
+    the MAILER_RETRY_DELAY and MAILER_MAX_ATTEMPTS settings.
+    Emails are claimed in a short transaction, by moving their next attempt
+    MAILER_CLAIM_TIMEOUT seconds ahead, so concurrent workers don't send them
+    twice and no rows are locked while talking to the SMTP server. Emails of a
+    worker that dies while sending are retried once the claim expires.
+    Returns a (sent, failed) tuple.
+    """
+    pool = pool or connection_pool()
+    timer = BatchTimer('queued')
+    now = datetime.now()
+    sent = failed = 0
+    with timer.phase('query'):
+        with transaction.atomic():
+            emails = list(OutboundEmail.objects.select_for_update().filter(
+                status=OutboundEmail.PENDING,
+                next_attempt__lte=now).order_by('next_attempt')[:batch_size])
+            OutboundEmail.objects.filter(id__in=[email.id for email in emails]).update(
+                next_attempt=now + timedelta(seconds=settings.MAILER_CLAIM_TIMEOUT))
+    timer.count(messages=len(emails))
+    for email in emails:
+        try:
+            pool.send_messages([email.message()], timer)
+        except Exception as e:
+            LOGGER.warning('Failed to send queued email %i: %r' % (email.id, e))
+            email.mark_failed(repr(e), now, settings.MAILER_RETRY_DELAY, settings.MAILER_MAX_ATTEMPTS)
+            failed += 1
+        else:
+            email.mark_sent(datetime.now())
+            sent += 1
+        email.save()
+    if len(emails) > 0:
+        timer.finish()
+    return sent, failed
 
 
 def email_address(player):
@@ -45,6 +757,173 @@ def email_address(player):
     return '%s <%s>' % (player.name, player.email)
 
 
+SUBJECT = 'Fobal'
+FROM_EMAIL = 'Fobal <noreply@fobal.com>'
+
+
+_TEMPLATES = {}
+
+
+def email_template(name):
+    """
+    Compiled email template with the given name.
+    Templates are loaded and compiled once per process.
+    """
+    template = _TEMPLATES.get(name)
+    if template == None:
+        template = _TEMPLATES[name] = get_template(name)
+    return template
+
+
+class MatchSnapshot(namedtuple('MatchSnapshot', [
+        'id', 'date', 'formatted_date', 'place', 'players', 'players_count', 'guests_count', 'player_count'])):
+    """
+    Immutable snapshot of a match for rendering a batch of emails.
+    Counts, the localized date and the roster are computed once, so rendering
+    and addressing a batch takes a constant number of queries.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, match):
+        """
+        Snapshot of the given match, or the match itself if it is a snapshot already.
+        """
+        if isinstance(match, MatchSnapshot):
+            return match
+        players = tuple(match.players.all())
+        guests_count = match.guests.count()
+        return cls(
+            id=match.id,
+            date=match.date,
+            formatted_date=date_format(match.date, 'MATCH_DATE_FORMAT'),
+            place=match.place,
+            players=players,
+            players_count=len(players),
+            guests_count=guests_count,
+            player_count=len(players) + guests_count)
+
+
+PLAYER_FIELDS = {
+    'player_name': lambda match, player: player.name,
+    'match_url': lambda match, player: absolute_url(match_url(match, player)),
+    'join_match_url': lambda match, player: absolute_url(join_match_url(match, player)),
+    'leave_match_url': lambda match, player: absolute_url(leave_match_url(match, player)),
+}
+"""
+Per-player fields available to email templates, and how to compute them.
+"""
+
+
+def placeholder(field):
+    """
+    Marker rendered in place of the given per-player field.
+    """
+    return '\x00%s\x00' % field
+
+
+class PlaceholderPlayer(object):
+    """
+    Stand-in for the recipient player while rendering a message template.
+    """
+    name = placeholder('player_name')
+
+
+class MessageTemplate(object):
+    """
+    Email message template rendered once for a batch of recipients.
+    The plain text and HTML bodies are rendered with placeholders for the
+    per-player fields (see PLAYER_FIELDS), so creating each message only
+    interpolates the recipient's values into the pre-rendered parts.
+    Per-player fields must be output without filters in the templates.
+    The match is available to the templates as a MatchSnapshot.
+    """
+
+    def __init__(self, name, match, context):
+        self.match = MatchSnapshot.of(match)
+        context = Context(dict(context, match=self.match, player=PlaceholderPlayer(), **dict(
+            (field, placeholder(field)) for field in PLAYER_FIELDS if field != 'player_name')))
+        self.text = email_template('core/%s.txt' % name).render(context).split('\x00')
+        self.html = email_template('core/%s.html' % name).render(context).split('\x00')
+
+    def interpolate(self, parts, values):
+        # even parts are literal text, odd parts are field names
+        return ''.join(part if i % 2 == 0 else values[part] for i, part in enumerate(parts))
+
+    def message(self, player):
+        """
+        Email message for the given player.
+        Includes plain text and HTML versions of the body.
+        """
+        fields = set(self.text[1::2]) | set(self.html[1::2])
+        values = dict(
+            (field, conditional_escape(PLAYER_FIELDS[field](self.match, player))) for field in fields)
+
+        msg = EmailMultiAlternatives(SUBJECT, self.interpolate(self.text, values), FROM_EMAIL, [email_address(player)])
+        msg.attach_alternative(self.interpolate(self.html, values), "text/html")
+        return msg
+
+
+class BroadcastTemplate(object):
+    """
+    Email message rendered once for any number of recipients, who are sent the
+    same message in BCC. There is no player in the context, and the links point
+    to the match landing page, which identifies the player.
+    The match is available to the templates as a MatchSnapshot.
+    """
+
+    def __init__(self, name, match, context):
+        self.match = MatchSnapshot.of(match)
+        context = Context(dict(
+            context,
+            match=self.match,
+            match_url=absolute_url(match_landing_url(self.match)),
+            join_match_url=absolute_url(match_landing_url(self.match, 'join')),
+            leave_match_url=absolute_url(match_landing_url(self.match, 'leave'))))
+        self.text = email_template('core/%s.txt' % name).render(context)
+        self.html = email_template('core/%s.html' % name).render(context)
+
+    def message(self, players):
+        """
+        Email message for the given players, in BCC.
+        """
+        msg = EmailMultiAlternatives(
+            SUBJECT, self.text, FROM_EMAIL, bcc=[email_address(player) for player in players],
+            headers={'To': 'undisclosed-recipients:;'})
+        msg.attach_alternative(self.html, "text/html")
+        return msg
+
+
+def send_template_chunks(timer, name, match, players, async, ledger):
+    """
+    Send the `name` email for the given match to the given players, finishing
+    the given BatchTimer.
+    Messages are personalised and sent in chunks of MAILER_CHUNK_SIZE, or
+    broadcast in BCC to chunks of MAILER_BROADCAST_CHUNK players if
+    MAILER_BROADCAST is set.
+    Returns the number of emails sent.
+    """
+    with timer.phase('query'):
+        match = MatchSnapshot.of(match)
+    with timer.phase('render'):
+        if settings.MAILER_BROADCAST:
+            template = BroadcastTemplate(name, match, {})
+        else:
+            template = MessageTemplate(name, match, {})
+    if settings.MAILER_BROADCAST:
+        chunks = broadcast_chunks(template, players, timer, ledger)
+    else:
+        chunks = message_chunks(template, players, timer, ledger)
+    return send_mail_chunks(chunks, async, timer, ledger.release if ledger != None else None)
+
+
+def invite_template(match):
+    """
+    Message template for inviting players to the given match.
+    """
+    return MessageTemplate('match_invite_email', match, {})
+
+
 def invite_message(match, player):
     """
     Email message for inviting the given player to the given match.
@@ -52,35 +931,26 @@ def invite_message(match, player):
     Includes links for the player to join/leave the match,
     and a link to the match itself.
     """
-    context = Context({
-        'player': player,
-        'match': match,
-        'match_url': absolute_url(match_url(match, player)),
-        'join_match_url': absolute_url(join_match_url(match, player)),
-        'leave_match_url': absolute_url(leave_match_url(match, player)),
-    })
-
-    text = get_template('core/match_invite_email.txt').render(context)
-    html = get_template('core/match_invite_email.html').render(context)
+    return invite_template(match).message(player)
 
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
 
-
-def send_invite_mails(match, players, async=True):
+def send_invite_mails(match, players, async=True, ledger=None):
     """
     Send emails to invite the given players to the given match.
-    This is a convenience method that uses invite_message to create and send
-    messages for all players.
+    This is a convenience method that creates and sends invite messages (see
+    invite_template) for all players, in chunks of MAILER_CHUNK_SIZE messages,
+    or broadcasts it if MAILER_BROADCAST is set (see send_template_chunks).
+    Sent emails are recorded in the given SendLedger, if any.
     Returns the number of emails sent.
     """
-    messages = []
-    for player in players:
-        messages.append(invite_message(match, player))
-    send_mails(messages, async)
-    return len(messages)
+    return send_template_chunks(BatchTimer('invite'), 'match_invite_email', match, players, async, ledger)
+
+
+def leave_match_template(match, leaving_player):
+    """
+    Message template for notifying players about the leaving_player leaving the match.
+    """
+    return MessageTemplate('leave_match_email', match, {'leaving_player': leaving_player})
 
 
 def leave_match_message(match, player, leaving_player):
@@ -89,35 +959,32 @@ def leave_match_message(match, player, leaving_player):
     Includes plain text and HTML versions of the body.
     Includes a link to the match.
     """
-    context = Context({
-        'player': player,
-        'leaving_player': leaving_player,
-        'match': match,
-        'match_url': absolute_url(match_url(match, player)),
-    })
-
-    text = get_template('core/leave_match_email.txt').render(context)
-    html = get_template('core/leave_match_email.html').render(context)
-
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
+    return leave_match_template(match, leaving_player).message(player)
 
 
 def send_leave_mails(match, leaving_player, async=True):
     """
     Send email notifications to all players in the given match to inform that
     the given leaving_player is not playing.
-    This is a convenience method that uses leave_match_message to create messages.
+    This is a convenience method that uses leave_match_template to create messages.
     Returns the number of emails sent.
+    The change is recorded for a digest instead if MAILER_DIGEST_WINDOW is set.
     """
-    messages = []
-    for player in match.players.all():
-        if player != leaving_player:
-            messages.append(leave_match_message(match, player, leaving_player))
-    send_mails(messages, async)
-    return len(messages)
+    if settings.MAILER_DIGEST_WINDOW:
+        return record_roster_event(match, RosterEvent.LEFT, leaving_player)
+    timer = BatchTimer('leave')
+    with timer.phase('query'):
+        match = MatchSnapshot.of(match)
+    with timer.phase('render'):
+        template = leave_match_template(match, leaving_player)
+    return send_roster_mails(template, leaving_player, async, timer)
+
+
+def join_match_template(match, joining_player):
+    """
+    Message template for notifying players about the joining_player joining the match.
+    """
+    return MessageTemplate('join_match_email', match, {'joining_player': joining_player})
 
 
 def join_match_message(match, player, joining_player):
@@ -126,73 +993,71 @@ def join_match_message(match, player, joining_player):
     the given joining_player joining the given match.
     Includes plain text and HTML vesions of the body and a link to the match.
     """
-    context = Context({
-        'player': player,
-        'joining_player': joining_player,
-        'match': match,
-        'match_url': absolute_url(match_url(match, player)),
-    })
-
-    text = get_template('core/join_match_email.txt').render(context)
-    html = get_template('core/join_match_email.html').render(context)
-
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
+    return join_match_template(match, joining_player).message(player)
 
 
 def send_join_mails(match, joining_player, async=True):
     """
     Send email notifications to all players in the given match to inform that
     the given joining_player has joined.
-    This is a convenience method that uses join_match_message and returns the
+    This is a convenience method that uses join_match_template and returns the
     number of emails sent.
+    The change is recorded for a digest instead if MAILER_DIGEST_WINDOW is set.
     """
-    messages = []
-    for player in match.players.all():
-        if player != joining_player:
-            messages.append(join_match_message(match, player, joining_player))
-    send_mails(messages, async)
-    return len(messages)
+    if settings.MAILER_DIGEST_WINDOW:
+        return record_roster_event(match, RosterEvent.JOINED, joining_player)
+    timer = BatchTimer('join')
+    with timer.phase('query'):
+        match = MatchSnapshot.of(match)
+    with timer.phase('render'):
+        template = join_match_template(match, joining_player)
+    return send_roster_mails(template, joining_player, async, timer)
 
 
-def invite_guest_message(match, player, inviting_player, guest):
+def invite_guest_template(match, inviting_player, guest):
     """
-    Creates and returns an email message to notify the given player about the
-    inviting_player inviting the guest to the match.
-    Contains plain text and HTML versions of the body and a link to the match.
+    Message template for notifying players about the inviting_player inviting
+    the guest to the match.
     """
-    context = Context({
-        'player': player,
+    return MessageTemplate('invite_guest_email', match, {
         'inviting_player': inviting_player,
-        'match': match,
-        'match_url': absolute_url(match_url(match, player)),
         'guest': guest,
     })
 
-    text = get_template('core/invite_guest_email.txt').render(context)
-    html = get_template('core/invite_guest_email.html').render(context)
 
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
+def invite_guest_message(match, player, inviting_player, guest):
+    """
+    Creates and returns an email message to notify the given player about the
+    inviting_player inviting the guest to the match.
+    Contains plain text and HTML versions of the body and a link to the match.
+    """
+    return invite_guest_template(match, inviting_player, guest).message(player)
 
 
 def send_invite_guest_mails(match, inviting_player, guest, async=True):
     """
     Send email notifications to all players but the inviting_player in the given
     match to inform that the given inviting_player has invited the given guest.
-    Convenience method that calls invite_guest_message and returns the number of
+    Convenience method that uses invite_guest_template and returns the number of
     emails sent.
+    The change is recorded for a digest instead if MAILER_DIGEST_WINDOW is set.
     """
-    messages = []
-    for player in match.players.all():
-        if player != inviting_player:
-            messages.append(invite_guest_message(match, player, inviting_player, guest))
-    send_mails(messages, async)
-    return len(messages)
+    if settings.MAILER_DIGEST_WINDOW:
+        return record_roster_event(match, RosterEvent.GUEST_ADDED, inviting_player, guest.name)
+    timer = BatchTimer('guest')
+    with timer.phase('query'):
+        match = MatchSnapshot.of(match)
+    with timer.phase('render'):
+        template = invite_guest_template(match, inviting_player, guest)
+    return send_roster_mails(template, inviting_player, async, timer)
+
+
+def remove_guest_template(guest):
+    """
+    Message template for notifying players about the guest being removed from
+    the match.
+    """
+    return MessageTemplate('remove_guest_email', guest.match, {'guest': guest})
 
 
 def remove_guest_message(guest, player):
@@ -201,65 +1066,166 @@ def remove_guest_message(guest, player):
     inviting_player removing the guest from the match.
     Contains plain text and HTML versions of the body and a link to the match.
     """
-    context = Context({
-        'player': player,
-        'match_url': absolute_url(match_url(guest.match, player)),
-        'guest': guest,
-    })
-
-    text = get_template('core/remove_guest_email.txt').render(context)
-    html = get_template('core/remove_guest_email.html').render(context)
-
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
+    return remove_guest_template(guest).message(player)
 
 
 def send_remove_guest_mails(guest, async=True):
     """
     Send email notifications to all match players but the inviting_player in the given
     match to inform that the given guest has been removed from the match.
-    Convenience method that calls remove_guest_message and returns the number of
+    Convenience method that uses remove_guest_template and returns the number of
     emails sent.
+    The change is recorded for a digest instead if MAILER_DIGEST_WINDOW is set.
+    """
+    if settings.MAILER_DIGEST_WINDOW:
+        return record_roster_event(guest.match, RosterEvent.GUEST_REMOVED, guest.inviting_player, guest.name)
+    timer = BatchTimer('guest')
+    with timer.phase('query'):
+        template = remove_guest_template(guest)
+    return send_roster_mails(template, guest.inviting_player, async, timer)
+
+
+def send_roster_mails(template, excluded_player, async, timer):
+    """
+    Send messages from the given template to all players in its match but the
+    excluded_player, finishing the given BatchTimer.
+    Returns the number of emails sent.
+    """
+    with timer.phase('render'):
+        messages = [template.message(player) for player in template.match.players if player != excluded_player]
+    send_mails(messages, async, timer)
+    timer.finish()
+    return len(messages)
+
+
+def record_roster_event(match, kind, player, guest_name=''):
+    """
+    Records a roster change to be notified in the next digest for the match.
+    Returns the number of emails sent, which is always 0.
+    """
+    RosterEvent.objects.create(match=match, kind=kind, player=player, guest_name=guest_name)
+    return 0
+
+
+def summarize_roster_events(events):
+    """
+    Net roster changes for the given events, as a dictionary with the names of
+    the players that joined and left, and the guests added and removed as
+    (guest name, inviting player name) tuples, in order of appearance.
+    Changes that cancel each other out, like joining and then leaving, are
+    left out.
+    """
+    net = OrderedDict()
+    for event in events:
+        if event.kind in (RosterEvent.JOINED, RosterEvent.LEFT):
+            key = (True, event.player.name)
+        else:
+            key = (False, (event.guest_name, event.player.name))
+        delta = 1 if event.kind in (RosterEvent.JOINED, RosterEvent.GUEST_ADDED) else -1
+        net[key] = net.get(key, 0) + delta
+
+    summary = {'joined': [], 'left': [], 'guests_added': [], 'guests_removed': []}
+    for (is_player, name), delta in net.items():
+        if delta > 0:
+            summary['joined' if is_player else 'guests_added'].append(name)
+        elif delta < 0:
+            summary['left' if is_player else 'guests_removed'].append(name)
+    return summary
+
+
+def roster_digest_template(match, events):
+    """
+    Message template summarizing the given roster events for the match, or
+    None if the events cancel each other out.
     """
-    messages = []
-    for player in guest.match.players.all():
-        if player != guest.inviting_player:
-            messages.append(remove_guest_message(guest, player))
-    send_mails(messages, async)
+    summary = summarize_roster_events(events)
+    if not any(summary.values()):
+        return None
+    return MessageTemplate('roster_digest_email', match, summary)
+
+
+def send_roster_digest_mails(now=None, async=True):
+    """
+    Send a digest of the recorded roster changes of every match whose oldest
+    pending change is older than MAILER_DIGEST_WINDOW seconds, to all players
+    in the match. Players are not told about their own changes, and don't get
+    a digest if there is nothing else to tell.
+    If async is true digests are queued when MAILER_QUEUE is set, they are
+    sent synchronously otherwise, as events are only deleted once their
+    digest is sent (see send_roster_digest).
+    Returns the number of emails sent.
+    """
+    now = now or datetime.now()
+    due = now - timedelta(seconds=settings.MAILER_DIGEST_WINDOW)
+    match_ids = RosterEvent.objects.filter(date__lte=due).values_list('match', flat=True).distinct()
+    sent = 0
+    for match_id in match_ids:
+        timer = BatchTimer('digest')
+        try:
+            sent += send_roster_digest(match_id, async, timer)
+        except Exception as e:
+            LOGGER.exception('Failed to send roster digest of match %i, will retry: %r' % (match_id, e))
+        finally:
+            timer.finish()
+    return sent
+
+
+def send_roster_digest(match_id, async, timer):
+    """
+    Sends the digest of the recorded roster changes of the given match, and
+    deletes them once sent. Events are locked until then, and kept for the
+    next digest if sending fails. Digests are only queued if async is true and
+    MAILER_QUEUE is set, and committed along with the deletion of their
+    events, otherwise they are sent before the events are deleted, never in
+    the background.
+    Returns the number of emails sent.
+    """
+    with transaction.atomic():
+        with timer.phase('query'):
+            events = list(RosterEvent.objects.select_for_update().filter(
+                match=match_id).select_related('match', 'player').order_by('date', 'id'))
+        if len(events) == 0:
+            return 0
+        with timer.phase('query'):
+            match = MatchSnapshot.of(events[0].match)
+        templates = {}
+        messages = []
+        with timer.phase('render'):
+            for player in match.players:
+                # one template per distinct set of events, as players skip their own
+                others = tuple(event for event in events if event.player_id != player.id)
+                if others not in templates:
+                    templates[others] = roster_digest_template(match, others)
+                if templates[others] != None:
+                    messages.append(templates[others].message(player))
+        send_mails(messages, async == True and settings.MAILER_QUEUE, timer)
+        with timer.phase('query'):
+            RosterEvent.objects.filter(id__in=[event.id for event in events]).delete()
     return len(messages)
 
 
+def status_template(match):
+    """
+    Message template with the status of the given match.
+    """
+    return MessageTemplate('status_email', match, {})
+
+
 def status_message(match, player):
     """
     Creates and returns an email message for the given player with the status
     of the given match.
     Contains plain text and HTML versions in the body, and a link to the match.
     """
-    context = Context({
-        'player': player,
-        'match': match,
-        'match_url': absolute_url(match_url(match, player)),
-    })
-
-    text = get_template('core/status_email.txt').render(context)
-    html = get_template('core/status_email.html').render(context)
+    return status_template(match).message(player)
 
-    address = email_address(player)
-    msg = EmailMultiAlternatives('Fobal', text, 'Fobal <noreply@fobal.com>', [address])
-    msg.attach_alternative(html, "text/html")
-    return msg
 
-
-def send_status_mails(match, players, async=True):
+def send_status_mails(match, players, async=True, ledger=None):
     """
     Send email notifications to all match players with the status of the match.
-    Convenience method that calls status_mail and returns the number of
-    emails sent.
+    Convenience method that sends status messages (see status_template) in
+    chunks of MAILER_CHUNK_SIZE, or broadcasts it if MAILER_BROADCAST is set
+    (see send_template_chunks), and returns the number of emails sent.
+    Sent emails are recorded in the given SendLedger, if any.
     """
-    messages = []
-    for player in players:
-        messages.append(status_message(match, player))
-    send_mails(messages, async)
-    return len(messages)
+    return send_template_chunks(BatchTimer('status'), 'status_email', match, players, async, ledger)
@@ -0,0 +1,376 @@
+"""
+Management command for benchmarking the mailer.
+"""
+
+import math
+import time
+import smtplib
+import resource
+import threading
+import tracemalloc
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+from django.test.utils import override_settings
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import get_template
+from django.template import Context
+from core.models import Match, Player, MatchPlayer, WeeklyMatchSchedule, SentEmail
+from core.urlhelper import absolute_url, join_match_url, leave_match_url, match_url
+from core.smtpsink import SMTPSink
+from core import mailer, tasks
+
+
+BENCHMARK_MONDAY = datetime(2099, 1, 5, 7, 0)
+"""
+Monday far enough in the future not to meet real matches, when invites are sent.
+"""
+
+
+def legacy_invite_message(match, player):
+    """
+    Invite message built the way the mailer did before message templates:
+    both templates are looked up and fully rendered for every player.
+    """
+    context = Context({
+        'player': player,
+        'match': match,
+        'match_url': absolute_url(match_url(match, player)),
+        'join_match_url': absolute_url(join_match_url(match, player)),
+        'leave_match_url': absolute_url(leave_match_url(match, player)),
+    })
+
+    text = get_template('core/match_invite_email.txt').render(context)
+    html = get_template('core/match_invite_email.html').render(context)
+
+    msg = EmailMultiAlternatives(mailer.SUBJECT, text, mailer.FROM_EMAIL, [mailer.email_address(player)])
+    msg.attach_alternative(html, "text/html")
+    return msg
+
+
+def fake_match():
+    """
+    Unsaved match for benchmarks that don't need the database.
+    """
+    return Match(id=1, date=datetime.now() + timedelta(days=2), place='Benchmark')
+
+
+def fake_players(count):
+    """
+    Unsaved players for benchmarks that don't need the database.
+    """
+    return [Player(id=i, name='Player %i' % i, email='player%i@fobal.com' % i) for i in range(1, count + 1)]
+
+
+def seed_players(count):
+    """
+    Create count players in the database, without users.
+    """
+    for start in range(0, count, 1000):
+        Player.objects.bulk_create([
+            Player(name='Benchmark Player %i' % i, email='benchmark%i@fobal.com' % i)
+            for i in range(start, min(count, start + 1000))], batch_size=500)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of the given values, fraction between 0 and 1.
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+@contextmanager
+def rolled_back():
+    """
+    Context manager for seeding benchmark data, rolling back the transaction
+    when done so the database is left untouched.
+    """
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the mailer. Scenarios: render (per-batch render time of invite emails), '
+        'memory (peak memory of a status batch), workers (messages rendered per second by number of '
+        'render processes), smtp (throughput and batch latency of the invite, status, join and leave '
+        'paths against a local SMTP sink), backends (concurrent batches sent by the threaded and asyncio '
+        'email backends to a local SMTP sink). Data is seeded in a transaction that is rolled back.')
+
+    DEFAULT_PLAYERS = {
+        'render': [2000],
+        'memory': [10000, 100000],
+        'workers': [20000],
+        'smtp': [1000],
+        'backends': [100],
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(Command.DEFAULT_PLAYERS.keys()))
+        parser.add_argument('--players', type=int, nargs='+',
+            help='Number of players (recipients) per batch, several values run the scenario for each one.')
+        parser.add_argument('--repeat', type=int, default=3,
+            help='Number of runs, the best one is reported.')
+        parser.add_argument('--processes', type=int, nargs='+',
+            help='Render process counts for the workers scenario, 0 renders in-process. '
+                 'Defaults to 0, 1, 2, 4... up to the number of CPUs.')
+        parser.add_argument('--latency', type=float, default=0,
+            help='Milliseconds the SMTP sink waits before accepting each message.')
+        parser.add_argument('--error-rate', type=float, default=0,
+            help='Fraction of messages rejected by the SMTP sink with a 451 error.')
+        parser.add_argument('--max-connections', type=int, default=0,
+            help='Concurrent sessions accepted by the SMTP sink, 0 is unlimited.')
+        parser.add_argument('--pool-size', type=int,
+            help='Mailer connection pool size for the smtp and backends scenarios (and asyncio backend '
+                 'sessions for the latter), defaults to MAILER_POOL_SIZE.')
+        parser.add_argument('--batches', type=int, default=20,
+            help='Number of batches sent at the same time in the backends scenario.')
+        parser.add_argument('--broadcast', action='store_true', default=False,
+            help='Send invite and status emails in BCC chunks (MAILER_BROADCAST) in the smtp scenario.')
+        parser.add_argument('--joins', type=int, default=20,
+            help='Number of players joining and then leaving the match in the smtp scenario.')
+
+    def handle(self, *args, **options):
+        if options['players'] == None:
+            options['players'] = Command.DEFAULT_PLAYERS[options['scenario']]
+        getattr(self, options['scenario'])(options)
+
+    def best_time(self, repeat, function):
+        """
+        Best wall clock time in seconds out of `repeat` calls to function.
+        """
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def report(self, label, seconds, messages):
+        self.stdout.write('%-10s %10.1f ms/batch %10.0f msg/s' % (label, seconds * 1000, messages / seconds))
+
+    def render(self, options):
+        """
+        Compare rendering an invite batch per message (legacy) against rendering
+        it once with mailer.MessageTemplate.
+        """
+        match = fake_match()
+        players = fake_players(options['players'][0])
+
+        def legacy():
+            return [legacy_invite_message(match, player) for player in players]
+
+        def templated():
+            template = mailer.invite_template(match)
+            return [template.message(player) for player in players]
+
+        self.stdout.write('Rendering %i invite emails per batch' % len(players))
+        legacy_time = self.best_time(options['repeat'], legacy)
+        templated_time = self.best_time(options['repeat'], templated)
+        self.report('legacy', legacy_time, len(players))
+        self.report('template', templated_time, len(players))
+        self.stdout.write('Speedup: %.1fx' % (legacy_time / templated_time))
+
+    def peak_memory(self, function):
+        """
+        Peak memory in bytes allocated by Python while calling function.
+        """
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def memory(self, options):
+        """
+        Compare peak memory of sending a status batch to all players by building
+        the whole list of messages first (legacy) against sending it in chunks.
+        Messages go to the dummy email backend.
+        """
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend'):
+            for count in options['players']:
+                with rolled_back():
+                    seed_players(count)
+                    match = Match.objects.create(date=datetime.now() + timedelta(days=2), place='Benchmark')
+
+                    def legacy():
+                        template = mailer.status_template(match)
+                        mailer.send_mails([template.message(player) for player in Player.objects.all()], async=False)
+
+                    def chunked():
+                        mailer.send_status_mails(match, Player.objects.all(), async=False)
+
+                    self.stdout.write('Status emails for %i players' % count)
+                    self.stdout.write('%-10s %10.1f MB peak' % ('legacy', self.peak_memory(legacy) / 2.0 ** 20))
+                    self.stdout.write('%-10s %10.1f MB peak' % ('chunked', self.peak_memory(chunked) / 2.0 ** 20))
+
+    def workers(self, options):
+        """
+        Messages rendered per second for an invite batch by number of render
+        processes (MAILER_RENDER_PROCESSES).
+        """
+        processes = options['processes']
+        if processes == None:
+            processes = [0, 1]
+            while processes[-1] * 2 <= multiprocessing.cpu_count():
+                processes.append(processes[-1] * 2)
+        match = fake_match()
+        players = fake_players(options['players'][0])
+
+        self.stdout.write('Rendering %i invite emails, %i CPUs' % (len(players), multiprocessing.cpu_count()))
+        for count in processes:
+            with override_settings(MAILER_RENDER_PROCESSES=count):
+                def render():
+                    for messages in mailer.message_chunks(mailer.invite_template(match), players):
+                        pass
+                self.report('%i procs' % count, self.best_time(options['repeat'], render), len(players))
+
+    def smtp(self, options):
+        """
+        Mail throughput against a local SMTP sink: an invite batch and `repeat`
+        status batches from tasks.create_match_or_send_status, then join and
+        leave notifications for --joins players. Every batch is sent synchronously.
+        Reports SMTP messages per second, p50/p99 batch latency and failed
+        batches per path, and the peak RSS of the process.
+        """
+        sink = SMTPSink(
+            latency=options['latency'] / 1000.0,
+            error_rate=options['error_rate'],
+            max_connections=options['max_connections'],
+            seed=0).start()
+        pool = mailer.ConnectionPool(
+            options['pool_size'] or settings.MAILER_POOL_SIZE,
+            settings.MAILER_CONNECTION_MAX_IDLE,
+            **sink.connection_kwargs())
+        previous_pool = mailer.use_connection_pool(pool)
+        try:
+            with override_settings(MAILER_QUEUE=False, MAILER_DIGEST_WINDOW=0, MAILER_BROADCAST=options['broadcast']):
+                for count in options['players']:
+                    with rolled_back():
+                        seed_players(count)
+                        self.smtp_paths(sink, count, options)
+        finally:
+            mailer.use_connection_pool(previous_pool)
+            pool.close()
+            sink.stop()
+        self.stdout.write('SMTP sink: %i connections, %i refused, %i messages rejected' % (
+            sink.connections, sink.refused, sink.errors))
+        self.stdout.write('Peak RSS: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    def smtp_paths(self, sink, count, options):
+        results = OrderedDict((path, {'latencies': [], 'emails': 0, 'failed': 0})
+            for path in ('invite', 'status', 'join', 'leave'))
+
+        def timed(path, function):
+            result = results[path]
+            before = sink.messages
+            start = time.perf_counter()
+            try:
+                function()
+            except (smtplib.SMTPException, OSError):
+                result['failed'] += 1
+            result['latencies'].append(time.perf_counter() - start)
+            result['emails'] += sink.messages - before
+
+        WeeklyMatchSchedule.objects.all().delete()
+        WeeklyMatchSchedule.objects.create(
+            weekday=2, time=BENCHMARK_MONDAY.time(), place='Benchmark', invite_weekday=BENCHMARK_MONDAY.weekday())
+        timed('invite', lambda: tasks.create_match_or_send_status(BENCHMARK_MONDAY, False))
+        for i in range(options['repeat']):
+            # as if it was another day, so status emails are not skipped as already sent
+            SentEmail.objects.all().delete()
+            timed('status', lambda: tasks.create_match_or_send_status(BENCHMARK_MONDAY, False))
+
+        match = Match.next_match(BENCHMARK_MONDAY)
+        players = list(Player.objects.order_by('pk')[:options['joins']])
+        for player in players:
+            MatchPlayer.objects.create(match=match, player=player)
+            timed('join', lambda: mailer.send_join_mails(match, player, False))
+        for player in players:
+            MatchPlayer.objects.filter(match=match, player=player).delete()
+            timed('leave', lambda: mailer.send_leave_mails(match, player, False))
+
+        self.stdout.write('SMTP batches for %i players' % count)
+        for path, result in results.items():
+            latencies = result['latencies']
+            if len(latencies) == 0:
+                continue
+            self.stdout.write('%-8s %5i batches %8i emails %10.0f emails/s   p50 %9.1f ms   p99 %9.1f ms %5i failed' % (
+                path,
+                len(latencies),
+                result['emails'],
+                result['emails'] / sum(latencies),
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                result['failed']))
+
+    def backends(self, options):
+        """
+        Compare the threaded backend (an EmailThread per batch over the pooled
+        SMTP connections) with the asyncio backend (core.asyncsmtp), sending
+        --batches invite batches at once to a local SMTP sink, over the same
+        number of SMTP sessions.
+        Reports the time until all emails are received, emails per second and
+        the peak number of threads.
+        """
+        sink = SMTPSink(
+            latency=options['latency'] / 1000.0,
+            error_rate=options['error_rate'],
+            max_connections=options['max_connections'],
+            seed=0).start()
+        sessions = options['pool_size'] or settings.MAILER_POOL_SIZE
+        template = mailer.invite_template(fake_match())
+        try:
+            for count in options['players']:
+                players = fake_players(count)
+                batches = [[template.message(player) for player in players] for i in range(options['batches'])]
+                self.stdout.write('%i batches of %i emails, %i SMTP sessions' % (len(batches), count, sessions))
+
+                pool = mailer.ConnectionPool(sessions, settings.MAILER_CONNECTION_MAX_IDLE, **sink.connection_kwargs())
+                previous_pool = mailer.use_connection_pool(pool)
+                try:
+                    with override_settings(MAILER_QUEUE=False, EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend'):
+                        self.send_concurrently('threaded', sink, batches)
+                finally:
+                    mailer.use_connection_pool(previous_pool)
+                    pool.close()
+
+                with override_settings(
+                        MAILER_QUEUE=False, EMAIL_BACKEND='core.asyncsmtp.EmailBackend',
+                        EMAIL_HOST=sink.host, EMAIL_PORT=sink.port, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+                        EMAIL_USE_TLS=False, EMAIL_USE_SSL=False, MAILER_ASYNC_CONCURRENCY=sessions):
+                    self.send_concurrently('asyncio', sink, batches)
+        finally:
+            sink.stop()
+
+    def send_concurrently(self, label, sink, batches):
+        """
+        Sends all batches asynchronously with mailer.send_mails and waits until
+        the sink has received (or rejected) every message, or made no progress
+        for 5 seconds.
+        """
+        expected = sum(len(messages) for messages in batches)
+        received = lambda: sink.messages + sink.errors
+        target = received() + expected
+        start = time.perf_counter()
+        for messages in batches:
+            mailer.send_mails(messages)
+        peak_threads = threading.active_count()
+        last, last_progress = received(), time.perf_counter()
+        while last < target and time.perf_counter() - last_progress < 5:
+            time.sleep(0.001)
+            peak_threads = max(peak_threads, threading.active_count())
+            if received() != last:
+                last, last_progress = received(), time.perf_counter()
+        elapsed = time.perf_counter() - start
+        done = expected - (target - last)
+        self.stdout.write('%-10s %10.1f ms %10.0f emails/s %5i peak threads%s' % (
+            label, elapsed * 1000, done / elapsed, peak_threads,
+            '' if done == expected else '   (%i emails lost)' % (expected - done)))
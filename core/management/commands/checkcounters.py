@@ -0,0 +1,54 @@
+"""
+Management command for checking the roster counters of matches.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from core.models import Match
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the players_count, guests_count and waiting_count of every match with its actual roster, '
+        'and fixes the ones that drifted with --repair.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', default=False,
+            help='Fix the counters that drifted.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+            help='Number of matches checked per query.')
+
+    def handle(self, *args, **options):
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                ids = list(Match.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', flat=True)[:options['chunk_size']])
+                if len(ids) == 0:
+                    break
+                if options['repair']:
+                    # joins and leaves wait for the chunk to be repaired
+                    list(Match.objects.select_for_update().filter(id__in=ids).values_list('id'))
+                matches = Match.objects.filter(id__in=ids).annotate(
+                    actual_players=Count('matchplayer', distinct=True),
+                    actual_guests=Count('guests', distinct=True),
+                    actual_waiting=Count('waitlist', distinct=True))
+                for match in matches:
+                    counted = (match.players_count, match.guests_count, match.waiting_count)
+                    actual = (match.actual_players, match.actual_guests, match.actual_waiting)
+                    if counted == actual:
+                        continue
+                    drifted += 1
+                    self.stdout.write('Match %i (%s): %i players, %i guests and %i waiting, counted %i, %i and %i' % (
+                        (match.id, match) + actual + counted))
+                    if options['repair']:
+                        Match.objects.filter(id=match.id).update(
+                            players_count=match.actual_players, guests_count=match.actual_guests,
+                            waiting_count=match.actual_waiting)
+            checked += len(ids)
+            last_id = ids[-1]
+
+        self.stdout.write('%i of %i matches had wrong counters%s' % (
+            drifted, checked, ', repaired' if options['repair'] and drifted > 0 else ''))
@@ -0,0 +1,308 @@
+"""
+Management command for load testing the web tier.
+"""
+
+import time
+import queue
+import logging
+import random
+import threading
+import socketserver
+import http.cookiejar
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urljoin
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.core.urlresolvers import reverse
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from core.models import Match, Player, MatchPlayer, WaitingPlayer, SiteStatistics
+from core.urlhelper import match_url, join_match_url
+from core.management.commands.benchmark import percentile
+
+
+STEPS = ('open', 'match', 'join', 'add_guest')
+"""
+Endpoints of the invite-day pattern: the email link to the match (with the
+player_id), the match page it redirects to, joining and adding a guest.
+"""
+
+SEED_EMAIL = 'loadtest%i@fobal.com'
+
+
+class QueryCountingApplication(object):
+    """
+    WSGI application counting the queries of every request, returned in the
+    X-Query-Count header.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        connection.force_debug_cursor = True
+        connection.queries_log.clear()
+
+        def counting_start_response(status, headers, exc_info=None):
+            headers.append(('X-Query-Count', str(len(connection.queries_log))))
+            return start_response(status, headers, exc_info)
+
+        return self.application(environ, counting_start_response)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Request handler that doesn't log every request.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """
+    WSGI server handling every connection in its own thread, like runserver,
+    with a listen backlog large enough for all the clients connecting at once.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Handler returning redirects instead of following them, so each hop is timed
+    on its own.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Results(object):
+    """
+    Status, latency and query count of every request by step, thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = OrderedDict((step, []) for step in STEPS)
+        self.queries = OrderedDict((step, []) for step in STEPS)
+        self.errors = OrderedDict((step, 0) for step in STEPS)
+
+    def add(self, step, seconds, status, queries):
+        """
+        Records a request, status is None if it couldn't be sent and queries is
+        None if the server doesn't count them.
+        """
+        with self.lock:
+            self.latencies[step].append(seconds)
+            if queries != None:
+                self.queries[step].append(queries)
+            if status == None or status >= 400:
+                self.errors[step] += 1
+
+
+class Client(object):
+    """
+    Browser of a single player, with its own cookies.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, base_url, results, timeout):
+        self.base_url = base_url
+        self.results = results
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), NoRedirectHandler)
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        return ''
+
+    def request(self, step, path, data=None):
+        """
+        Requests path (POSTing data if given) and records it as step.
+        Returns the redirect location, or None.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.opener.open(urljoin(self.base_url, path),
+                urlencode(data).encode('utf-8') if data != None else None, self.timeout)
+        except urllib.error.HTTPError as e:
+            response = e
+        except OSError:
+            self.results.add(step, time.perf_counter() - start, None, None)
+            return None
+        try:
+            response.read()
+        finally:
+            response.close()
+        queries = response.headers.get('X-Query-Count', None)
+        self.results.add(step, time.perf_counter() - start, response.code,
+            int(queries) if queries != None else None)
+        return response.headers.get('Location', None) if response.code in (301, 302, 303) else None
+
+    def visit(self, step, path, data=None):
+        """
+        Requests path and follows its redirects, which are recorded as open if
+        they identify the player or as match otherwise.
+        """
+        location = self.request(step, path, data)
+        for i in range(Client.MAX_REDIRECTS):
+            if location == None:
+                break
+            location = self.request('open' if 'player_id=' in location else 'match', location)
+
+
+class Command(BaseCommand):
+    help = (
+        'Load tests the web tier the way players use it right after the invites are sent: every player '
+        'opens the match link from the email, follows the redirect to the match, joins (or waits for a seat '
+        'once the match is full), views the roster and some add a guest, from many concurrent clients. '
+        'Reports throughput, latency percentiles, '
+        'error rates and queries per request by endpoint. Players and the match are seeded in the database '
+        'and deleted when done. Runs against a local threaded server unless --url is given (which must use '
+        'the same database, and doesn\'t report queries). Emails are not sent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=200,
+            help='Number of invited players, each one runs the invite-day pattern once.')
+        parser.add_argument('--clients', type=int, default=50,
+            help='Number of concurrent clients.')
+        parser.add_argument('--capacity', type=int,
+            help='Capacity of the match, players joining once it is full wait for a seat. '
+                 'Defaults to MATCH_SIZE.')
+        parser.add_argument('--guest-rate', type=float, default=0.2,
+            help='Fraction of players adding a guest after joining.')
+        parser.add_argument('--timeout', type=float, default=30,
+            help='Seconds to wait for each response.')
+        parser.add_argument('--url',
+            help='Base URL of an already running server instead of a local one.')
+        parser.add_argument('--keep', action='store_true', default=False,
+            help='Keep the seeded players and match.')
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            # every join and guest is logged
+            logging.disable(logging.INFO)
+        # fake players must not get emails, nor fill the outbound queue
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+                MAILER_QUEUE=False, ALLOWED_HOSTS=['127.0.0.1', 'localhost']):
+            match, players = self.seed(options['players'], options['capacity'] or settings.MATCH_SIZE)
+            try:
+                self.run(match, players, options)
+            finally:
+                if not options['keep']:
+                    self.clean_up(match)
+                logging.disable(logging.NOTSET)
+
+    def seeded_players(self):
+        return Player.objects.filter(email__startswith='loadtest', email__endswith='@fobal.com')
+
+    def seed(self, count, capacity):
+        """
+        Creates count players and a match tomorrow with the given capacity,
+        returns both.
+        """
+        Player.objects.bulk_create([
+            Player(name='Load Test Player %i' % i, email=SEED_EMAIL % i) for i in range(count)], batch_size=500)
+        players = list(self.seeded_players().order_by('id'))
+        match = Match.objects.create(date=datetime.now() + timedelta(days=1), place='Load test', capacity=capacity)
+        return match, players
+
+    def clean_up(self, match):
+        """
+        Deletes the seeded players and match, players were bulk created so the
+        statistics are rebuilt.
+        """
+        match.delete()
+        self.seeded_players().delete()
+        SiteStatistics.rebuild()
+
+    def start_server(self):
+        """
+        Starts a local server on a free port, returns it and its base URL.
+        """
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        server.set_app(QueryCountingApplication(get_internal_wsgi_application()))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, 'http://127.0.0.1:%i' % server.server_port
+
+    def run(self, match, players, options):
+        server = None
+        base_url = options['url']
+        if base_url == None:
+            server, base_url = self.start_server()
+
+        rng = random.Random(0)
+        pending = queue.Queue()
+        for player in players:
+            pending.put((player, rng.random() < options['guest_rate']))
+        results = Results()
+        start_line = threading.Barrier(options['clients'] + 1)
+
+        def client():
+            start_line.wait()
+            while True:
+                try:
+                    player, guest = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self.invite_day(Client(base_url, results, options['timeout']), match, player, guest)
+
+        threads = [threading.Thread(target=client) for i in range(options['clients'])]
+        for thread in threads:
+            thread.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        if server != None:
+            server.shutdown()
+            server.server_close()
+        self.report(results, seconds, options)
+        joined = MatchPlayer.objects.filter(match=match).count()
+        guests = match.guests.count()
+        self.stdout.write('%i of %i players joined, %i waiting, %i guests, capacity %i%s' % (
+            joined, len(players), WaitingPlayer.objects.filter(match=match).count(), guests, match.capacity,
+            ', OVERBOOKED' if joined + guests > match.capacity else ''))
+
+    def invite_day(self, client, match, player, guest):
+        """
+        Replays a player clicking the invite email link, joining the match and
+        maybe adding a guest.
+        """
+        client.visit('open', match_url(match, player))
+        client.visit('join', join_match_url(match, player))
+        if guest:
+            client.visit('add_guest', reverse('add_guest', args=[match.id]), {
+                'guest': 'Guest of %s' % player.name,
+                'inviting_player': player.id,
+                'csrfmiddlewaretoken': client.csrf_token(),
+            })
+
+    def report(self, results, seconds, options):
+        self.stdout.write('%i players, %i clients, %.2f s' % (options['players'], options['clients'], seconds))
+        self.stdout.write('%-10s %8s %8s %7s %8s %8s %8s %8s %9s' % (
+            'endpoint', 'requests', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries'))
+        rows = [(step, results.latencies[step], results.errors[step], results.queries[step]) for step in STEPS]
+        rows.append(('total', sum(results.latencies.values(), []), sum(results.errors.values()),
+                     sum(results.queries.values(), [])))
+        for step, latencies, errors, queries in rows:
+            if len(latencies) == 0:
+                continue
+            self.stdout.write('%-10s %8i %8.1f %6.1f%% %8.1f %8.1f %8.1f %8.1f %9s' % (
+                step, len(latencies), len(latencies) / seconds, 100.0 * errors / len(latencies),
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+                percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+                '%.1f' % (sum(queries) / len(queries)) if len(queries) > 0 else '-'))
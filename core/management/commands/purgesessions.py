@@ -0,0 +1,40 @@
+"""
+Management command for purging expired sessions.
+"""
+
+import time
+import logging
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from django.contrib.sessions.models import Session
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes expired sessions from the database in chunks, so the session table stays small '
+        'without locking it for long.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Number of sessions deleted per query.')
+        parser.add_argument('--sleep', type=float, default=0,
+            help='Seconds to wait between chunks.')
+
+    def handle(self, *args, **options):
+        now = datetime.now()
+        purged = 0
+        while True:
+            keys = list(Session.objects.filter(expire_date__lt=now)
+                .values_list('session_key', flat=True)[:options['chunk_size']])
+            if len(keys) == 0:
+                break
+            Session.objects.filter(session_key__in=keys).delete()
+            purged += len(keys)
+            if options['sleep'] > 0:
+                time.sleep(options['sleep'])
+
+        LOGGER.info('Purged %i expired sessions' % purged)
+        self.stdout.write('Purged %i expired sessions' % purged)
@@ -0,0 +1,25 @@
+"""
+Management command for rebuilding the site statistics.
+"""
+
+import logging
+from django.core.management.base import BaseCommand
+from core.models import SiteStatistics
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the site statistics shown in the index page from existing data, '
+        'which are kept up to date incrementally afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Number of players aggregated per query.')
+
+    def handle(self, *args, **options):
+        stats = SiteStatistics.rebuild(options['chunk_size'])
+        LOGGER.info('Rebuilt site statistics: %s, top player %s with %i matches' % (
+            stats, stats.top_player, stats.top_player_matches))
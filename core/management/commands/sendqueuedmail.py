@@ -0,0 +1,50 @@
+"""
+Management command for draining the outbound email queue.
+"""
+
+import time
+import logging
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from datetime import datetime
+from core import mailer, tasks
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends queued outbound emails in batches, retrying failed ones with exponential backoff, '
+        'roster digests when MAILER_DIGEST_WINDOW is set, and due invite waves when '
+        'MAILER_INVITE_WAVE_SIZE is set. Exits right away when none of them is enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Max number of emails sent per batch.')
+        parser.add_argument('--sleep', type=float, default=5,
+            help='Seconds to wait before polling again when the queue is empty.')
+        parser.add_argument('--once', action='store_true', default=False,
+            help='Send a single batch and exit instead of polling forever.')
+
+    def handle(self, *args, **options):
+        if not (settings.MAILER_QUEUE or settings.MAILER_DIGEST_WINDOW or settings.MAILER_INVITE_WAVE_SIZE):
+            # nothing will ever be queued, don't keep a worker polling
+            self.stdout.write(
+                'Nothing to send: MAILER_QUEUE, MAILER_DIGEST_WINDOW and MAILER_INVITE_WAVE_SIZE are not set')
+            return
+        while True:
+            if settings.MAILER_DIGEST_WINDOW:
+                digests = mailer.send_roster_digest_mails()
+                if digests > 0:
+                    LOGGER.info('Sent %i roster digest emails' % digests)
+            if settings.MAILER_INVITE_WAVE_SIZE:
+                tasks.send_invite_waves(datetime.now(), async=True)
+            sent, failed = mailer.send_queued_mails(options['batch_size'])
+            if sent > 0 or failed > 0:
+                LOGGER.info('Sent %i queued emails, %i failed' % (sent, failed))
+            if options['once']:
+                break
+            if sent + failed < options['batch_size']:
+                # queue drained, wait for new emails
+                time.sleep(options['sleep'])
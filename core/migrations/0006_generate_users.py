@@ -2,13 +2,6 @@
 from __future__ import unicode_literals
 
 from django.db import models, migrations
-from core.models import Player
-
-
-def generate_users(apps, schema_editor):
-    for player in Player.objects.all():
-        player.user = player.create_user()
-        player.save()
 
 
 class Migration(migrations.Migration):
@@ -17,6 +10,7 @@ class Migration(migrations.Migration):
         ('core', '0005_auto_20150722_2325'),
     ]
 
+    # users are generated in 0019_generate_users, with the historical models
     operations = [
-        migrations.RunPython(generate_users),
+        migrations.RunPython(migrations.RunPython.noop, migrations.RunPython.noop),
     ]
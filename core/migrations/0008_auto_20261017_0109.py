@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_merge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('subject', models.CharField(max_length=200)),
+                ('from_email', models.CharField(max_length=200)),
+                ('to', models.TextField()),
+                ('body', models.TextField()),
+                ('html', models.TextField(blank=True)),
+                ('status', models.CharField(max_length=10, default='pending', choices=[('pending', 'Pending'), ('sent', 'Sent'), ('dead', 'Dead')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent_date', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outboundemail',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+    ]
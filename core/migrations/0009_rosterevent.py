@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_auto_20261017_0109'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RosterEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('kind', models.CharField(max_length=20, choices=[('joined', 'Joined'), ('left', 'Left'), ('guest_added', 'Guest added'), ('guest_removed', 'Guest removed')])),
+                ('guest_name', models.CharField(max_length=50, blank=True)),
+                ('date', models.DateTimeField(db_index=True, auto_now_add=True)),
+                ('match', models.ForeignKey(related_name='roster_events', to='core.Match')),
+                ('player', models.ForeignKey(to='core.Player')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_rosterevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('kind', models.CharField(max_length=20, choices=[('invite', 'Invite'), ('status', 'Status')])),
+                ('day', models.DateField()),
+                ('match', models.ForeignKey(related_name='sent_emails', to='core.Match')),
+                ('player', models.ForeignKey(to='core.Player')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sentemail',
+            unique_together=set([('match', 'kind', 'day', 'player')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_sentemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='next_invite_wave',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_match_next_invite_wave'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteStatistics',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('match_count', models.IntegerField(default=0)),
+                ('player_count', models.IntegerField(default=0)),
+                ('top_player_matches', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('next_match', models.ForeignKey(blank=True, null=True, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='core.Match')),
+                ('top_player', models.ForeignKey(blank=True, null=True, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='core.Player')),
+            ],
+            options={
+                'verbose_name_plural': 'site statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def count_matches(apps, schema_editor):
+    Player = apps.get_model('core', 'Player')
+    MatchPlayer = apps.get_model('core', 'MatchPlayer')
+    counts = MatchPlayer.objects.values('player').annotate(count=models.Count('id'))
+    for row in counts.iterator():
+        Player.objects.filter(id=row['player']).update(match_count=row['count'], played=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_sitestatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='left',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='match_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='played',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def count_players(apps, schema_editor):
+    Match = apps.get_model('core', 'Match')
+    for match in Match.objects.annotate(
+            actual_players=models.Count('matchplayer', distinct=True),
+            actual_guests=models.Count('guests', distinct=True)).iterator():
+        Match.objects.filter(id=match.id).update(
+            players_count=match.actual_players, guests_count=match.actual_guests)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_player_match_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='guests_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='players_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_players, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_match_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='modified',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import core.models
+import django.core.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_match_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitingPlayer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('waiting_date', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='capacity',
+            field=models.IntegerField(default=core.models.default_capacity, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='waiting_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='waitingplayer',
+            name='match',
+            field=models.ForeignKey(related_name='waitlist', to='core.Match'),
+        ),
+        migrations.AddField(
+            model_name='waitingplayer',
+            name='player',
+            field=models.ForeignKey(to='core.Player'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='waitingplayer',
+            unique_together=set([('match', 'player')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_match_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundemail',
+            name='bcc',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='outboundemail',
+            name='cc',
+            field=models.TextField(blank=True),
+        ),
+    ]
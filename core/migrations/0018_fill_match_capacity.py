@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fill_capacity(apps, schema_editor):
+    """
+    Matches created before 0016 got the default capacity, raise it to the
+    number of players and guests that had already joined so they don't end up
+    over capacity.
+    """
+    Match = apps.get_model('core', 'Match')
+    joined = models.F('players_count') + models.F('guests_count')
+    Match.objects.filter(capacity__lt=joined).update(capacity=joined)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_outboundemail_cc_bcc'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_capacity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.db import models, migrations
+
+
+def generate_users(apps, schema_editor):
+    """
+    Create an user for every player that doesn't have one, like
+    Player.create_user does, using only the historical models.
+    """
+    Player = apps.get_model('core', 'Player')
+    User = apps.get_model('auth', 'User')
+    for player in Player.objects.filter(user=None):
+        # try to use first part of the email as the username
+        username = player.email.partition('@')[0]
+        # randomize username if needed
+        if len(username) == 0 or len(username) > 30 or User.objects.filter(username=username).exists():
+            username = str(datetime.now().timestamp())
+        player.user = User.objects.create(username=username, password='!')
+        player.save(update_fields=['user'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        ('core', '0018_fill_match_capacity'),
+    ]
+
+    operations = [
+        migrations.RunPython(generate_users, migrations.RunPython.noop),
+    ]
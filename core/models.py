@@ -2,12 +2,38 @@
 Module for Django models.
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from core import datehelper
-from django.db import models
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
 from django.core.validators import validate_email, MinValueValidator, MaxValueValidator
-from django.db.models import Count, Q
+from django.db.models import Count, Q, F
 from django.contrib.auth.models import User
+from django.core.mail import EmailMultiAlternatives
+
+
+def delete_row(instance, using=None):
+    """
+    Deletes the row of the given instance with a single DELETE, and returns
+    whether it was still there. post_delete is only sent if it was, so the
+    counters kept by core.signals aren't decremented twice when the same row is
+    deleted twice, e.g. by simultaneous requests.
+    Only for models without other rows depending on them.
+    """
+    model = type(instance)
+    using = using or router.db_for_write(model, instance=instance)
+    connection = connections[using]
+    delete = 'DELETE FROM %s WHERE %s = %%s' % (
+        connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column))
+
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(delete, [instance.pk])
+            if cursor.rowcount == 0:
+                return False
+        post_delete.send(sender=model, instance=instance, using=using)
+    return True
 
 
 class Player(models.Model):
@@ -21,6 +47,24 @@ class Player(models.Model):
     email = models.CharField(max_length=50, unique=True, db_index=True, validators=[validate_email])
     matches = models.ManyToManyField('Match', through='MatchPlayer')
     user = models.ForeignKey(User, null=True, blank=True)
+    match_count = models.IntegerField(default=0, db_index=True)
+    """
+    Number of matches the player is in.
+    """
+    played = models.IntegerField(default=0)
+    """
+    Number of times the player joined a match.
+    """
+    left = models.IntegerField(default=0)
+    """
+    Number of times the player left a match before it was played.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Player, self).__init__(*args, **kwargs)
+        # name and email as loaded, read from __dict__ so deferred fields aren't loaded
+        self._saved_details = (self.__dict__.get('name'), self.__dict__.get('email'))
+        self.details_changed = False
 
     def __str__(self):
         """
@@ -33,7 +77,14 @@ class Player(models.Model):
         """
         Returns the player that has played the most matches.
         """
-        return Player.objects.annotate(match_count=Count('matches')).order_by('-match_count').first()
+        return Player.leaderboard().first()
+
+    @classmethod
+    def leaderboard(cls):
+        """
+        Returns all players ordered by match_count, most frequent players first.
+        """
+        return Player.objects.order_by('-match_count', 'id')
 
     def can_join(self, match):
         """
@@ -41,7 +92,7 @@ class Player(models.Model):
         A player can join a match if he has not joined already, and if the match
         has not been played already.
         """
-        return (not match.players.filter(id=self.id).exists()) and (match.date > datetime.now())
+        return (not match.has_player(self)) and (match.date > datetime.now())
 
     def can_leave(self, match):
         """
@@ -49,7 +100,7 @@ class Player(models.Model):
         A player can leave a match if he has joined and the match has not been
         played already.
         """
-        return (match.players.filter(id=self.id).exists()) and (match.date > datetime.now())
+        return match.has_player(self) and (match.date > datetime.now())
 
     def create_user(self):
         """
@@ -70,13 +121,26 @@ class Player(models.Model):
         if self.user == None:
             self.user = self.create_user()
             # TODO: send welcome email
+        # tell the post_save receivers whether the name or email changed
+        details = (self.__dict__.get('name'), self.__dict__.get('email'))
+        self.details_changed = not self._state.adding and any(
+            loaded != None and loaded != saved for loaded, saved in zip(details, self._saved_details))
         # save player
         super(Player, self).save(*args, **kwargs)
+        self._saved_details = (self.name, self.email)
+        self.details_changed = False
 
     def owner(self):
         return self.user
 
 
+def default_capacity():
+    """
+    Capacity of new matches, MATCH_SIZE.
+    """
+    return settings.MATCH_SIZE
+
+
 class Match(models.Model):
     """
     Model class representing a match.
@@ -87,10 +151,46 @@ class Match(models.Model):
     date = models.DateTimeField(unique=True, db_index=True)
     place = models.CharField(max_length=50)
     players = models.ManyToManyField('Player', through='MatchPlayer')
+    capacity = models.IntegerField(default=default_capacity, validators=[MinValueValidator(1)])
+    """
+    Number of players (including guests) that can play the match, more players
+    wait in the waitlist (see core.seats).
+    """
+    players_count = models.IntegerField(default=0)
+    guests_count = models.IntegerField(default=0)
+    waiting_count = models.IntegerField(default=0)
+    """
+    Number of players, guests and waiting players in the match, kept in sync by
+    core.signals and checked by the checkcounters command.
+    """
+    version = models.IntegerField(default=0)
+    modified = models.DateTimeField(default=datetime.now)
+    """
+    Version of the match and its roster, bumped with the modification date
+    whenever the match, its players or guests change. Used for conditional
+    requests.
+    """
+    COUNTER_FIELDS = ('players_count', 'guests_count', 'waiting_count', 'version')
+    next_invite_wave = models.DateTimeField(null=True, blank=True, db_index=True)
+    """
+    When the next wave of invites is due, None if there are no more waves.
+    Only used if MAILER_INVITE_WAVE_SIZE is set.
+    """
 
     def __str__(self):
         return str(self.date)
 
+    def save(self, *args, **kwargs):
+        """
+        Saving a match loaded from the database doesn't write the counters,
+        which might have changed since, unless they are in update_fields. The
+        version is bumped by core.signals.
+        """
+        if not self._state.adding and kwargs.get('update_fields') == None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in Match.COUNTER_FIELDS]
+        super(Match, self).save(*args, **kwargs)
+
     @classmethod
     def next_match(cls, date):
         """
@@ -98,11 +198,51 @@ class Match(models.Model):
         """
         return Match.objects.filter(date__gt=date).order_by('date').first()
 
+    @classmethod
+    def lock(cls, match_id):
+        """
+        Locks the match with the given id until the end of the current
+        transaction and returns it, with its current counters.
+        Databases without SELECT ... FOR UPDATE (sqlite) lock when the
+        transaction first writes, so the match is written instead.
+        """
+        matches = Match.objects.filter(id=match_id)
+        if connections[router.db_for_write(Match)].features.has_select_for_update:
+            return matches.select_for_update().get()
+        matches.update(capacity=F('capacity'))
+        return matches.get()
+
+    def has_player(self, player):
+        """
+        Check if the given player has joined the match.
+        """
+        return self.players.filter(id=player.id).exists()
+
+    def etag(self):
+        """
+        Entity tag of the match, changes with its version.
+        """
+        return 'match-%i-%i' % (self.id, self.version)
+
     def player_count(self):
         """
-        Returns the total number of players in the match, including guests.
+        Returns the total number of players in the match, including guests, as
+        of when the match was loaded.
+        """
+        return self.players_count + self.guests_count
+
+    def free_seats(self):
+        """
+        Returns the number of players (including guests) that can still join
+        the match, as of when the match was loaded.
         """
-        return self.players.count() + self.guests.count()
+        return max(0, self.capacity - self.player_count())
+
+    def is_full(self):
+        """
+        Whether capacity players (including guests) have joined the match.
+        """
+        return self.free_seats() == 0
 
 
 class MatchPlayer(models.Model):
@@ -122,6 +262,113 @@ class MatchPlayer(models.Model):
     def __str__(self):
         return '%s joined %s on %s' % (self.player, self.match, self.join_date)
 
+    @classmethod
+    def join(cls, match, player):
+        """
+        Adds the given player to the given match with a single INSERT that does
+        nothing if the player is in the match already, so simultaneous joins
+        don't fail. Returns whether the player joined.
+        post_save is sent as if the match player was saved, in the same
+        transaction.
+        """
+        using = router.db_for_write(MatchPlayer)
+        connection = connections[using]
+        join_date = datetime.now()
+        insert = 'INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+            connection.ops.quote_name(MatchPlayer._meta.db_table),
+            connection.ops.quote_name(MatchPlayer._meta.get_field('match').column),
+            connection.ops.quote_name(MatchPlayer._meta.get_field('player').column),
+            connection.ops.quote_name(MatchPlayer._meta.get_field('join_date').column))
+        params = [match.id, player.id, connection.ops.value_to_db_datetime(join_date)]
+
+        with transaction.atomic(using=using):
+            if connection.vendor in ('sqlite', 'mysql'):
+                with connection.cursor() as cursor:
+                    cursor.execute(('INSERT OR IGNORE ' if connection.vendor == 'sqlite' else 'INSERT IGNORE ') + insert, params)
+                    match_player_id = cursor.lastrowid if cursor.rowcount == 1 else None
+            elif connection.vendor == 'postgresql' and connection.pg_version >= 90500:
+                with connection.cursor() as cursor:
+                    cursor.execute('INSERT ' + insert + ' ON CONFLICT DO NOTHING RETURNING id', params)
+                    row = cursor.fetchone()
+                    match_player_id = row[0] if row != None else None
+            else:
+                try:
+                    with transaction.atomic(using=using):
+                        MatchPlayer.objects.create(match=match, player=player)
+                    return True
+                except IntegrityError:
+                    return False
+
+            if match_player_id == None:
+                return False
+            match_player = MatchPlayer(id=match_player_id, match=match, player=player, join_date=join_date)
+            post_save.send(sender=MatchPlayer, instance=match_player, created=True,
+                update_fields=None, raw=False, using=using)
+        return True
+
+    @classmethod
+    def leave(cls, match, player):
+        """
+        Removes the given player from the given match with a single DELETE.
+        Returns whether the player left, False if they weren't in the match.
+        post_delete is sent as if the match player was deleted, in the same
+        transaction. Leaving a match that hasn't been played counts as leaving
+        (see Player.left), deleting match players doesn't.
+        """
+        using = router.db_for_write(MatchPlayer)
+        connection = connections[using]
+        delete = 'DELETE FROM %s WHERE %s = %%s AND %s = %%s' % (
+            connection.ops.quote_name(MatchPlayer._meta.db_table),
+            connection.ops.quote_name(MatchPlayer._meta.get_field('match').column),
+            connection.ops.quote_name(MatchPlayer._meta.get_field('player').column))
+
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(delete, [match.id, player.id])
+                if cursor.rowcount == 0:
+                    return False
+            post_delete.send(sender=MatchPlayer, instance=MatchPlayer(match=match, player=player), using=using)
+            if match.date > datetime.now():
+                Player.objects.filter(id=player.id).update(left=F('left') + 1)
+        return True
+
+    def delete(self, using=None):
+        """
+        Deletes the match player, returns whether it was still there (see
+        delete_row).
+        """
+        return delete_row(self, using)
+
+    def owner(self):
+        return self.player.user
+
+
+class WaitingPlayer(models.Model):
+    """
+    Model class representing a player waiting for a seat in a full match.
+    Waiting players are given the seats that are freed in the order they
+    started waiting (see core.seats).
+    A player can wait for a match only once.
+    """
+
+    match = models.ForeignKey(Match, related_name='waitlist')
+    player = models.ForeignKey(Player)
+    waiting_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['match', 'player']
+        ordering = ['id']
+
+    def __str__(self):
+        return '%s waiting for %s since %s' % (self.player, self.match, self.waiting_date)
+
+    def delete(self, using=None):
+        """
+        Deletes the waiting player, returns whether it was still there (see
+        delete_row).
+        """
+        return delete_row(self, using)
+
     def owner(self):
         return self.player.user
 
@@ -143,6 +390,12 @@ class Guest(models.Model):
     def __str__(self):
         return self.name
 
+    def delete(self, using=None):
+        """
+        Deletes the guest, returns whether it was still there (see delete_row).
+        """
+        return delete_row(self, using)
+
     def owner(self):
         return self.inviting_player.user
 
@@ -218,3 +471,267 @@ class WeeklyMatchSchedule(models.Model):
         given date's weekday.
         """
         return WeeklyMatchSchedule.objects.filter(invite_weekday=date.weekday()).first()
+
+
+class OutboundEmail(models.Model):
+    """
+    Model class representing an email queued for sending by the mail worker.
+    Pending emails are sent in batches, failed attempts are retried with
+    exponential backoff, and emails are moved to the dead state when they run
+    out of attempts.
+    """
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (DEAD, 'Dead'),
+    )
+
+    subject = models.CharField(max_length=200)
+    from_email = models.CharField(max_length=200)
+    to = models.TextField()
+    cc = models.TextField(blank=True)
+    bcc = models.TextField(blank=True)
+    """
+    Recipient addresses, one per line. Broadcast emails only have bcc
+    recipients.
+    """
+
+    body = models.TextField()
+    html = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = ['status', 'next_attempt']
+
+    def __str__(self):
+        return '%s to %s (%s)' % (self.subject, ', '.join(self.recipients()), self.status)
+
+    def recipients(self):
+        """
+        All the recipient addresses, including cc and bcc.
+        """
+        return [address for addresses in (self.to, self.cc, self.bcc) for address in addresses.split('\n') if address]
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Create an unsaved instance for the given EmailMultiAlternatives message.
+        Only the recipients, the plain text body and an HTML alternative are
+        kept.
+        """
+        html = ''
+        for content, mimetype in getattr(message, 'alternatives', []):
+            if mimetype == 'text/html':
+                html = content
+        return cls(
+            subject=message.subject,
+            from_email=message.from_email,
+            to='\n'.join(message.to),
+            cc='\n'.join(message.cc),
+            bcc='\n'.join(message.bcc),
+            body=message.body,
+            html=html)
+
+    def message(self):
+        """
+        EmailMultiAlternatives message for this email.
+        """
+        addresses = lambda value: value.split('\n') if value else []
+        msg = EmailMultiAlternatives(self.subject, self.body, self.from_email, addresses(self.to),
+            bcc=addresses(self.bcc), cc=addresses(self.cc))
+        if len(self.html) > 0:
+            msg.attach_alternative(self.html, 'text/html')
+        return msg
+
+    def mark_sent(self, date):
+        """
+        Mark the email as sent on the given date.
+        """
+        self.status = OutboundEmail.SENT
+        self.attempts += 1
+        self.sent_date = date
+
+    def mark_failed(self, error, date, retry_delay, max_attempts):
+        """
+        Record a failed attempt on the given date.
+        The next attempt is scheduled retry_delay * 2^(attempts - 1) seconds
+        later, or the email is marked as dead after max_attempts.
+        """
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= max_attempts:
+            self.status = OutboundEmail.DEAD
+        else:
+            self.next_attempt = date + timedelta(seconds=retry_delay * 2 ** (self.attempts - 1))
+
+
+class RosterEvent(models.Model):
+    """
+    Model class representing a change in a match roster waiting to be notified.
+    Events are only recorded when roster notifications are coalesced into
+    digests, and deleted once the digest has been sent.
+    """
+
+    JOINED = 'joined'
+    LEFT = 'left'
+    GUEST_ADDED = 'guest_added'
+    GUEST_REMOVED = 'guest_removed'
+    KIND_CHOICES = (
+        (JOINED, 'Joined'),
+        (LEFT, 'Left'),
+        (GUEST_ADDED, 'Guest added'),
+        (GUEST_REMOVED, 'Guest removed'),
+    )
+
+    match = models.ForeignKey(Match, related_name='roster_events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    player = models.ForeignKey(Player)
+    """
+    The player joining or leaving the match, or inviting the guest.
+    """
+
+    guest_name = models.CharField(max_length=50, blank=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '%s %s %s' % (self.player, self.kind, self.guest_name)
+
+
+class SentEmail(models.Model):
+    """
+    Model class representing a daily email sent to a player about a match.
+    Used as a ledger so repeated triggers on the same day don't send the same
+    email again.
+    """
+
+    INVITE = 'invite'
+    STATUS = 'status'
+    KIND_CHOICES = (
+        (INVITE, 'Invite'),
+        (STATUS, 'Status'),
+    )
+
+    match = models.ForeignKey(Match, related_name='sent_emails')
+    player = models.ForeignKey(Player)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    day = models.DateField()
+
+    class Meta:
+        unique_together = (('match', 'kind', 'day', 'player'),)
+
+    def __str__(self):
+        return '%s %s %s %s' % (self.day, self.kind, self.match, self.player)
+
+
+class SiteStatistics(models.Model):
+    """
+    Model class holding the numbers shown in the index page, kept up to date
+    incrementally as players, matches and match players change (see
+    core.signals) so the index page doesn't aggregate the whole database.
+    There is a single row, built on first use or with the rebuildstats command.
+    """
+
+    match_count = models.IntegerField(default=0)
+    player_count = models.IntegerField(default=0)
+    top_player = models.ForeignKey(Player, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    top_player_matches = models.IntegerField(default=0)
+    next_match = models.ForeignKey(Match, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'site statistics'
+
+    def __str__(self):
+        return '%i matches, %i players' % (self.match_count, self.player_count)
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the statistics, with the top player and next match, in a single
+        query. The statistics are rebuilt if they don't exist yet, and the next
+        match is looked up again once it has been played.
+        """
+        stats = SiteStatistics.objects.select_related('top_player', 'next_match').filter(pk=1).first()
+        if stats == None:
+            stats = SiteStatistics.rebuild()
+        now = datetime.now()
+        if stats.next_match != None and stats.next_match.date <= now:
+            stats.next_match = Match.next_match(now)
+            SiteStatistics.objects.filter(pk=1).update(next_match=stats.next_match)
+        return stats
+
+    @classmethod
+    def rebuild(cls, chunk_size=1000):
+        """
+        Recomputes the statistics from scratch, aggregating match players in
+        chunks of chunk_size players.
+        """
+        top_player, top_player_matches = None, 0
+        last_id = 0
+        while True:
+            chunk = list(Player.objects.filter(id__gt=last_id).order_by('id')[:chunk_size]
+                .annotate(matches_played=Count('matches')))
+            if len(chunk) == 0:
+                break
+            for player in chunk:
+                if top_player == None or player.matches_played > top_player_matches:
+                    top_player, top_player_matches = player, player.matches_played
+            last_id = chunk[-1].id
+
+        stats = SiteStatistics(
+            pk=1,
+            match_count=Match.objects.count(),
+            player_count=Player.objects.count(),
+            top_player=top_player,
+            top_player_matches=top_player_matches,
+            next_match=Match.next_match(datetime.now()))
+        stats.save()
+        return stats
+
+    @classmethod
+    def add(cls, **counts):
+        """
+        Atomically adds the given amounts to the given counters.
+        """
+        SiteStatistics.objects.filter(pk=1).update(**dict(
+            (field, models.F(field) + amount) for field, amount in counts.items()))
+
+    @classmethod
+    def player_matches_changed(cls, player_id, joined):
+        """
+        Updates the top player after the player with the given id joined or left
+        a match.
+        """
+        stats = SiteStatistics.objects.filter(pk=1)
+        if joined:
+            matches = Player.objects.values_list('match_count', flat=True).get(id=player_id)
+            stats.filter(Q(top_player=player_id) | Q(top_player_matches__lt=matches)).update(
+                top_player=player_id, top_player_matches=matches)
+        elif stats.filter(top_player=player_id).exists():
+            # somebody else might be on top now
+            SiteStatistics.top_player_changed()
+
+    @classmethod
+    def next_match_changed(cls):
+        """
+        Looks up the next match again.
+        """
+        SiteStatistics.objects.filter(pk=1).update(next_match=Match.next_match(datetime.now()))
+
+    @classmethod
+    def top_player_changed(cls):
+        """
+        Looks up the top player again.
+        """
+        top_player = Player.top_player()
+        SiteStatistics.objects.filter(pk=1).update(
+            top_player=top_player, top_player_matches=top_player.match_count if top_player != None else 0)
@@ -0,0 +1,195 @@
+"""
+Rate limiting for sending emails within the quotas of the SMTP provider.
+"""
+
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+
+class TokenBucket(object):
+    """
+    Token bucket allowing `rate` sends per `period` seconds, in bursts of up to
+    `rate` sends. A rate of 0 is unlimited.
+    """
+
+    def __init__(self, rate, period=1):
+        self.rate = rate
+        self.period = period
+        self._lock = threading.Lock()
+        self._tokens = float(rate)
+        self._updated = time.time()
+
+    def reserve(self):
+        """
+        Takes a token, returns the number of seconds to wait before using it.
+        Tokens can be reserved ahead of time, so concurrent senders are spaced
+        out instead of all waking up at once.
+        """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens * self.period / self.rate
+
+
+class SharedRateLimit(object):
+    """
+    Rate limit of `rate` sends per `period` seconds shared by every process
+    using the cache, which counts the sends of each period-long window. At most
+    `rate` sends start in any window, and sends beyond that take a slot in the
+    following windows. A rate of 0 is unlimited.
+    Counters are incremented atomically by memcached, the database cache
+    backend can let a few concurrent sends through over the rate.
+    """
+
+    KEY = 'mail_rate:%i:%i'
+
+    def __init__(self, rate, period=1):
+        self.rate = rate
+        self.period = period
+
+    def reserve(self):
+        """
+        Takes a slot, returns the number of seconds to wait before using it.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        window = int(now // self.period)
+        while True:
+            key = SharedRateLimit.KEY % (self.period, window)
+            cache.add(key, 0, int((window + 2) * self.period - now))
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                # expired since it was added
+                continue
+            if count <= self.rate:
+                return max(0, window * self.period - now)
+            window += 1
+
+
+class SendScheduler(object):
+    """
+    Schedules message sends within per_second and per_hour rate limits (0 is
+    unlimited), with at most `concurrency` sends at the same time. Rate limits
+    are kept in the cache, shared with other processes, if `shared` is true,
+    or in the memory of the process otherwise.
+    Concurrency is adaptive: it's halved every time the server throttles us with
+    a 4xx reply, and grows back by one every `concurrency` successful sends up
+    to max_concurrency. Throttled sends should be retried after backoff(attempt)
+    seconds.
+    The backlog is the number of messages submitted and not sent (or failed) yet.
+    """
+
+    def __init__(self, max_concurrency, per_second=0, per_hour=0, backoff=1, shared=False):
+        self.max_concurrency = max_concurrency
+        self.per_second = per_second
+        self.per_hour = per_hour
+        self._backoff = backoff
+        bucket = SharedRateLimit if shared else TokenBucket
+        self._buckets = [bucket(per_second, 1), bucket(per_hour, 3600)]
+        self._condition = threading.Condition()
+        self.concurrency = float(max_concurrency)
+        self.active = 0
+        self.backlog = 0
+        self.throttled = 0
+
+    def stats(self):
+        with self._condition:
+            return {
+                'backlog': self.backlog,
+                'active': self.active,
+                'concurrency': int(self.concurrency),
+                'max_concurrency': self.max_concurrency,
+                'throttled': self.throttled,
+                'per_second': self.per_second,
+                'per_hour': self.per_hour,
+            }
+
+    def submitted(self, count):
+        with self._condition:
+            self.backlog += count
+
+    def done(self, count=1):
+        with self._condition:
+            self.backlog -= count
+
+    def reserve(self):
+        """
+        Takes a token from every bucket, returns the seconds to wait before sending.
+        """
+        return max(bucket.reserve() for bucket in self._buckets)
+
+    def acquire(self):
+        """
+        Blocks the calling thread until a send is allowed by the concurrency and
+        rate limits. Call release() once sent.
+        """
+        with self._condition:
+            while self.active >= int(self.concurrency):
+                self._condition.wait()
+            self.active += 1
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def success(self):
+        with self._condition:
+            if self.concurrency < self.max_concurrency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self._condition.notify_all()
+
+    def throttle(self):
+        with self._condition:
+            self.throttled += 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+
+    def backoff(self, attempt):
+        """
+        Seconds to wait before retrying a send throttled `attempt` times.
+        """
+        return self._backoff * 2 ** (attempt - 1)
+
+
+def is_throttled(error):
+    """
+    Whether the given SMTP error is a transient 4xx reply, usually the server
+    asking us to slow down.
+    """
+    code = getattr(error, 'smtp_code', None)
+    return code != None and 400 <= code < 500
+
+
+def send_scheduler(max_concurrency):
+    """
+    New SendScheduler according to the MAILER_RATE_PER_SECOND,
+    MAILER_RATE_PER_HOUR and MAILER_THROTTLE_BACKOFF settings.
+    The rates are shared by all processes through the cache if it is shared,
+    otherwise every process gets an equal part of them, according to the
+    MAILER_RATE_PROCESSES setting.
+    """
+    if settings.CACHE_IS_SHARED:
+        return SendScheduler(
+            max_concurrency,
+            per_second=settings.MAILER_RATE_PER_SECOND,
+            per_hour=settings.MAILER_RATE_PER_HOUR,
+            backoff=settings.MAILER_THROTTLE_BACKOFF,
+            shared=True)
+    return SendScheduler(
+        max_concurrency,
+        per_second=settings.MAILER_RATE_PER_SECOND / settings.MAILER_RATE_PROCESSES,
+        per_hour=settings.MAILER_RATE_PER_HOUR / settings.MAILER_RATE_PROCESSES,
+        backoff=settings.MAILER_THROTTLE_BACKOFF)
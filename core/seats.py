@@ -0,0 +1,113 @@
+"""
+Allocation of the seats of matches.
+
+A match has capacity seats, taken by its players and guests. Players joining a
+full match wait in its waitlist, and are given the seats that are freed when
+players leave or guests are removed, in the order they started waiting. Guests
+only take free seats, they don't wait.
+Seats are allocated with the match locked (see Match.lock), so simultaneous
+joins never take more seats than there are, and waiting players are promoted
+exactly once.
+"""
+
+import logging
+from django.db import transaction
+from core.models import Match, MatchPlayer, WaitingPlayer
+from core import mailer
+
+
+LOGGER = logging.getLogger(__name__)
+
+JOINED = 'joined'
+WAITING = 'waiting'
+LEFT = 'left'
+UNQUEUED = 'unqueued'
+
+
+def join(match, player):
+    """
+    Gives the given player a seat in the given match if there is a free one,
+    otherwise adds them to the end of the waitlist.
+    Returns JOINED or WAITING, or None if the player was in the match or
+    waiting already.
+    """
+    with transaction.atomic():
+        match = Match.lock(match.id)
+        if match.waiting_count == 0 and not match.is_full():
+            return JOINED if MatchPlayer.join(match, player) else None
+        if match.has_player(player):
+            return None
+        return WAITING if WaitingPlayer.objects.get_or_create(match=match, player=player)[1] else None
+
+
+def leave(match, player):
+    """
+    Removes the given player from the given match, giving their seat to the
+    first waiting player, or from its waitlist.
+    Returns LEFT, UNQUEUED or None if the player was neither in the match nor
+    waiting, and the list of players that were given a seat.
+    """
+    with transaction.atomic():
+        match = Match.lock(match.id)
+        if MatchPlayer.leave(match, player):
+            return LEFT, promote(match)
+        waiting = WaitingPlayer.objects.filter(match=match, player=player).first()
+        if waiting == None or not waiting.delete():
+            return None, []
+        return UNQUEUED, []
+
+
+def add_guest(match, inviting_player, name):
+    """
+    Adds a guest with the given name, invited by inviting_player, to the given
+    match if there is a free seat and nobody is waiting for one.
+    Returns the guest, or None if the match is full.
+    """
+    with transaction.atomic():
+        match = Match.lock(match.id)
+        if match.waiting_count > 0 or match.is_full():
+            return None
+        return match.guests.create(inviting_player=inviting_player, name=name)
+
+
+def remove_guest(guest):
+    """
+    Removes the given guest from its match, giving the seat to the first
+    waiting player.
+    Returns whether the guest was removed, False if it was removed already
+    (e.g. by a simultaneous request), and the list of players that were given a
+    seat.
+    """
+    with transaction.atomic():
+        match = Match.lock(guest.match_id)
+        if not guest.delete():
+            return False, []
+        return True, promote(match)
+
+
+def promote(match):
+    """
+    Gives the free seats of the given match to the players waiting the
+    longest, for example after raising its capacity. The match is locked (again
+    if the current transaction locked it already) to read its current counters.
+    Returns the list of players that were given a seat.
+    """
+    with transaction.atomic():
+        match = Match.lock(match.id)
+        if match.waiting_count == 0 or match.is_full():
+            return []
+        promoted = []
+        for waiting in WaitingPlayer.objects.filter(match=match).select_related('player')[:match.free_seats()]:
+            if waiting.delete() and MatchPlayer.join(match, waiting.player):
+                promoted.append(waiting.player)
+        return promoted
+
+
+def notify_promoted(match, promoted):
+    """
+    Sends the join emails for the waiting players that were given a seat in the
+    match.
+    """
+    for player in promoted:
+        sent_mails = mailer.send_join_mails(match, player)
+        LOGGER.info('%s joined %s from the waitlist, sent %i email(s)' % (player, match, sent_mails))
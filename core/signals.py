@@ -0,0 +1,132 @@
+"""
+Signal receivers keeping cached data in sync with the models.
+Roster changes bump the version of the match, which keys its cached fragment
+(see core.fragments).
+"""
+
+from datetime import datetime
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.db.models import Q, F
+from core.models import Player, Match, MatchPlayer, WaitingPlayer, Guest, SiteStatistics
+from core import currentplayer
+
+
+@receiver(post_save, sender=MatchPlayer)
+def player_joined(sender, instance, created, **kwargs):
+    if created:
+        Player.objects.filter(id=instance.player_id).update(
+            match_count=F('match_count') + 1, played=F('played') + 1)
+        SiteStatistics.player_matches_changed(instance.player_id, joined=True)
+
+
+@receiver(post_delete, sender=MatchPlayer)
+def player_left(sender, instance, **kwargs):
+    """
+    Leaving is counted by MatchPlayer.leave, deleting matches or match players
+    doesn't count as leaving.
+    """
+    Player.objects.filter(id=instance.player_id).update(match_count=F('match_count') - 1)
+    SiteStatistics.player_matches_changed(instance.player_id, joined=False)
+
+
+def roster_updated(match_ids, **counts):
+    """
+    Adds the given amounts to the given counters of the given matches, and bumps
+    their version.
+    """
+    updates = dict((field, F(field) + amount) for field, amount in counts.items())
+    Match.objects.filter(id__in=match_ids).update(version=F('version') + 1, modified=datetime.now(), **updates)
+
+
+@receiver(post_save, sender=MatchPlayer)
+def match_player_counted(sender, instance, created, **kwargs):
+    roster_updated([instance.match_id], players_count=1 if created else 0)
+
+
+@receiver(post_delete, sender=MatchPlayer)
+def match_player_uncounted(sender, instance, **kwargs):
+    roster_updated([instance.match_id], players_count=-1)
+
+
+@receiver(post_save, sender=Guest)
+def guest_counted(sender, instance, created, **kwargs):
+    roster_updated([instance.match_id], guests_count=1 if created else 0)
+
+
+@receiver(post_delete, sender=Guest)
+def guest_uncounted(sender, instance, **kwargs):
+    roster_updated([instance.match_id], guests_count=-1)
+
+
+@receiver(post_save, sender=WaitingPlayer)
+def waiting_player_counted(sender, instance, created, **kwargs):
+    roster_updated([instance.match_id], waiting_count=1 if created else 0)
+
+
+@receiver(post_delete, sender=WaitingPlayer)
+def waiting_player_uncounted(sender, instance, **kwargs):
+    roster_updated([instance.match_id], waiting_count=-1)
+
+
+@receiver(post_save, sender=Match)
+def match_saved(sender, instance, created, **kwargs):
+    stats = SiteStatistics.objects.filter(pk=1)
+    if created:
+        SiteStatistics.add(match_count=1)
+    else:
+        roster_updated([instance.id])
+    if instance.date > datetime.now():
+        # an earlier upcoming match is the next one
+        stats.filter(Q(next_match=None) | Q(next_match__date__gt=instance.date)).update(next_match=instance)
+    elif stats.filter(next_match=instance).exists():
+        # the next match was moved to the past
+        SiteStatistics.next_match_changed()
+
+
+@receiver(post_delete, sender=Match)
+def match_deleted(sender, instance, **kwargs):
+    """
+    The next match is set to null before deleting it, and looked up again.
+    """
+    SiteStatistics.add(match_count=-1)
+    if SiteStatistics.objects.filter(pk=1, next_match=None).exists():
+        SiteStatistics.next_match_changed()
+
+
+@receiver(post_save, sender=Player)
+def player_created(sender, instance, created, **kwargs):
+    if created:
+        SiteStatistics.add(player_count=1)
+        SiteStatistics.objects.filter(pk=1, top_player=None).update(top_player=instance, top_player_matches=0)
+
+
+@receiver(post_delete, sender=Player)
+def player_deleted(sender, instance, **kwargs):
+    """
+    The top player is set to null before deleting it, and looked up again.
+    """
+    SiteStatistics.add(player_count=-1)
+    if SiteStatistics.objects.filter(pk=1, top_player=None).exists():
+        SiteStatistics.top_player_changed()
+
+
+@receiver(post_save, sender=Player)
+def player_changed(sender, instance, created, **kwargs):
+    """
+    Players are shown by name and email in the roster of their matches in the
+    API, and by name in the waitlist and guests of upcoming match pages. The
+    version of those matches is bumped when the name or email changes.
+    """
+    if instance.details_changed:
+        match_ids = Match.objects.filter(
+            Q(matchplayer__player=instance) |
+            Q(Q(waitlist__player=instance) | Q(guests__inviting_player=instance), date__gt=datetime.now())
+        ).values_list('id', flat=True).distinct()
+        roster_updated(list(match_ids))
+
+
+@receiver(post_save, sender=Player)
+@receiver(post_delete, sender=Player)
+def player_snapshot_changed(sender, instance, **kwargs):
+    currentplayer.invalidate(instance.id)
@@ -0,0 +1,164 @@
+"""
+Local SMTP stand-in for measuring the mailer.
+Accepts SMTP sessions on localhost and discards every message, keeping count of
+connections and messages so the mailer behaviour can be measured offline.
+Latency, errors and connection limits of a real server can be simulated.
+"""
+
+import random
+import socketserver
+import threading
+import time
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single SMTP session, implementing just enough of the protocol for
+    Django's SMTP email backend (no STARTTLS and no authentication).
+    """
+    # replies to pipelined commands are small writes, don't delay them
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('ascii'))
+
+    def handle(self):
+        sink = self.server.sink
+        if not sink.connection_opened():
+            self.reply('421 Too many connections')
+            return
+        try:
+            self.reply('220 localhost Fobal SMTP sink')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.decode('ascii', 'replace').strip().upper()
+                if command.startswith('EHLO'):
+                    self.reply('250-localhost')
+                    self.reply('250 PIPELINING')
+                elif command.startswith('HELO'):
+                    self.reply('250 localhost')
+                elif command.startswith('DATA'):
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    self.read_data()
+                    if sink.latency > 0:
+                        time.sleep(sink.latency)
+                    if sink.message_received():
+                        self.reply('250 OK')
+                    else:
+                        self.reply('%i Try again later' % sink.error_code)
+                elif command.startswith('QUIT'):
+                    self.reply('221 Bye')
+                    break
+                elif command.split(' ')[0] in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                    self.reply('250 OK')
+                else:
+                    self.reply('502 Command not implemented')
+        finally:
+            sink.connection_closed()
+
+    def read_data(self):
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b'.\r\n':
+                return
+
+
+class SMTPSinkServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Threaded TCP server for the SMTP sink, one thread per SMTP session.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink(object):
+    """
+    Local SMTP server that discards messages and counts them.
+    Binds to an ephemeral port on localhost by default, use `port` to get the
+    actual port once started.
+    Simulates a real server with:
+    - latency: seconds to wait before accepting each message
+    - error_rate: fraction of messages rejected with error_code (451 by default)
+    - max_connections: concurrent sessions allowed, further ones are refused
+      with 421 (0 is unlimited)
+    Rejected messages and refused connections are counted in `errors` and
+    `refused`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, error_code=451, max_connections=0, seed=None):
+        self.server = SMTPSinkServer((host, port), SMTPSinkHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.max_connections = max_connections
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.connections = 0
+        self.open_connections = 0
+        self.max_open_connections = 0
+        self.messages = 0
+        self.errors = 0
+        self.refused = 0
+
+    def connection_opened(self):
+        """
+        Counts a new session, returns False if it's over max_connections.
+        """
+        with self._lock:
+            if self.max_connections > 0 and self.open_connections >= self.max_connections:
+                self.refused += 1
+                return False
+            self.connections += 1
+            self.open_connections += 1
+            self.max_open_connections = max(self.max_open_connections, self.open_connections)
+            return True
+
+    def connection_closed(self):
+        with self._lock:
+            self.open_connections -= 1
+
+    def message_received(self):
+        """
+        Counts a new message, returns False if it should be rejected.
+        """
+        with self._lock:
+            if self.error_rate > 0 and self._random.random() < self.error_rate:
+                self.errors += 1
+                return False
+            self.messages += 1
+            return True
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and release the port.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def connection_kwargs(self):
+        """
+        Keyword arguments for django.core.mail.get_connection to send to this sink.
+        """
+        return {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': self.host,
+            'port': self.port,
+            'username': '',
+            'password': '',
+            'use_tls': False,
+        }
@@ -4,26 +4,42 @@ Module containing recurring tasks and helper functions.
 
 import logging
 from datetime import datetime, timedelta
-from core.models import Player, Match, WeeklyMatchSchedule
+from collections import namedtuple
+from django.conf import settings
+from core.models import Player, Match, WeeklyMatchSchedule, SentEmail
 from core import mailer, datehelper
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def create_match_or_send_status(date, async):
+DailyMails = namedtuple('DailyMails', ['match', 'sent', 'skipped'])
+"""
+Result of send_daily_mails: the found or created match, if any, the number of
+emails sent and the number of players skipped because they already got an
+email about the match that day.
+"""
+
+
+def send_daily_mails(date, async):
     """
     Creates next match and sends invite emails if needed, or sends status emails
     if the next match is already created.
     Matches are played according to the existing WeeklyMatchSchedule instances.
     No matches are created and no emails are sent on weekends.
-    Returns the found or created match if any.
+    Players get at most one invite or status email about the match per day, so
+    calling this again on the same day only sends emails to new players, and
+    to players whose email failed to send (see mailer.SendLedger).
+    If MAILER_INVITE_WAVE_SIZE is set players are invited in waves (see
+    send_invite_wave), any due waves are sent, and status emails only go to
+    players that have been invited.
+    Returns a DailyMails tuple.
     If async si true emails are sent asynchronously.
     """
     if datehelper.is_weekend(date):
         # nothing happens on weekends
         LOGGER.info('No emails sent on weekends %s' % date)
-        return None
+        return DailyMails(None, 0, 0)
     else:
         # find next match
         next_match = Match.next_match(date)
@@ -32,13 +48,84 @@ def create_match_or_send_status(date, async):
             schedule = WeeklyMatchSchedule.invite_weekday_schedule(date)
             if schedule == None:
                 LOGGER.info('No weekly match schedules setup to send invites on %s' % date)
-                return None
+                return DailyMails(None, 0, 0)
             else:
                 next_match = schedule.create_next_match(date)
-                sent_mails = mailer.send_invite_mails(next_match, Player.objects.all(), async)
+                if settings.MAILER_INVITE_WAVE_SIZE > 0:
+                    sent_mails = send_invite_wave(next_match, date, async)
+                    LOGGER.info('Created match for %s and sent %i invitation emails in the first wave' % (
+                        next_match.date, sent_mails))
+                    return DailyMails(next_match, sent_mails, 0)
+                ledger = mailer.SendLedger(next_match, SentEmail.INVITE, date.date())
+                unsent = ledger.unsent(Player.objects.all())
+                sent_mails = mailer.send_invite_mails(next_match, unsent.players, async, ledger)
                 LOGGER.info('Created match for %s and sent %i invitation emails' % (next_match.date, sent_mails))
         else:
-            sent_mails = mailer.send_status_mails(next_match, Player.objects.all(), async)
-            LOGGER.info('Sent %i status messages for next match: %s' % (sent_mails, next_match.date))
+            players = Player.objects.all()
+            wave_mails = 0
+            if settings.MAILER_INVITE_WAVE_SIZE > 0:
+                wave_mails = send_invite_waves(date, async)
+                players = players.filter(id__in=invited_players(next_match))
+            ledger = mailer.SendLedger(next_match, SentEmail.STATUS, date.date(), also_skip=[SentEmail.INVITE])
+            unsent = ledger.unsent(players)
+            sent_mails = 0
+            if unsent.count > 0:
+                sent_mails = mailer.send_status_mails(next_match, unsent.players, async, ledger)
+            LOGGER.info('Sent %i status messages for next match: %s, skipped %i already sent' % (
+                sent_mails, next_match.date, unsent.skipped))
+            sent_mails += wave_mails
+
+        return DailyMails(next_match, sent_mails, unsent.skipped)
+
+
+def create_match_or_send_status(date, async):
+    """
+    Creates next match and sends invite emails if needed, or sends status emails
+    if the next match is already created, see send_daily_mails.
+    Returns the found or created match if any.
+    If async si true emails are sent asynchronously.
+    """
+    return send_daily_mails(date, async).match
+
+
+def invited_players(match):
+    """
+    QuerySet with the ids of the players invited to the given match.
+    """
+    return SentEmail.objects.filter(match=match, kind=SentEmail.INVITE).values('player')
+
+
+def send_invite_wave(match, date, async):
+    """
+    Invites the next MAILER_INVITE_WAVE_SIZE players that weren't invited to the
+    given match yet, most frequent players first, unless the match is full or
+    has been played already.
+    The next wave is scheduled MAILER_INVITE_WAVE_INTERVAL seconds after the
+    given date, if there are players left to invite.
+    Returns the number of emails sent.
+    """
+    if match.date <= date or match.is_full():
+        Match.objects.filter(id=match.id).update(next_invite_wave=None)
+        return 0
+
+    size = settings.MAILER_INVITE_WAVE_SIZE
+    wave = list(Player.leaderboard().exclude(id__in=invited_players(match))[:size + 1])
+    next_wave = date + timedelta(seconds=settings.MAILER_INVITE_WAVE_INTERVAL) if len(wave) > size else None
+    Match.objects.filter(id=match.id).update(next_invite_wave=next_wave)
+    match.next_invite_wave = next_wave
+
+    ledger = mailer.SendLedger(match, SentEmail.INVITE, date.date())
+    return mailer.send_invite_mails(match, wave[:size], async, ledger)
 
-        return next_match
+
+def send_invite_waves(date, async):
+    """
+    Sends the invite waves that are due on the given date.
+    Returns the number of emails sent.
+    """
+    sent = 0
+    for match in Match.objects.filter(next_invite_wave__lte=date):
+        wave = send_invite_wave(match, date, async)
+        LOGGER.info('Sent a wave of %i invitation emails for %s' % (wave, match.date))
+        sent += wave
+    return sent
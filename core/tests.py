@@ -7,18 +7,72 @@ Tests module for the following modules:
 - urlhelper
 """
 from urllib.parse import urljoin
+from io import StringIO
 import datetime
-
-from django.test import TestCase, Client
-from django.core.exceptions import ValidationError
+import threading
+import json
+import smtplib
+import logging
+import time
+import re
+
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.db import connection
+from unittest import skipIf
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.conf import settings
 from django.core import mail
+from django.core.cache import cache
+from django.core import signing
+from django.core.management import call_command
+from django.template import Context
+from django.template.loader import get_template
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+
+from django.core.mail.backends.base import BaseEmailBackend
 
-from core.models import Player, Match, MatchPlayer, Guest, WeeklyMatchSchedule
-from core import tasks, mailer, datehelper
+from core.models import Player, Match, MatchPlayer, Guest, WeeklyMatchSchedule, OutboundEmail, RosterEvent, SentEmail, SiteStatistics
+from core import tasks, mailer, datehelper, fragments, currentplayer, seats
+from core.smtpsink import SMTPSink
+from core.ratelimit import TokenBucket, SharedRateLimit, SendScheduler
+from core.asyncsmtp import AsyncSMTPSender
+from core.loghandlers import BackgroundHandler, AdminEmailHandler
 from core.urlhelper import absolute_url, join_match_url, leave_match_url, match_url
 
+
+def cookie_player_id(client):
+    """
+    Id of the player in the current player cookie of the given client, or None.
+    """
+    cookie = client.cookies.get(currentplayer.COOKIE_NAME)
+    if cookie == None or cookie.value == '':
+        return None
+    signer = signing.get_cookie_signer(salt=currentplayer.COOKIE_NAME + currentplayer.COOKIE_SALT)
+    return int(signer.unsign(cookie.value))
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    """
+    Email backend that fails to send any message.
+    """
+    def send_messages(self, email_messages):
+        raise ConnectionRefusedError('SMTP server is down')
+
+
+class RejectingEmailBackend(BaseEmailBackend):
+    """
+    Email backend that rejects messages to addresses starting with 'reject',
+    and sends the others to the test outbox.
+    """
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if any(address.partition('<')[2].startswith('reject') for address in message.recipients()):
+                raise smtplib.SMTPRecipientsRefused(dict((address, (550, 'Rejected')) for address in message.recipients()))
+            mail.outbox.append(message)
+        return len(email_messages)
+
+
 # Model tests
 
 class PlayerTests(TestCase):
@@ -93,6 +147,85 @@ class PlayerTests(TestCase):
         self.assertTrue(top_player, p2)
 
 
+    def test_match_counters(self):
+        """
+        Joining and leaving matches should update the player counters, deleting
+        matches doesn't count as leaving.
+        """
+        p1 = Player.objects.create(name='Counters', email='counters@email.com')
+        past = Match.objects.create(date=datetime.datetime.now() - datetime.timedelta(days=1), place='Here')
+        future = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Here')
+        MatchPlayer.objects.create(player=p1, match=past)
+        MatchPlayer.objects.create(player=p1, match=future)
+        p1 = Player.objects.get(id=p1.id)
+        self.assertEquals((p1.match_count, p1.played, p1.left), (2, 2, 0))
+
+        MatchPlayer.leave(future, p1)
+        past.delete()
+        p1 = Player.objects.get(id=p1.id)
+        self.assertEquals((p1.match_count, p1.played, p1.left), (0, 2, 1))
+
+        MatchPlayer.objects.create(player=p1, match=future)
+        future.delete()
+        p1 = Player.objects.get(id=p1.id)
+        self.assertEquals((p1.match_count, p1.played, p1.left), (0, 3, 1))
+
+
+    def test_delete_counters(self):
+        """
+        Deleting a row that was deleted already shouldn't change the counters.
+        """
+        player = Player.objects.create(name='Twice', email='twice@email.com')
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Twice')
+        guest = Guest.objects.create(name='Twice', inviting_player=player, match=match)
+        match_player = MatchPlayer.objects.create(player=player, match=match)
+        stale_guest = Guest.objects.get(id=guest.id)
+        stale_match_player = MatchPlayer.objects.get(id=match_player.id)
+
+        self.assertTrue(guest.delete())
+        self.assertFalse(stale_guest.delete())
+        self.assertTrue(match_player.delete())
+        self.assertFalse(stale_match_player.delete())
+        match = Match.objects.get(id=match.id)
+        self.assertEquals((match.players_count, match.guests_count), (0, 0))
+        self.assertEquals(Player.objects.get(id=player.id).match_count, 0)
+
+
+    def test_rename_version(self):
+        """
+        Changing the name or email of a player should bump the version of the
+        matches they played or will play, and of the upcoming matches they
+        invited guests to. Other changes to the player shouldn't bump any.
+        """
+        player = Player.objects.create(name='Renamed', email='renamed@email.com')
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        past = Match.objects.create(date=yesterday, place='Past')
+        past_guest = Match.objects.create(date=yesterday - datetime.timedelta(days=1), place='Past Guest')
+        upcoming = Match.objects.create(date=tomorrow, place='Upcoming')
+        other = Match.objects.create(date=tomorrow + datetime.timedelta(days=1), place='Other')
+        for match in [past, upcoming]:
+            MatchPlayer.objects.create(player=player, match=match)
+        for match in [past_guest, upcoming]:
+            Guest.objects.create(name='Guest', inviting_player=player, match=match)
+        versions = lambda: [Match.objects.get(id=match.id).version for match in [past, past_guest, upcoming, other]]
+        before = versions()
+
+        player = Player.objects.get(id=player.id)
+        player.save()
+        self.assertEquals(versions(), before)
+
+        player.email = 'renamed2@email.com'
+        player.save()
+        self.assertEquals(versions(), [before[0] + 1, before[1], before[2] + 1, before[3]])
+        player.save()
+        self.assertEquals(versions(), [before[0] + 1, before[1], before[2] + 1, before[3]])
+
+        player.name = 'Renamed Again'
+        player.save()
+        self.assertEquals(versions(), [before[0] + 2, before[1], before[2] + 2, before[3]])
+
+
     def test_can_join(self):
         """
         can_join should be True iff player has not joined already
@@ -226,21 +359,81 @@ class MatchTests(TestCase):
 
     def test_player_count(self):
         """
-        player_count should return the total number of players in the match, including guests.
+        player_count should return the total number of players in the match,
+        including guests, as of when the match was loaded.
         """
         match = Match.objects.create(date=datetime.datetime.now(), place='Player Count')
         self.assertEquals(match.player_count(), 0)
 
         p1 = Player.objects.create(name='Player One', email='p1@email.com')
         match.matchplayer_set.create(player=p1)
+        match.refresh_from_db()
         self.assertEquals(match.player_count(), 1)
 
         p2 = Player.objects.create(name='Player Two', email='p2@email.com')
         match.matchplayer_set.create(player=p2)
+        match.refresh_from_db()
         self.assertEquals(match.player_count(), 2)
 
         match.guests.create(name='Guest', inviting_player=p1)
+        match.refresh_from_db()
         self.assertEquals(match.player_count(), 3)
+        with self.assertNumQueries(0):
+            self.assertEquals(match.player_count(), 3)
+
+        # saving a stale match keeps the counters
+        stale = Match.objects.get(id=match.id)
+        match.guests.all().delete()
+        stale.place = 'Renamed'
+        stale.save()
+        match.refresh_from_db()
+        self.assertEquals((match.place, match.players_count, match.guests_count), ('Renamed', 2, 0))
+
+
+    def test_join_and_leave(self):
+        """
+        join and leave should only change the roster once, and report it.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Join')
+        player = Player.objects.create(name='Joiner', email='joiner@email.com')
+        self.assertTrue(MatchPlayer.join(match, player))
+        # a single statement (within a savepoint) if nothing changed
+        with self.assertNumQueries(3):
+            self.assertFalse(MatchPlayer.join(match, player))
+        self.assertEquals(Match.objects.get(id=match.id).players_count, 1)
+        self.assertEquals(MatchPlayer.objects.get(match=match).player, player)
+
+        self.assertTrue(MatchPlayer.leave(match, player))
+        with self.assertNumQueries(3):
+            self.assertFalse(MatchPlayer.leave(match, player))
+        self.assertEquals(Match.objects.get(id=match.id).players_count, 0)
+        self.assertEquals(Player.objects.get(id=player.id).left, 1)
+
+
+    def test_check_counters(self):
+        """
+        checkcounters should report matches with wrong counters, and fix them
+        with --repair.
+        """
+        p1 = Player.objects.create(name='Player One', email='p1@email.com')
+        m1 = Match.objects.create(date=datetime.datetime.now(), place='Drift')
+        m2 = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Fine')
+        m1.matchplayer_set.create(player=p1)
+        m2.matchplayer_set.create(player=p1)
+        m2.guests.create(name='Guest', inviting_player=p1)
+        Match.objects.filter(id=m1.id).update(players_count=5, guests_count=-1)
+
+        out = StringIO()
+        call_command('checkcounters', chunk_size=1, stdout=out)
+        self.assertTrue('1 of 2 matches' in out.getvalue())
+        self.assertEquals(Match.objects.get(id=m1.id).player_count(), 4)
+
+        call_command('checkcounters', repair=True, stdout=out)
+        self.assertEquals(Match.objects.get(id=m1.id).player_count(), 1)
+        self.assertEquals(Match.objects.get(id=m2.id).player_count(), 2)
+        out = StringIO()
+        call_command('checkcounters', stdout=out)
+        self.assertTrue('0 of 2 matches' in out.getvalue())
 
 
 # View tests
@@ -275,6 +468,90 @@ class ViewTests(TestCase):
         self.assertEquals(response.context['next_match'], Match.next_match(now))
 
 
+    def test_index_view_statistics(self):
+        """
+        Index view should render from the incrementally updated statistics in a
+        single query, and match the rebuilt statistics.
+        """
+        now = datetime.datetime.now()
+        c = Client()
+        players = [Player.objects.create(name='Stats %i' % i, email='stats%i@email.com' % i) for i in range(3)]
+        past = Match.objects.create(date=now - datetime.timedelta(days=1), place='Past')
+        later = Match.objects.create(date=now + datetime.timedelta(days=2), place='Later')
+        c.get('/')
+
+        sooner = Match.objects.create(date=now + datetime.timedelta(days=1), place='Sooner')
+        MatchPlayer.objects.create(player=players[1], match=past)
+        MatchPlayer.objects.create(player=players[2], match=past)
+        MatchPlayer.objects.create(player=players[2], match=sooner)
+        with self.assertNumQueries(1):
+            response = c.get('/')
+        self.assertEquals(response.context['match_count'], 3)
+        self.assertEquals(response.context['player_count'], 3)
+        self.assertEquals(response.context['top_player'], players[2])
+        self.assertEquals(response.context['next_match'], sooner)
+        self.assertTrue('Stats 2 (2)' in str(response.content))
+
+        # the top player leaves, then is deleted
+        MatchPlayer.objects.filter(player=players[2], match=sooner).delete()
+        MatchPlayer.objects.create(player=players[1], match=later)
+        self.assertEquals(c.get('/').context['top_player'], players[1])
+        players[1].delete()
+        sooner.delete()
+        response = c.get('/')
+        self.assertEquals(response.context['player_count'], 2)
+        self.assertEquals(response.context['match_count'], 2)
+        self.assertEquals(response.context['top_player'], players[2])
+        self.assertEquals(response.context['next_match'], later)
+
+        incremental = SiteStatistics.objects.get(pk=1)
+        call_command('rebuildstats', chunk_size=1)
+        rebuilt = SiteStatistics.objects.get(pk=1)
+        self.assertEquals(
+            (rebuilt.match_count, rebuilt.player_count, rebuilt.top_player, rebuilt.top_player_matches, rebuilt.next_match),
+            (incremental.match_count, incremental.player_count, incremental.top_player, incremental.top_player_matches, incremental.next_match))
+
+
+    def test_leaderboard_view(self):
+        """
+        Leaderboard view should list players by match count, paginated, in a
+        constant number of queries.
+        """
+        c = Client()
+        match = Match.objects.create(date=datetime.datetime.now(), place='Here')
+        players = [Player.objects.create(name='Board %02i' % i, email='board%i@email.com' % i) for i in range(25)]
+        MatchPlayer.objects.create(player=players[24], match=match)
+        with self.assertNumQueries(2):
+            response = c.get('/players/')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.templates[0].name, 'core/leaderboard.html')
+        self.assertEquals(list(response.context['page'].object_list), [players[24]] + players[:19])
+        response = c.get('/players/', {'page': 2})
+        self.assertEquals(list(response.context['page'].object_list), players[19:24])
+        self.assertTrue('<td>25</td>' in str(response.content))
+        self.assertEquals(c.get('/players/', {'page': 3}).status_code, 404)
+
+
+    def test_leaderboard_api(self):
+        """
+        Leaderboard API should return players by match count to authenticated users.
+        """
+        c = Client()
+        match = Match.objects.create(date=datetime.datetime.now(), place='Here')
+        p1 = Player.objects.create(name='Api 1', email='api1@email.com')
+        p2 = Player.objects.create(name='Api 2', email='api2@email.com')
+        MatchPlayer.objects.create(player=p2, match=match)
+        self.assertEquals(c.get('/api/leaderboard/').status_code, 403)
+        p1.user.set_password('secret')
+        p1.user.save()
+        self.assertTrue(c.login(username=p1.user.username, password='secret'))
+        response = c.get('/api/leaderboard/')
+        self.assertEquals(response.status_code, 200)
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertEquals([(r['name'], r['match_count'], r['played'], r['left']) for r in results],
+            [('Api 2', 1, 1, 0), ('Api 1', 0, 0, 0)])
+
+
     def test_match_view(self):
         """
         Match view should be rendered with the proper context and template.
@@ -285,7 +562,7 @@ class ViewTests(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.context['match'], match)
         self.assertFalse('player' in response.context)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
         self.assertFalse("<form action=\"addguest/\" method=\"post\">" in str(response.content))
         self.assertFalse("Juego!" in str(response.content))
         self.assertFalse('join_match_url' in response.context)
@@ -303,7 +580,7 @@ class ViewTests(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.context['match'], match)
         self.assertEquals(response.context['player'], player)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
         self.assertTrue("<form action=\"addguest/\" method=\"post\"" in str(response.content))
         self.assertTrue("Juego" in str(response.content))
         self.assertTrue('join_match_url' in response.context)
@@ -326,7 +603,7 @@ class ViewTests(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.context['match'], match)
         self.assertEquals(response.context['player'], player1)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
         self.assertTrue("<form action=\"addguest/\" method=\"post\"" in str(response.content))
         self.assertTrue("No juego" in str(response.content))
         self.assertFalse('join_match_url' in response.context)
@@ -335,6 +612,209 @@ class ViewTests(TestCase):
         self.assertFalse('removeguest/%i/' % guest2.id in str(response.content))
 
 
+    @override_settings(MATCH_CACHE_TIMEOUT=600, CURRENT_PLAYER_CACHE_TIMEOUT=3600)
+    def test_match_view_queries(self):
+        """
+        Match view should run the same number of queries no matter how many
+        players and guests joined the match.
+        """
+        c = Client()
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place="La Cancha")
+        player = Player.objects.create(name='Test Match View', email="test@matchview.com")
+        c.get('/matches/%d/' % match.id, {'player_id': player.id})
+        for size in [2, 20]:
+            for i in range(match.players.count(), size):
+                other = Player.objects.create(name='Test Queries %i' % i, email='queries%i@matchview.com' % i)
+                match.matchplayer_set.create(player=other)
+                Guest.objects.create(name='Guest %i' % i, inviting_player=other, match=match)
+            # match, roster, guests and waitlist, the player is cached
+            with self.assertNumQueries(4):
+                response = c.get('/matches/%d/' % match.id)
+            self.assertEquals(str(response.content).count('Test Queries'), 2 * size)
+            self.assertTrue('join_match_url' in response.context)
+            # roster, guests and waitlist are cached
+            with self.assertNumQueries(1):
+                cached = c.get('/matches/%d/' % match.id)
+            self.assertEquals(cached.content, response.content)
+
+
+    @override_settings(MATCH_CACHE_TIMEOUT=600)
+    def test_match_view_cache(self):
+        """
+        The cached roster should be invalidated when players join or leave or
+        guests are added or removed, and personal links rendered for each player.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place="La Cancha")
+        player1 = Player.objects.create(name='Cached Player 1', email="cached1@matchview.com")
+        player2 = Player.objects.create(name='Cached Player 2', email="cached2@matchview.com")
+        c1 = Client()
+        c2 = Client()
+        c1.get('/matches/%d/' % match.id, {'player_id': player1.id})
+        c2.get('/matches/%d/' % match.id, {'player_id': player2.id})
+
+        match.matchplayer_set.create(player=player1)
+        guest = Guest.objects.create(name='Cached Guest', inviting_player=player1, match=match)
+        response = c1.get('/matches/%d/' % match.id)
+        self.assertTrue('Cached Player 1' in str(response.content))
+        self.assertTrue('removeguest/%i/' % guest.id in str(response.content))
+        self.assertTrue('leave_match_url' in response.context)
+        response = c2.get('/matches/%d/' % match.id)
+        self.assertTrue('Cached Guest' in str(response.content))
+        self.assertFalse('removeguest/%i/' % guest.id in str(response.content))
+        self.assertTrue('join_match_url' in response.context)
+
+        guest.delete()
+        player1.name = 'Renamed Player 1'
+        player1.save()
+        response = c2.get('/matches/%d/' % match.id)
+        self.assertFalse('Cached Guest' in str(response.content))
+        self.assertTrue('Renamed Player 1' in str(response.content))
+
+        MatchPlayer.objects.filter(match=match).delete()
+        match.matchplayer_set.create(player=player2)
+        response = c2.get('/matches/%d/' % match.id)
+        self.assertFalse('Renamed Player 1' in str(response.content))
+        self.assertTrue('leave_match_url' in response.context)
+
+
+    @override_settings(MATCH_CACHE_TIMEOUT=600, MATCH_CACHE_FILL_WAIT=1)
+    def test_match_fragment_single_flight(self):
+        """
+        Only one worker should render a missing fragment, the others wait for it.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place="La Cancha")
+        player = Player.objects.create(name='Flight Player', email="flight@matchview.com")
+        match.matchplayer_set.create(player=player)
+        match = Match.objects.get(id=match.id)
+        fill_key = fragments.FILL_KEY % match.id
+        self.assertTrue(cache.add(fill_key, True))
+        filled = fragments.render(match)
+        filler = threading.Timer(0.2, lambda: cache.set(fragments.fragment_key(match), filled))
+        filler.start()
+        with self.assertNumQueries(0):
+            fragment = fragments.match_fragment(match)
+        self.assertEquals(fragment, filled)
+
+        # the filler took too long, render it anyway
+        cache.delete(fragments.fragment_key(match))
+        with override_settings(MATCH_CACHE_FILL_WAIT=0), self.assertNumQueries(3):
+            fragment = fragments.match_fragment(match)
+        self.assertEquals(fragment.player_ids, set([player.id]))
+
+
+    @override_settings(CURRENT_PLAYER_CACHE_TIMEOUT=3600)
+    def test_match_view_conditional(self):
+        """
+        Match view should return 304 after a single lookup if the match, its
+        roster and the current player didn't change.
+        """
+        c = Client()
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place="La Cancha")
+        player = Player.objects.create(name='Conditional', email="conditional@matchview.com")
+        c.get('/matches/%d/' % match.id, {'player_id': player.id})
+        response = c.get('/matches/%d/' % match.id)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        with self.assertNumQueries(1):
+            response = c.get('/matches/%d/' % match.id, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+
+        # roster changed
+        match.matchplayer_set.create(player=player)
+        response = c.get('/matches/%d/' % match.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('leave_match_url' in response.context)
+        self.assertNotEquals(response['ETag'], etag)
+        etag = response['ETag']
+
+        # other player
+        response = Client().get('/matches/%d/' % match.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+
+        # match changed
+        match.place = 'Otra Cancha'
+        match.save()
+        response = c.get('/matches/%d/' % match.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(Match.objects.get(id=match.id).version, 2)
+
+        self.assertEquals(c.get('/matches/12345/', HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+
+    def test_conditional_api(self):
+        """
+        Match and guest API resources should return 304 if they didn't change.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place="La Cancha")
+        player = Player.objects.create(name='Api Conditional', email="conditional@api.com")
+        guest = Guest.objects.create(name='Api Guest', inviting_player=player, match=match)
+        player.user.set_password('secret')
+        player.user.save()
+        c = Client()
+        self.assertTrue(c.login(username=player.user.username, password='secret'))
+
+        for url in ['/api/matches/%i/' % match.id, '/api/guests/%i/' % guest.id]:
+            response = c.get(url, HTTP_ACCEPT='application/json')
+            self.assertEquals(response.status_code, 200)
+            etag = response['ETag']
+            response = c.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304)
+            match.matchplayer_set.create(player=Player.objects.create(name=url, email='%i@api.com' % len(url)))
+            response = c.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 200)
+
+        self.assertEquals(c.get('/api/guests/12345/', HTTP_ACCEPT='application/json').status_code, 404)
+
+        # the emails of players are in the match resource
+        url = '/api/matches/%i/' % match.id
+        etag = c.get(url, HTTP_ACCEPT='application/json')['ETag']
+        roster_player = match.players.first()
+        roster_player.email = 'changed@api.com'
+        roster_player.save()
+        response = c.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('changed@api.com' in response.content.decode('utf-8'))
+
+
+    def test_match_player_api(self):
+        """
+        Joining and leaving through the API should respect the capacity and the
+        waitlist of the match.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Api', capacity=1)
+        players = [Player.objects.create(name='Api %i' % i, email='api%i@email.com' % i) for i in range(3)]
+        for player in players:
+            player.user.set_password('secret')
+            player.user.save()
+        staff = User.objects.create_user('staff', 'staff@fobal.com', 'secret')
+        staff.is_staff = True
+        staff.save()
+        join = lambda c, player: c.post('/api/matchplayers/', {
+            'match': 'http://testserver/api/matches/%i/' % match.id,
+            'player': 'http://testserver/api/players/%i/' % player.id})
+
+        c = Client()
+        self.assertTrue(c.login(username=players[0].user.username, password='secret'))
+        self.assertEquals(join(c, players[1]).status_code, 403)
+        self.assertEquals(join(c, players[0]).status_code, 201)
+        self.assertEquals(join(c, players[0]).status_code, 400)
+        c.logout()
+        self.assertTrue(c.login(username=players[1].user.username, password='secret'))
+        self.assertEquals(join(c, players[1]).status_code, 202)
+        self.assertEquals(list(match.players.all()), [players[0]])
+        self.assertEquals([waiting.player for waiting in match.waitlist.all()], [players[1]])
+
+        # the seat is given to the waiting player
+        c.logout()
+        self.assertTrue(c.login(username='staff', password='secret'))
+        match_player = MatchPlayer.objects.get(match=match, player=players[0])
+        self.assertEquals(c.delete('/api/matchplayers/%i/' % match_player.id).status_code, 204)
+        self.assertEquals(list(match.players.all()), [players[1]])
+        self.assertEquals(match.waitlist.count(), 0)
+        self.assertEquals(Match.objects.get(id=match.id).players_count, 1)
+        self.assertEquals(Player.objects.get(id=players[0].id).left, 1)
+
+
     def test_match_view_with_invalid_player(self):
         """
         Match view with an invalid player should render as if there were no player.
@@ -355,6 +835,36 @@ class ViewTests(TestCase):
         self.assertEquals(response.status_code, 404)
 
 
+    def test_match_landing_view(self):
+        """
+        Test that the match landing page identifies the player and redirects.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Landing')
+        player = Player.objects.create(name='Landing Player', email='landing@email.com')
+        c = Client()
+
+        response = c.get('/matches/%i/me/?action=join' % match.id)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.templates[0].name, 'core/match_landing.html')
+
+        response = c.post('/matches/%i/me/?action=join' % match.id, {'email': 'nobody@email.com'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(cookie_player_id(c), None)
+
+        response = c.post('/matches/%i/me/?action=join' % match.id, {'email': 'Landing@email.com'})
+        self.assertRedirects(response, join_match_url(match, player), target_status_code=302)
+        self.assertEquals(cookie_player_id(c), player.id)
+
+        # known player
+        response = c.get('/matches/%i/me/?action=leave' % match.id)
+        self.assertRedirects(response, leave_match_url(match, player), target_status_code=302)
+        response = c.get('/matches/%i/me/' % match.id)
+        self.assertRedirects(response, match_url(match))
+
+        response = c.get('/matches/12345/me/')
+        self.assertEquals(response.status_code, 404)
+
+
     def test_join_match_view(self):
         """
         Join match view should redirect to match view and create the proper MatchPlayer.
@@ -367,7 +877,7 @@ class ViewTests(TestCase):
 
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.context['match'], match)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
 
         match_player = MatchPlayer.objects.get(match=match, player=player)
         self.assertEquals(match_player.match, match)
@@ -505,7 +1015,7 @@ class ViewTests(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.context['match'], match)
         self.assertEquals(response.context['player'], inviter)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
 
         guest = Guest.objects.get(match=match, inviting_player=inviter, name=post_data['guest'])
         self.assertTrue(guest.inviting_date != None)
@@ -582,7 +1092,81 @@ class ViewTests(TestCase):
 
         # user should be redirected to match
         self.assertEquals(response.context['match'], match2)
-        self.assertEquals(response.templates[0].name, 'core/match.html')
+        self.assertTemplateUsed(response, 'core/match.html')
+
+
+    def test_waitlist_views(self):
+        """
+        Players joining a full match should wait for a seat, and be given the
+        seats freed by players leaving or guests being removed in order.
+        Guests should only take free seats.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Full',
+            capacity=2)
+        players = [Player.objects.create(name='Waiting %i' % i, email='waiting%i@email.com' % i) for i in range(5)]
+        c = Client()
+        join = lambda player: c.get('/matches/%d/join/%d/' % (match.id, player.id), follow=True)
+        leave = lambda player: c.get('/matches/%d/leave/%d/' % (match.id, player.id), follow=True)
+
+        join(players[0])
+        c.post('/matches/%d/addguest/' % match.id, {'guest': 'Early Guest', 'inviting_player': players[0].id})
+        response = join(players[1])
+        self.assertFalse(MatchPlayer.objects.filter(match=match, player=players[1]).exists())
+        self.assertTrue('quedaste en la lista de espera' in response.content.decode('utf-8'))
+        self.assertTrue(response.context['waiting'])
+        self.assertTrue('Salir de la lista de espera' in response.content.decode('utf-8'))
+        join(players[2])
+        join(players[3])
+        self.assertEquals(list(match.waitlist.values_list('player', flat=True)),
+            [players[1].id, players[2].id, players[3].id])
+
+        # joining again changes nothing, the match is full for guests
+        mail.outbox = []
+        response = join(players[2])
+        self.assertTrue('quedaste en la lista de espera' in response.content.decode('utf-8'))
+        c.post('/matches/%d/addguest/' % match.id, {'guest': 'Late Guest', 'inviting_player': players[0].id})
+        self.assertEquals(match.guests.count(), 1)
+        self.assertEquals(len(mail.outbox), 0)
+
+        # the first waiting player takes the seat of a leaving player, and
+        # waiting players can leave the waitlist
+        leave(players[0])
+        self.assertEquals(list(match.players.all()), [players[1]])
+        self.assertTrue(len(mail.outbox) > 0)
+        leave(players[2])
+        self.assertEquals(list(match.waitlist.values_list('player', flat=True)), [players[3].id])
+
+        # removing a guest gives its seat away too
+        c.get('/removeguest/%i/' % match.guests.get().id)
+        self.assertEquals(set(match.players.all()), set([players[1], players[3]]))
+        match = Match.objects.get(id=match.id)
+        self.assertEquals((match.players_count, match.guests_count, match.waiting_count), (2, 0, 0))
+
+        # a free seat is taken right away
+        leave(players[1])
+        join(players[4])
+        self.assertEquals(set(match.players.all()), set([players[3], players[4]]))
+
+
+    def test_remove_guest_twice(self):
+        """
+        Removing the same guest twice (e.g. from simultaneous requests) should
+        free its seat once.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Twice',
+            capacity=2)
+        players = [Player.objects.create(name='Twice %i' % i, email='twice%i@email.com' % i) for i in range(3)]
+        seats.join(match, players[0])
+        guest = seats.add_guest(match, players[0], 'Twice Guest')
+        seats.join(match, players[1])
+        seats.join(match, players[2])
+        stale_guest = Guest.objects.get(id=guest.id)
+
+        self.assertEquals(seats.remove_guest(guest), (True, [players[1]]))
+        self.assertEquals(seats.remove_guest(stale_guest), (False, []))
+        match = Match.objects.get(id=match.id)
+        self.assertEquals((match.players_count, match.guests_count, match.waiting_count), (2, 0, 1))
+        self.assertEquals(MatchPlayer.objects.filter(match=match).count(), 2)
 
 
     def test_send_mail_view(self):
@@ -597,6 +1181,8 @@ class ViewTests(TestCase):
         Player.objects.create(name='O Rei', email='pele@brasil.net')
 
         self.assertTrue(response.status_code == 201 or response.status_code == 204)
+        self.assertTrue('X-Fobal-Sent' in response)
+        self.assertTrue('X-Fobal-Skipped' in response)
 
         if response.status_code == 201:
             self.assertEquals(match_count + 1, Match.objects.count())
@@ -604,7 +1190,76 @@ class ViewTests(TestCase):
             self.assertEquals(match_count, Match.objects.count())
 
 
+    def test_mailer_metrics_view(self):
+        """
+        Test that mailer metrics are only available to staff.
+        """
+        c = Client()
+        response = c.get('/mailer/metrics/')
+        self.assertEquals(response.status_code, 302)
+
+        staff = User.objects.create_user('staff', 'staff@fobal.com', 'secret')
+        staff.is_staff = True
+        staff.save()
+        c.login(username='staff', password='secret')
+        match = Match.objects.create(date=datetime.datetime.now(), place='Metrics Field')
+        Player.objects.create(name='Metrics Player', email='metrics@email.com')
+        mailer.send_status_mails(match, Player.objects.all(), async=False)
+
+        response = c.get('/mailer/metrics/')
+        self.assertEquals(response.status_code, 200)
+        metrics = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(metrics['kinds']['status']['messages'] >= 1)
+        self.assertTrue('sent' in metrics['pool'])
+        self.assertEquals(metrics['scheduler']['backlog'], 0)
+
+
+    @override_settings(CURRENT_PLAYER_CACHE_TIMEOUT=3600)
     def test_current_player(self):
+        """
+        Test that current player is properly set and retrieved from a signed
+        cookie, without using the session.
+        """
+        # base case
+        c = Client()
+        response = c.get('/')
+        self.assertEquals(cookie_player_id(c), None)
+
+        # remember player
+        player = Player.objects.create(name='Jimmy Page', email='jpage@zeppelin.com')
+        response = c.get('/?player_id=%i' % player.id)
+        self.assertEquals(cookie_player_id(c), player.id)
+        self.assertEquals(response.context['player'], player)
+
+        # player is remembered and cached
+        with self.assertNumQueries(1):
+            response = c.get('/')
+        self.assertEquals(response.context['player'].name, 'Jimmy Page')
+        self.assertFalse(settings.SESSION_COOKIE_NAME in c.cookies)
+
+        # renamed player
+        player.name = 'James Page'
+        player.save()
+        self.assertEquals(c.get('/').context['player'].name, 'James Page')
+
+        # without the cache, changes made by other workers are seen
+        with override_settings(CURRENT_PLAYER_CACHE_TIMEOUT=0):
+            Player.objects.filter(id=player.id).update(name='Jimmy Page')
+            self.assertEquals(c.get('/').context['player'].name, 'Jimmy Page')
+
+        # tampered cookie
+        c.cookies[currentplayer.COOKIE_NAME] = c.cookies[currentplayer.COOKIE_NAME].value.replace(':', ':1', 1)
+        self.assertFalse('player' in c.get('/').context)
+
+        # forget player if bad id
+        c.get('/?player_id=%i' % player.id)
+        response = c.get('/?player_id=12345')
+        self.assertFalse('player' in response.context)
+        self.assertEquals(cookie_player_id(c), None)
+
+
+    @override_settings(CURRENT_PLAYER_STORAGE='session')
+    def test_current_player_session(self):
         """
         Test that current player is properly set and retrieved from session.
         """
@@ -628,6 +1283,135 @@ class ViewTests(TestCase):
         response = c.get('/?player_id=12345')
         self.assertFalse('player_id' in c.session)
 
+        # players in the session are moved to the cookie
+        c.get('/?player_id=%i' % player.id)
+        with override_settings(CURRENT_PLAYER_STORAGE='cookie'):
+            self.assertEquals(c.get('/').context['player'], player)
+            self.assertEquals(cookie_player_id(c), player.id)
+        self.assertFalse('player_id' in c.session)
+
+
+    def test_purge_sessions(self):
+        """
+        purgesessions should delete expired sessions only.
+        """
+        now = datetime.datetime.now()
+        for i in range(5):
+            Session.objects.create(session_key='expired%i' % i, session_data='', expire_date=now - datetime.timedelta(days=1))
+        Session.objects.create(session_key='active', session_data='', expire_date=now + datetime.timedelta(days=1))
+        out = StringIO()
+        call_command('purgesessions', chunk_size=2, stdout=out)
+        self.assertTrue('Purged 5 expired sessions' in out.getvalue())
+        self.assertEquals(list(Session.objects.values_list('session_key', flat=True)), ['active'])
+
+
+@skipIf(connection.vendor == 'sqlite' and not connection.settings_dict['TEST'].get('NAME'),
+    'In-memory sqlite test databases lock tables instead of waiting for concurrent writers')
+class JoinConcurrencyTests(TransactionTestCase):
+    """
+    Test case subclass for joining and leaving a match from many threads.
+    """
+
+    def hammer(self, function, players, threads=8, rounds=5):
+        """
+        Calls function(match, player) for every player from every thread, the
+        given number of rounds. Returns how many calls returned True, and the
+        calls per second.
+        """
+        changed = []
+        errors = []
+
+        def run():
+            try:
+                for i in range(rounds):
+                    for player in players:
+                        if function(self.match, player):
+                            changed.append(player.id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=run) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEquals(errors, [])
+        return changed, threads * rounds * len(players) / (time.perf_counter() - start)
+
+    def test_concurrent_joins(self):
+        """
+        Simultaneous joins and leaves of the same players should neither fail
+        nor change anything twice.
+        """
+        self.match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Herd')
+        players = [Player.objects.create(name='Herd %i' % i, email='herd%i@email.com' % i) for i in range(10)]
+
+        joined, joins_per_second = self.hammer(MatchPlayer.join, players)
+        self.assertEquals(sorted(joined), [player.id for player in players])
+        self.assertEquals(MatchPlayer.objects.filter(match=self.match).count(), 10)
+        self.assertEquals(Match.objects.get(id=self.match.id).players_count, 10)
+        self.assertEquals(set(Player.objects.values_list('match_count', 'played', 'left')), set([(1, 1, 0)]))
+
+        left, leaves_per_second = self.hammer(MatchPlayer.leave, players)
+        self.assertEquals(sorted(left), [player.id for player in players])
+        self.assertEquals(Match.objects.get(id=self.match.id).players_count, 0)
+        self.assertEquals(set(Player.objects.values_list('match_count', 'played', 'left')), set([(0, 1, 1)]))
+
+        # a no-op join or leave is a single statement, so hundreds per second is
+        # a conservative floor even on sqlite
+        self.assertTrue(joins_per_second > 100, joins_per_second)
+        self.assertTrue(leaves_per_second > 100, leaves_per_second)
+
+
+    def test_concurrent_seats(self):
+        """
+        Simultaneous joins of a small match should take exactly its seats and
+        queue everybody else once, and simultaneous leaves should give every
+        freed seat to a waiting player.
+        """
+        self.match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Seats',
+            capacity=5)
+        players = [Player.objects.create(name='Seat %i' % i, email='seat%i@email.com' % i) for i in range(20)]
+
+        changed, joins_per_second = self.hammer(seats.join, players)
+        self.assertEquals(sorted(changed), [player.id for player in players])
+        match = Match.objects.get(id=self.match.id)
+        self.assertEquals((match.players_count, match.guests_count, match.waiting_count), (5, 0, 15))
+        self.assertEquals(MatchPlayer.objects.filter(match=match).count(), 5)
+
+        # the players that left first are replaced by the first waiting ones
+        waiting = list(match.waitlist.values_list('player', flat=True))
+        seated = list(match.players.values_list('id', flat=True))
+        changed, leaves_per_second = self.hammer(lambda match, player: seats.leave(match, player)[0],
+            [Player(id=player_id) for player_id in seated[:3]], rounds=1)
+        self.assertEquals(set(match.players.values_list('id', flat=True)), set(seated[3:] + waiting[:3]))
+        match = Match.objects.get(id=self.match.id)
+        self.assertEquals((match.players_count, match.waiting_count), (5, 12))
+
+        # a conservative floor, every join locks the match
+        self.assertTrue(joins_per_second > 20, joins_per_second)
+
+
+    def test_loadtest(self):
+        """
+        The loadtest command should replay the invite-day pattern against a
+        local server, report every endpoint and clean up after itself.
+        """
+        out = StringIO()
+        call_command('loadtest', players=6, clients=3, capacity=4, guest_rate=0.5, stdout=out)
+        report = out.getvalue()
+        for endpoint in ['open', 'match', 'join', 'add_guest', 'total']:
+            self.assertTrue(re.search(r'^%s +\d+ .* 0\.0%% ' % endpoint, report, re.MULTILINE), report)
+        joined, waiting, guests = map(int, re.search(
+            r'(\d+) of 6 players joined, (\d+) waiting, (\d+) guests, capacity 4$', report, re.MULTILINE).groups())
+        self.assertEquals(joined + waiting, 6)
+        self.assertEquals(joined + guests, 4)
+        self.assertEquals(Player.objects.count(), 0)
+        self.assertEquals(Match.objects.count(), 0)
+
 
 # Tasks tests
 
@@ -732,6 +1516,153 @@ class TasksTests(TestCase):
         self.assertEquals(len(mail.outbox), 0)
 
 
+    def test_send_daily_mails_twice(self):
+        """
+        Sending the daily mails again on the same day should skip players that
+        already got an email, with a single lookup.
+        """
+        for i in range(3):
+            Player.objects.create(name='Daily %i' % i, email='daily%i@email.com' % i)
+        WeeklyMatchSchedule.objects.create(
+            weekday=2,
+            time=datetime.time(19, 0, 0, 0),
+            place='Wednesday',
+            invite_weekday=0)
+
+        # Monday, invites
+        date = datetime.datetime(2015, 3, 23, 7, 15, 0, 0)
+        result = tasks.send_daily_mails(date=date, async=False)
+        self.assertEquals((result.sent, result.skipped), (3, 0))
+
+        # retried trigger
+        with self.assertNumQueries(2):
+            result = tasks.send_daily_mails(date=date + datetime.timedelta(minutes=5), async=False)
+        self.assertEquals((result.sent, result.skipped), (0, 3))
+        self.assertEquals(len(mail.outbox), 3)
+
+        # only new players get an email
+        Player.objects.create(name='Daily New', email='dailynew@email.com')
+        result = tasks.send_daily_mails(date=date, async=False)
+        self.assertEquals((result.sent, result.skipped), (1, 3))
+
+        # next day everybody gets a status email
+        result = tasks.send_daily_mails(date=date + datetime.timedelta(days=1), async=False)
+        self.assertEquals((result.sent, result.skipped), (4, 0))
+        self.assertEquals(SentEmail.objects.filter(kind=SentEmail.STATUS, day=datetime.date(2015, 3, 24)).count(), 4)
+
+
+    def test_send_daily_mails_failed(self):
+        """
+        Players whose daily email failed to send should get it when the daily
+        mails are sent again.
+        """
+        for i in range(3):
+            Player.objects.create(name='Daily %i' % i, email='daily%i@email.com' % i)
+        WeeklyMatchSchedule.objects.create(
+            weekday=2,
+            time=datetime.time(19, 0, 0, 0),
+            place='Wednesday',
+            invite_weekday=0)
+        date = datetime.datetime(2015, 3, 23, 7, 15, 0, 0)
+        previous = mailer.use_connection_pool(
+            mailer.ConnectionPool(size=1, max_idle=60, backend='core.tests.FailingEmailBackend'))
+        try:
+            with self.assertRaises(ConnectionRefusedError):
+                tasks.send_daily_mails(date=date, async=False)
+            self.assertEquals(SentEmail.objects.count(), 0)
+
+            # failed in the background (run in this thread to share the test transaction)
+            match = Match.objects.get()
+            ledger = mailer.SendLedger(match, SentEmail.STATUS, date.date())
+            players = list(Player.objects.all())
+            list(ledger.record([players]))
+            done = threading.Event()
+            mailer.EmailThread([mailer.status_message(match, players[0])], done.set, failed=ledger.release).run()
+            self.assertTrue(done.is_set())
+            self.assertEquals(SentEmail.objects.count(), 2)
+        finally:
+            mailer.use_connection_pool(previous)
+
+        result = tasks.send_daily_mails(date=date, async=False)
+        self.assertEquals((result.sent, result.skipped), (1, 2))
+        self.assertEquals(mail.outbox[0].to, [mailer.email_address(players[0])])
+
+
+    def test_send_daily_mails_partly_failed(self):
+        """
+        Only players whose daily email wasn't sent should get it when the daily
+        mails are sent again.
+        """
+        players = [Player.objects.create(name='Daily %i' % i, email=email) for i, email in
+                   enumerate(['daily0@email.com', 'reject1@email.com', 'daily2@email.com'])]
+        WeeklyMatchSchedule.objects.create(
+            weekday=2,
+            time=datetime.time(19, 0, 0, 0),
+            place='Wednesday',
+            invite_weekday=0)
+        date = datetime.datetime(2015, 3, 23, 7, 15, 0, 0)
+        previous = mailer.use_connection_pool(
+            mailer.ConnectionPool(size=1, max_idle=60, backend='core.tests.RejectingEmailBackend'))
+        try:
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                tasks.send_daily_mails(date=date, async=False)
+            self.assertEquals(len(mail.outbox), 1)
+            self.assertEquals(list(SentEmail.objects.values_list('player', flat=True)), [players[0].id])
+
+            # in the background
+            SentEmail.objects.all().delete()
+            ledger = mailer.SendLedger(Match.objects.get(), SentEmail.STATUS, date.date())
+            list(ledger.record([players]))
+            messages = [mailer.status_message(Match.objects.get(), player) for player in players]
+            mailer.EmailThread(messages, failed=ledger.release).run()
+            self.assertEquals(list(SentEmail.objects.values_list('player', flat=True)), [players[0].id])
+        finally:
+            mailer.use_connection_pool(previous)
+
+    @override_settings(MAILER_INVITE_WAVE_SIZE=2, MAILER_INVITE_WAVE_INTERVAL=3600, MATCH_SIZE=2)
+    def test_send_invite_waves(self):
+        """
+        Players should be invited in waves, most frequent players first, until
+        the match is full.
+        """
+        players = [Player.objects.create(name='Wave %i' % i, email='wave%i@email.com' % i) for i in range(5)]
+        past_match = Match.objects.create(date=datetime.datetime(2015, 3, 18, 19, 0), place='Past')
+        for player in players[2:]:
+            MatchPlayer.objects.create(player=player, match=past_match)
+        WeeklyMatchSchedule.objects.create(
+            weekday=2,
+            time=datetime.time(19, 0, 0, 0),
+            place='Wednesday',
+            invite_weekday=0)
+
+        # Monday, first wave
+        date = datetime.datetime(2015, 3, 23, 7, 15, 0, 0)
+        result = tasks.send_daily_mails(date=date, async=False)
+        self.assertEquals(result.sent, 2)
+        self.assertEquals(sorted(m.to[0] for m in mail.outbox), ['Wave 2 <wave2@email.com>', 'Wave 3 <wave3@email.com>'])
+        match = Match.objects.get(id=result.match.id)
+        self.assertEquals(match.next_invite_wave, date + datetime.timedelta(hours=1))
+
+        # nothing is due yet
+        self.assertEquals(tasks.send_invite_waves(date + datetime.timedelta(minutes=30), async=False), 0)
+
+        # second wave
+        self.assertEquals(tasks.send_invite_waves(date + datetime.timedelta(hours=1), async=False), 2)
+        self.assertEquals(sorted(m.to[0] for m in mail.outbox[2:]), ['Wave 0 <wave0@email.com>', 'Wave 4 <wave4@email.com>'])
+        self.assertEquals(Match.objects.get(id=match.id).next_invite_wave, datetime.datetime(2015, 3, 23, 9, 15))
+
+        # the match is full, so there are no more waves
+        MatchPlayer.objects.create(player=players[2], match=match)
+        Guest.objects.create(name='Wave guest', inviting_player=players[2], match=match)
+        self.assertEquals(tasks.send_invite_waves(date + datetime.timedelta(hours=2), async=False), 0)
+        self.assertEquals(Match.objects.get(id=match.id).next_invite_wave, None)
+        self.assertEquals(len(mail.outbox), 4)
+
+        # status emails only go to invited players
+        result = tasks.send_daily_mails(date=date + datetime.timedelta(days=1), async=False)
+        self.assertEquals(result.sent, 4)
+
+
 # Mailer tests
 
 class MailerTests(TestCase):
@@ -979,6 +1910,119 @@ class MailerTests(TestCase):
         mailer.send_status_mails(match, Player.objects.all(), async=False)
         self.assertEquals(len(mail.outbox), 2)
 
+    def test_batch_stats(self):
+        """
+        Test that sent batches are timed and counted per kind.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Stats Field')
+        Player.objects.create(name='Stats One', email='stats1@email.com')
+        Player.objects.create(name='Stats Two', email='stats2@email.com')
+        before = mailer.STATS.snapshot().get('invite', {'batches': 0, 'messages': 0, 'failures': 0})
+
+        mailer.send_invite_mails(match, Player.objects.all(), async=False)
+
+        after = mailer.STATS.snapshot()['invite']
+        self.assertEquals(after['batches'], before['batches'] + 1)
+        self.assertEquals(after['messages'], before['messages'] + 2)
+        self.assertEquals(after['failures'], before['failures'])
+        self.assertEquals(after['last_batch']['messages'], 2)
+        self.assertEquals(set(after['seconds'].keys()), set(mailer.PHASES))
+        self.assertTrue(after['last_batch']['ms']['render'] > 0)
+
+        # failures are counted too
+        timer = mailer.BatchTimer('failing')
+        pool = mailer.ConnectionPool(1, 60, backend='core.tests.FailingEmailBackend')
+        with self.assertRaises(ConnectionRefusedError):
+            pool.send_messages([mailer.status_message(match, Player.objects.first())], timer)
+        timer.finish()
+        self.assertEquals(mailer.STATS.snapshot()['failing']['failures'], 1)
+
+    @override_settings(MAILER_BROADCAST=True, MAILER_BROADCAST_CHUNK=2)
+    def test_broadcast_mails(self):
+        """
+        Broadcast status and invite emails should be rendered once and sent to
+        chunks of players in BCC, with links to the match landing page.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Broadcast Field')
+        for i in range(5):
+            Player.objects.create(name='Broadcast %i' % i, email='broadcast%i@email.com' % i)
+
+        self.assertEquals(mailer.send_status_mails(match, Player.objects.all(), async=False), 5)
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertEquals([len(msg.bcc) for msg in mail.outbox], [2, 2, 1])
+        self.assertEquals(set(address for msg in mail.outbox for address in msg.bcc),
+            set(mailer.email_address(player) for player in Player.objects.all()))
+        msg = mail.outbox[0]
+        self.assertEquals(msg.to, [])
+        self.assertEquals(msg.message()['To'], 'undisclosed-recipients:;')
+        self.assertTrue('Hola,' in msg.body)
+        self.assertFalse('Broadcast 0' in msg.body)
+        self.assertTrue(absolute_url('/matches/%i/me/' % match.id) in msg.body)
+        self.assertFalse('player_id' in msg.body)
+        mail.outbox = []
+
+        self.assertEquals(mailer.send_invite_mails(match, Player.objects.all(), async=False), 5)
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertTrue(absolute_url('/matches/%i/me/?action=join' % match.id) in mail.outbox[0].body)
+        self.assertTrue(absolute_url('/matches/%i/me/?action=leave' % match.id) in mail.outbox[0].alternatives[0][0])
+
+    def test_send_status_mails_queries(self):
+        """
+        Sending status messages should take the same number of queries regardless
+        of the number of players.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Status Field')
+        players = [Player.objects.create(name='Status %i' % i, email='status%i@email.com' % i) for i in range(6)]
+        match.matchplayer_set.create(player=players[0])
+        match.guests.create(name='Guest', inviting_player=players[0])
+
+        with self.assertNumQueries(2):
+            mailer.send_status_mails(match, players[:2], async=False)
+        with self.assertNumQueries(2):
+            mailer.send_status_mails(match, players, async=False)
+        self.assertEquals(len(mail.outbox), 8)
+        self.assertTrue('2 jugadores' in mail.outbox[-1].body)
+
+
+    @override_settings(MAILER_CHUNK_SIZE=2)
+    def test_send_status_mails_chunked(self):
+        """
+        Status messages for a queryset of players should be created and sent in
+        chunks, paginating players by id.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Status Field')
+        for i in range(5):
+            Player.objects.create(name='Status %i' % i, email='status%i@email.com' % i)
+
+        self.assertEquals([len(chunk) for chunk in mailer.chunked(Player.objects.all(), 2)], [2, 2, 1])
+        self.assertEquals([chunk for chunk in mailer.chunked(range(5), 3)], [[0, 1, 2], [3, 4]])
+
+        # 2 for the match snapshot, 1 per chunk and 1 more to find the end
+        with self.assertNumQueries(6):
+            sent = mailer.send_status_mails(match, Player.objects.all(), async=False)
+        self.assertEquals(sent, 5)
+        self.assertEquals(len(mail.outbox), 5)
+        self.assertEquals(len(set(tuple(m.to) for m in mail.outbox)), 5)
+
+        out = StringIO()
+        call_command('benchmark', 'memory', players=[10], stdout=out)
+        self.assertTrue('MB peak' in out.getvalue())
+        self.assertEquals(Player.objects.count(), 5)
+
+
+    @override_settings(MAILER_CHUNK_SIZE=2, MAILER_RENDER_PROCESSES=2)
+    def test_send_invite_mails_render_processes(self):
+        """
+        Invite messages rendered in a process pool should be sent in order.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Pool')
+        players = [Player.objects.create(name='Pool %i' % i, email='pool%i@email.com' % i) for i in range(5)]
+
+        self.assertEquals(mailer.send_invite_mails(match, players, async=False), 5)
+        self.assertEquals([m.to for m in mail.outbox], [[mailer.email_address(p)] for p in players])
+        self.assertTrue(join_match_url(match, players[4]) in mail.outbox[4].body)
+
+
     def test_send_mail_async(self):
         """
         Test async mail sending.
@@ -990,6 +2034,364 @@ class MailerTests(TestCase):
         mailer.send_status_mails(match, Player.objects.all(), async=True)
         # TODO: assert something, for now just making sure no exceptions are thrown
 
+    def test_message_template(self):
+        """
+        Messages created from a message template should be the same as fully
+        rendering the email templates for each player, escaping included.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Template & Co')
+        player = Player.objects.create(name="O'Neill & <Sons>", email='oneill@email.com')
+        context = Context({
+            'player': player,
+            'match': mailer.MatchSnapshot.of(match),
+            'match_url': absolute_url(match_url(match, player)),
+            'join_match_url': absolute_url(join_match_url(match, player)),
+            'leave_match_url': absolute_url(leave_match_url(match, player)),
+        })
+
+        template = mailer.invite_template(match)
+        msg = template.message(player)
+        self.assertEquals(msg.body, get_template('core/match_invite_email.txt').render(context))
+        self.assertEquals(msg.alternatives[0][0], get_template('core/match_invite_email.html').render(context))
+        self.assertTrue('O&#39;Neill &amp; &lt;Sons&gt;' in msg.body)
+
+        # templates are compiled once per process
+        self.assertIs(mailer.email_template('core/match_invite_email.txt'), mailer.email_template('core/match_invite_email.txt'))
+
+        out = StringIO()
+        call_command('benchmark', 'render', players=[3], repeat=1, stdout=out)
+        self.assertTrue('Speedup' in out.getvalue())
+
+
+    @override_settings(MAILER_DIGEST_WINDOW=60)
+    def test_roster_digest_mails(self):
+        """
+        Roster changes should be coalesced into one digest per player when
+        MAILER_DIGEST_WINDOW is set.
+        """
+        match = Match.objects.create(date=datetime.datetime.now() + datetime.timedelta(days=1), place='Digest')
+        players = [Player.objects.create(name='Digest %i' % i, email='digest%i@email.com' % i) for i in range(4)]
+        c = Client()
+        for player in players:
+            c.get('/matches/%d/join/%d/' % (match.id, player.id))
+        c.get('/matches/%d/leave/%d/' % (match.id, players[3].id))
+        c.post('/matches/%d/addguest/' % match.id, {'inviting_player': players[0].id, 'guest': 'Invitee'})
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(RosterEvent.objects.count(), 6)
+
+        # not due yet
+        self.assertEquals(mailer.send_roster_digest_mails(async=False), 0)
+
+        now = datetime.datetime.now() + datetime.timedelta(seconds=61)
+        self.assertEquals(mailer.send_roster_digest_mails(now=now, async=False), 3)
+        self.assertEquals(RosterEvent.objects.count(), 0)
+        self.assertEquals(len(mail.outbox), 3)
+
+        digest = [m for m in mail.outbox if m.to == [mailer.email_address(players[1])]][0]
+        self.assertTrue('Juegan: Digest 0, Digest 2' in digest.body)
+        self.assertTrue('Digest 0 invitó a Invitee' in digest.body)
+        self.assertFalse('Digest 3' in digest.body, 'Joining and leaving should cancel out')
+        self.assertFalse('Digest 1' in digest.body.replace('Hola Digest 1', ''), 'Own changes should be left out')
+        self.assertTrue('Hay 4 jugadores' in digest.body)
+
+        self.assertEquals(mailer.send_roster_digest_mails(now=now, async=False), 0)
+
+        # failed digests are kept for the next run
+        c.get('/matches/%d/leave/%d/' % (match.id, players[2].id))
+        previous = mailer.use_connection_pool(
+            mailer.ConnectionPool(size=1, max_idle=60, backend='core.tests.FailingEmailBackend'))
+        try:
+            self.assertEquals(mailer.send_roster_digest_mails(now=now, async=False), 0)
+            # like the sendqueuedmail worker, without MAILER_QUEUE
+            self.assertEquals(mailer.send_roster_digest_mails(now=now), 0)
+        finally:
+            mailer.use_connection_pool(previous)
+        self.assertEquals(RosterEvent.objects.count(), 1)
+        self.assertEquals(mailer.send_roster_digest_mails(now=now, async=False), 2)
+        self.assertEquals(RosterEvent.objects.count(), 0)
+
+
+    def test_connection_pool(self):
+        """
+        Pooled connections should be reused across batches, reopened when stale,
+        and never exceed the pool size.
+        """
+        sink = SMTPSink().start()
+        self.addCleanup(sink.stop)
+        pool = mailer.ConnectionPool(size=1, max_idle=60, **sink.connection_kwargs())
+        self.addCleanup(pool.close)
+        player = Player.objects.create(name='Pool Player', email='pool@email.com')
+        match = Match.objects.create(date=datetime.datetime.now(), place='Pool')
+        messages = [mailer.status_message(match, player) for i in range(3)]
+
+        self.assertEquals(pool.send_messages(messages), 3)
+        self.assertEquals(pool.send_messages(messages), 3)
+        self.assertEquals(pool.stats(), {'handshakes': 1, 'sent': 6})
+
+        # the server drops the idle connection
+        connection, last_used = pool._idle[0]
+        connection.connection.close()
+        self.assertEquals(pool.send_messages(messages), 3)
+        self.assertEquals(pool.stats(), {'handshakes': 2, 'sent': 9})
+
+        sink.max_open_connections = sink.open_connections
+        threads = [threading.Thread(target=pool.send_messages, args=(messages,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(pool.stats()['sent'], 21)
+        self.assertEquals(sink.messages, 21)
+        self.assertEquals(sink.max_open_connections, 1)
+
+
+    def test_rate_limited_pool(self):
+        """
+        Pooled sends should respect the rate limits, and retry throttled
+        messages at a lower concurrency.
+        """
+        bucket = TokenBucket(10)
+        self.assertEquals([bucket.reserve() for i in range(10)], [0] * 10)
+        self.assertTrue(0.05 < bucket.reserve() <= 0.1)
+        self.assertEquals(TokenBucket(0).reserve(), 0)
+
+        # shared limits are counted together
+        limits = [SharedRateLimit(3, 3600), SharedRateLimit(3, 3600)]
+        self.assertEquals([limits[i % 2].reserve() for i in range(3)], [0] * 3)
+        self.assertTrue(0 < limits[1].reserve() <= 3600)
+        self.assertEquals(SharedRateLimit(0).reserve(), 0)
+
+        sink = SMTPSink(error_rate=0.5, seed=0).start()
+        self.addCleanup(sink.stop)
+        scheduler = SendScheduler(2, per_second=20, backoff=0)
+        pool = mailer.ConnectionPool(size=2, max_idle=60, scheduler=scheduler, retries=10, **sink.connection_kwargs())
+        self.addCleanup(pool.close)
+        player = Player.objects.create(name='Rate Player', email='rate@email.com')
+        match = Match.objects.create(date=datetime.datetime.now(), place='Rate')
+        messages = [mailer.status_message(match, player) for i in range(15)]
+
+        start = datetime.datetime.now()
+        threads = [threading.Thread(target=pool.send_messages, args=(messages,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sink.messages, 30)
+        self.assertTrue(sink.errors > 0)
+        # 20 sends in a burst, the rest at 20 per second
+        self.assertTrue(datetime.datetime.now() - start > datetime.timedelta(seconds=(30 + sink.errors - 20) / 20.0 - 0.1))
+        stats = scheduler.stats()
+        self.assertEquals(stats['throttled'], sink.errors)
+        self.assertEquals(stats['backlog'], 0)
+        self.assertTrue(stats['concurrency'] <= 2)
+
+        # gives up after the retries
+        pool.retries = 0
+        sink.error_rate = 1
+        with self.assertRaises(smtplib.SMTPDataError):
+            pool.send_messages(messages)
+        self.assertEquals(scheduler.stats()['backlog'], 0)
+
+
+    def test_smtp_sink_faults(self):
+        """
+        The SMTP sink should reject messages and refuse connections as configured,
+        and drive the smtp benchmark.
+        """
+        sink = SMTPSink(error_rate=1, max_connections=1).start()
+        self.addCleanup(sink.stop)
+        player = Player.objects.create(name='Sink Player', email='sink@email.com')
+        match = Match.objects.create(date=datetime.datetime.now(), place='Sink')
+        message = mailer.status_message(match, player)
+
+        connection = mail.get_connection(**sink.connection_kwargs())
+        connection.open()
+        self.addCleanup(connection.close)
+        with self.assertRaises(smtplib.SMTPDataError):
+            connection.send_messages([message])
+        self.assertEquals(sink.errors, 1)
+
+        with self.assertRaises(smtplib.SMTPConnectError):
+            mail.get_connection(**sink.connection_kwargs()).open()
+        self.assertEquals(sink.refused, 1)
+
+        out = StringIO()
+        call_command('benchmark', 'smtp', players=[5], repeat=1, joins=2, stdout=out)
+        self.assertTrue('emails/s' in out.getvalue())
+        self.assertTrue('Peak RSS' in out.getvalue())
+
+
+    def test_asyncio_backend(self):
+        """
+        The asyncio backend should pipeline messages over its own sessions, keep
+        sending after a rejected message, and be usable by send_mails.
+        """
+        sink = SMTPSink(seed=0).start()
+        self.addCleanup(sink.stop)
+        smtp_settings = override_settings(
+            EMAIL_BACKEND='core.asyncsmtp.EmailBackend', EMAIL_HOST=sink.host, EMAIL_PORT=sink.port,
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False, MAILER_ASYNC_CONCURRENCY=2,
+            MAILER_THROTTLE_BACKOFF=0, MAILER_THROTTLE_RETRIES=20)
+        smtp_settings.enable()
+        self.addCleanup(smtp_settings.disable)
+        player = Player.objects.create(name='Async Player', email='async@email.com')
+        match = Match.objects.create(date=datetime.datetime.now(), place='Async')
+        messages = [mailer.status_message(match, player) for i in range(5)]
+
+        backend = mail.get_connection()
+        self.assertEquals(backend.send_messages(messages), 5)
+        self.assertEquals(sink.messages, 5)
+        self.assertTrue(sink.max_open_connections <= 2)
+        self.assertEquals(backend.sender().stats(), {'handshakes': 2, 'sent': 5})
+
+        # a rejected message doesn't stop the batch
+        sink.error_rate = 0.5
+        sink.error_code = 550
+        with self.assertRaises(smtplib.SMTPDataError):
+            backend.send_messages(messages * 4)
+        self.assertEquals(sink.messages + sink.errors, 25)
+        self.assertEquals(backend.sender().stats()['handshakes'], 2)
+
+        # throttled messages are retried
+        sink.error_code = 451
+        errors = sink.errors
+        self.assertEquals(backend.send_messages(messages), 5)
+        self.assertEquals(backend.sender().scheduler.stats()['throttled'], sink.errors - errors)
+        sink.error_rate = 0
+
+        # sends are limited by the concurrency of the scheduler
+        scheduler = SendScheduler(1)
+        acquire = scheduler.acquire
+        active = []
+        def acquired():
+            acquire()
+            active.append(scheduler.active)
+        scheduler.acquire = acquired
+        sender = AsyncSMTPSender(sink.host, sink.port, concurrency=2, scheduler=scheduler)
+        self.addCleanup(sender.close)
+        self.assertEquals(sender.submit(messages).result(), (5, []))
+        self.assertEquals(active, [1] * 5)
+        self.assertEquals(scheduler.stats()['active'], 0)
+
+        sent = sink.messages
+        mailer.send_mails(messages, async=False)
+        self.assertEquals(sink.messages, sent + 5)
+        done = threading.Event()
+        mailer.send_in_background(messages, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEquals(sink.messages, sent + 10)
+
+        with self.assertRaises(ImproperlyConfigured):
+            mail.get_connection(use_tls=True)
+
+        out = StringIO()
+        call_command('benchmark', 'backends', players=[2], batches=2, stdout=out)
+        self.assertTrue('asyncio' in out.getvalue())
+
+
+    @override_settings(MAILER_QUEUE=True)
+    def test_queued_mails(self):
+        """
+        Async mails should be queued when MAILER_QUEUE is set, and sent by
+        send_queued_mails.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Queue')
+        p1 = Player.objects.create(name='Queue One', email='queue1@email.com')
+        p2 = Player.objects.create(name='Queue Two', email='queue2@email.com')
+
+        mailer.send_invite_mails(match, [p1, p2])
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(OutboundEmail.objects.filter(status=OutboundEmail.PENDING).count(), 2)
+
+        self.assertEquals(mailer.send_queued_mails(batch_size=10), (2, 0))
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(mail.outbox[0].to, [mailer.email_address(p1)])
+        self.assertTrue(join_match_url(match, p1) in mail.outbox[0].body)
+        self.assertEquals(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertEquals(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 2)
+        self.assertEquals(mailer.send_queued_mails(batch_size=10), (0, 0))
+
+        mailer.send_status_mails(match, [p1])
+        call_command('sendqueuedmail', once=True)
+        self.assertEquals(len(mail.outbox), 3)
+
+        # without the queue, digests or invite waves the worker has nothing to do
+        mailer.send_status_mails(match, [p1])
+        out = StringIO()
+        with self.settings(MAILER_QUEUE=False, MAILER_DIGEST_WINDOW=0, MAILER_INVITE_WAVE_SIZE=0):
+            call_command('sendqueuedmail', stdout=out)
+        self.assertTrue('Nothing to send' in out.getvalue())
+        self.assertEquals(len(mail.outbox), 3)
+
+
+    @override_settings(MAILER_QUEUE=True, MAILER_BROADCAST=True, MAILER_BROADCAST_CHUNK=10)
+    def test_queued_broadcast_mails(self):
+        """
+        Queued broadcast mails should keep their BCC recipients.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Queue')
+        players = [Player.objects.create(name='Queue %i' % i, email='queue%i@email.com' % i) for i in range(3)]
+
+        mailer.send_status_mails(match, players)
+        email = OutboundEmail.objects.get()
+        self.assertEquals(email.to, '')
+        self.assertEquals(email.recipients(), [mailer.email_address(player) for player in players])
+
+        self.assertEquals(mailer.send_queued_mails(batch_size=10), (1, 0))
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].to, [])
+        self.assertEquals(mail.outbox[0].bcc, [mailer.email_address(player) for player in players])
+
+
+    @override_settings(MAILER_QUEUE=True, MAILER_RETRY_DELAY=10, MAILER_MAX_ATTEMPTS=2)
+    def test_queued_mails_retry(self):
+        """
+        Failed queued mails should be retried with backoff, and marked as dead
+        after MAILER_MAX_ATTEMPTS.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Queue')
+        player = Player.objects.create(name='Queue One', email='queue1@email.com')
+        mailer.send_status_mails(match, [player])
+        pool = mailer.ConnectionPool(size=1, max_idle=60, backend='core.tests.FailingEmailBackend')
+
+        self.assertEquals(mailer.send_queued_mails(batch_size=10, pool=pool), (0, 1))
+        email = OutboundEmail.objects.get()
+        self.assertEquals(email.status, OutboundEmail.PENDING)
+        self.assertEquals(email.attempts, 1)
+        self.assertTrue('SMTP server is down' in email.last_error)
+        self.assertGreater(email.next_attempt, datetime.datetime.now())
+
+        # not due yet
+        self.assertEquals(mailer.send_queued_mails(batch_size=10, pool=pool), (0, 0))
+
+        email.next_attempt = datetime.datetime.now()
+        email.save()
+        self.assertEquals(mailer.send_queued_mails(batch_size=10, pool=pool), (0, 1))
+        email = OutboundEmail.objects.get()
+        self.assertEquals(email.status, OutboundEmail.DEAD)
+        self.assertEquals(email.attempts, 2)
+
+
+    @override_settings(MAILER_QUEUE=True)
+    def test_queued_mails_claimed(self):
+        """
+        Queued mails being sent by a worker should not be sent by others.
+        """
+        match = Match.objects.create(date=datetime.datetime.now(), place='Queue')
+        player = Player.objects.create(name='Queue One', email='queue1@email.com')
+        mailer.send_status_mails(match, [player])
+        concurrent = []
+
+        class ConcurrentPool(object):
+            def send_messages(self, messages, timer=mailer.NULL_TIMER):
+                concurrent.append(mailer.send_queued_mails(batch_size=10))
+                mail.outbox.extend(messages)
+
+        self.assertEquals(mailer.send_queued_mails(batch_size=10, pool=ConcurrentPool()), (1, 0))
+        self.assertEquals(concurrent, [(0, 0)])
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(OutboundEmail.objects.get().status, OutboundEmail.SENT)
+
 
 # URL helper tests
 
@@ -1245,3 +2647,87 @@ class WeeklyMatchScheduleTests(TestCase):
 
         schedule = WeeklyMatchSchedule.invite_weekday_schedule(fri)
         self.assertIsNone(schedule, schedule)
+
+
+# Logging tests
+
+class BlockingHandler(logging.Handler):
+    """
+    Handler that records handled records, blocking until released.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.released = threading.Event()
+
+    def emit(self, record):
+        self.released.wait()
+        self.records.append(record)
+
+
+class BackgroundHandlerTests(TestCase):
+    """
+    Test case subclass for the loghandlers module.
+    """
+
+    def test_background_handler(self):
+        """
+        Records should be handled in the background, de-duplicated, dropped when
+        the buffer is full and flushed on close.
+        """
+        handler = BackgroundHandler(BlockingHandler, capacity=2, window=60)
+        logger = logging.getLogger('core.tests.background')
+        logger.propagate = False
+        logger.addHandler(handler)
+        same_error = lambda: logger.error('Same error')
+        try:
+            # logging doesn't wait for the blocked target
+            logger.error('Error %i', 0)
+            while not handler.queue.empty():
+                time.sleep(0.01)
+            for i in range(3):
+                same_error()
+            logger.error('Error %i', 1)
+            logger.error('Error %i', 2)
+            self.assertEquals(handler.dropped, 1)
+            self.assertEquals(list(handler.suppressed.values()), [2])
+            handler.target.released.set()
+            handler.queue.join()
+
+            # duplicates after the window
+            handler._last_seen = {}
+            same_error()
+            logger.error('Error %i', 3)
+        finally:
+            handler.target.released.set()
+            logger.removeHandler(handler)
+            handler.close()
+
+        self.assertEquals([record.getMessage() for record in handler.target.records], [
+            'Error 0', 'Same error', 'Error 1', 'Same error (2 similar errors suppressed)', 'Error 3'])
+
+
+    @override_settings(ADMINS=[('Admin', 'admin@fobal.com')])
+    def test_background_admin_emails(self):
+        """
+        Request details should be rendered on the logging thread, and the
+        request not handed to the background thread.
+        """
+        handler = BackgroundHandler(AdminEmailHandler, window=60)
+        logger = logging.getLogger('core.tests.background')
+        logger.propagate = False
+        logger.addHandler(handler)
+        request = RequestFactory().get('/matches/1/', REMOTE_ADDR='10.0.0.1')
+        try:
+            prepared = handler.prepare(logging.makeLogRecord({'msg': 'Prepared', 'request': request, 'suppressed': 0}))
+            self.assertFalse(hasattr(prepared, 'request'))
+            logger.error('Internal Server Error: %s', request.path, extra={'request': request})
+            handler.queue.join()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertTrue('ERROR (EXTERNAL IP): Internal Server Error: /matches/1/' in mail.outbox[0].subject)
+        self.assertTrue("path:/matches/1/" in mail.outbox[0].body)
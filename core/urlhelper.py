@@ -28,6 +28,18 @@ def leave_match_url(match, player):
     return reverse('leave_match', args=[match.id, player.id])
 
 
+def match_landing_url(match, action=None):
+    """
+    Relative URL of the landing page for the given match, where players are
+    identified and then redirected to the match, or to join or leave it if
+    `action` is 'join' or 'leave'.
+    """
+    url = reverse('match_landing', args=[match.id])
+    if action != None:
+        url += '?action=%s' % action
+    return url
+
+
 def match_url(match, player = None):
     """
     Relative URL for the given match and the given player.
@@ -8,12 +8,15 @@ from core import views, api
 
 urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
+    url(r'^players/$', views.leaderboard, name='leaderboard'),
     url(r'^matches/(?P<match_id>\d+)/$', views.match, name='match'),
+    url(r'^matches/(?P<match_id>\d+)/me/$', views.match_landing, name='match_landing'),
     url(r'^matches/(?P<match_id>\d+)/join/(?P<player_id>\d+)/$', views.join_match, name='join_match'),
     url(r'^matches/(?P<match_id>\d+)/leave/(?P<player_id>\d+)/$', views.leave_match, name='leave_match'),
     url(r'^matches/(?P<match_id>\d+)/addguest/$', views.add_guest, name='add_guest'),
     url(r'^removeguest/(?P<guest_id>\d+)/$', views.remove_guest, name='remove_guest'),
     url(r'^sendmail/$', views.send_mail, name='send_mail'),
+    url(r'^mailer/metrics/$', views.mailer_metrics, name='mailer_metrics'),
     url(r'^api/', include(api.router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 )
@@ -3,18 +3,26 @@ Django views module.
 """
 
 import logging
+import hashlib
 from datetime import datetime
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotAllowed
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotAllowed, JsonResponse, Http404
+from django.core.paginator import Paginator, InvalidPage
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from core.models import Match, Player, MatchPlayer, Guest
-from core import mailer, tasks
+from core.models import Match, Player, Guest, SiteStatistics
+from core import mailer, tasks, fragments, currentplayer, seats
 from core.urlhelper import match_url, join_match_url, leave_match_url
 
 
 LOGGER = logging.getLogger(__name__)
 
+LEADERBOARD_PAGE_SIZE = 20
+
 
 # TODO: use generic views?
 
@@ -22,21 +30,11 @@ LOGGER = logging.getLogger(__name__)
 def current_player(request):
     """
     Get current player for the request.
-    If player_id in GET parameters then set player_id in session,
-    else try to get player_id from session.
+    If player_id in GET parameters then remember that player, else use the
+    player remembered by previous requests (see core.currentplayer).
     Return player with id = player_id, or None.
     """
-    if 'player_id' in request.GET:
-        request.session['player_id'] = int(request.GET['player_id'])
-
-    if 'player_id' in request.session:
-        try:
-            return Player.objects.get(id=request.session['player_id'])
-        except Player.DoesNotExist:
-            LOGGER.info('Player does not exist, removing from session: %s' % request.session['player_id'])
-            del request.session['player_id']
-    else:
-        return None
+    return currentplayer.resolve(request)
 
 
 def set_current_player(request, context):
@@ -55,11 +53,12 @@ def index(request):
     if request.method != 'GET':
         return HttpResponseNotAllowed(['GET'])
 
+    stats = SiteStatistics.current()
     context = {
-        'match_count': Match.objects.count(),
-        'player_count': Player.objects.count(),
-        'top_player': Player.top_player(),
-        'next_match': Match.next_match(datetime.now()),
+        'match_count': stats.match_count,
+        'player_count': stats.player_count,
+        'top_player': stats.top_player,
+        'next_match': stats.next_match,
     }
 
     set_current_player(request, context)
@@ -67,16 +66,80 @@ def index(request):
     return render(request, 'core/index.html', context)
 
 
+def leaderboard(request):
+    """
+    View for the players leaderboard, most frequent players first, in pages of
+    LEADERBOARD_PAGE_SIZE players.
+    Returns 404 if the page GET parameter is not a valid page.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    paginator = Paginator(Player.leaderboard(), LEADERBOARD_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404('No such page')
+
+    context = {'page': page}
+
+    set_current_player(request, context)
+
+    return render(request, 'core/leaderboard.html', context)
+
+
+def requested_match(request, match_id):
+    """
+    Returns the match with the given match_id, or None, looked up once per
+    request.
+    """
+    if not hasattr(request, 'requested_match'):
+        request.requested_match = Match.objects.filter(pk=match_id).first()
+    return request.requested_match
+
+
+def match_validators(request, match_id):
+    """
+    Returns the ETag and last modified date of the match page for the request,
+    from the version of the match, or (None, None) if the page
+    shouldn't be revalidated (the match doesn't exist, the player is being set,
+    or there are messages to show).
+    The ETag depends on the current player too, and on whether the match has
+    been played.
+    """
+    if not hasattr(request, 'match_validators'):
+        validators = (None, None)
+        if 'player_id' not in request.GET and CookieStorage.cookie_name not in request.COOKIES:
+            match = requested_match(request, match_id)
+            if match != None:
+                player = current_player(request)
+                key = '%s-%s-%s' % (match.etag(), match.date > datetime.now(),
+                    '%i-%s' % (player.id, player.name) if player != None else '')
+                validators = (hashlib.md5(key.encode('utf-8')).hexdigest(), match.modified)
+        request.match_validators = validators
+    return request.match_validators
+
+
+@cache_control(private=True, max_age=0, must_revalidate=True)
+@condition(etag_func=lambda request, match_id: match_validators(request, match_id)[0],
+    last_modified_func=lambda request, match_id: match_validators(request, match_id)[1])
 def match(request, match_id):
     """
     View for displaying a match with the given match_id.
     If the match does not exist returns 404.
     Any player stored in the session is set to the context.
+    The roster and guests are shared by all players and cached (see
+    core.fragments), the join/leave buttons and links for removing guests are
+    rendered on top for the current player.
+    Returns 304 if the page didn't change since the ETag or date in the request
+    (see match_validators).
     """
     if request.method != 'GET':
         return HttpResponseNotAllowed(['GET'])
 
-    match = get_object_or_404(Match, pk=match_id)
+    match = requested_match(request, match_id)
+    if match == None:
+        raise Http404('No such match')
     context = {'match': match}
 
     set_current_player(request, context)
@@ -85,25 +148,65 @@ def match(request, match_id):
         # clean URL after setting current player in session
         return HttpResponseRedirect(match_url(match))
 
+    fragment = fragments.match_fragment(match)
+    context['roster_html'] = fragment.roster
+    context['guests_html'] = fragment.guests
+    context['waitlist_html'] = fragment.waitlist
+
     player = context.get('player', None)
     if player != None:
-        if player.can_join(match):
-            context['join_match_url'] = join_match_url(match, player)
-        elif player.can_leave(match):
-            context['leave_match_url'] = leave_match_url(match, player)
+        context['waiting'] = fragment.is_waiting(player)
+        if match.date > datetime.now():
+            if not fragment.has_player(player) and not context['waiting']:
+                context['join_match_url'] = join_match_url(match, player)
+            else:
+                context['leave_match_url'] = leave_match_url(match, player)
+        context['guests_html'] = fragment.guests_for(player)
 
     return render(request, 'core/match.html', context)
 
 
+def match_landing(request, match_id):
+    """
+    Landing page for the links in broadcast emails, which are the same for all
+    players.
+    The current player is used, or asked for their email, and then
+    redirected to the match, or to join or leave it if the action GET parameter
+    is join or leave.
+    If the match does not exist returns 404.
+    """
+    match = get_object_or_404(Match, pk=match_id)
+    player = current_player(request)
+
+    if player == None and request.method == 'POST':
+        try:
+            player = Player.objects.get(email__iexact=request.POST.get('email', '').strip())
+            currentplayer.remember(request, player.id)
+        except Player.DoesNotExist:
+            messages.error(request, 'No encontramos a nadie con ese email')
+
+    if player == None:
+        return render(request, 'core/match_landing.html', {'match': match})
+
+    action = request.GET.get('action', None)
+    if action == 'join':
+        return HttpResponseRedirect(join_match_url(match, player))
+    elif action == 'leave':
+        return HttpResponseRedirect(leave_match_url(match, player))
+    else:
+        return HttpResponseRedirect(match_url(match))
+
+
 def join_match(request, match_id, player_id):
     """
     View for joining a match.
     Adds the player with the given player_id to the match with the given
-    match_id, and redirects to the match view upon success.
+    match_id, or to its waitlist if the match is full (see core.seats), and
+    redirects to the match view upon success.
     If match or player do not exist it returns 404.
     If match has already been played returns 400.
-    If player was already in the match it does nothing.
-    Emails are sent to the match players.
+    If player was already in the match or waiting it does nothing.
+    Emails are sent to the match players if the player joined.
     """
     if request.method != 'GET':
         return HttpResponseNotAllowed(['GET'])
@@ -119,13 +222,17 @@ def join_match(request, match_id, player_id):
 
     player = get_object_or_404(Player, pk=player_id)
 
-    if not MatchPlayer.objects.filter(match=match, player=player).exists():
-        match_player = MatchPlayer(match=match, player=player)
-        match_player.save()
+    joined = seats.join(match, player)
+    if joined == seats.JOINED:
         sent_mails = mailer.send_join_mails(match, player)
         LOGGER.info('%s joined %s, sent %i email(s)' % (player, match, sent_mails))
+    elif joined == seats.WAITING:
+        LOGGER.info('%s is waiting for %s' % (player, match))
 
-    messages.success(request, 'Estás anotado para el partido!')
+    if joined == seats.WAITING or (joined == None and match.waitlist.filter(player=player).exists()):
+        messages.warning(request, 'El partido está lleno, quedaste en la lista de espera')
+    else:
+        messages.success(request, 'Estás anotado para el partido!')
 
     return HttpResponseRedirect(match_url(match, player))
 
@@ -134,11 +241,13 @@ def leave_match(request, match_id, player_id):
     """
     View for leaving a match.
     Removes the player with the given player_id from the match with the given
-    match_id, and redirects to the match view upon success.
+    match_id, or from its waitlist, and redirects to the match view upon
+    success. The seat is given to the first waiting player.
     If match or player do not exist it returns 404.
     If match has already been played returns 400.
     If player had not joined the match, nothing happens.
-    Emails are sent to the match players.
+    Emails are sent to the match players if the player left or another one was
+    given the seat.
     """
     if request.method != 'GET':
         return HttpResponseNotAllowed(['GET'])
@@ -154,14 +263,17 @@ def leave_match(request, match_id, player_id):
 
     player = get_object_or_404(Player, pk=player_id)
 
-    mp = match.matchplayer_set.filter(player=player)
-    if len(mp) > 0:
-        mp.delete()
+    left, promoted = seats.leave(match, player)
+    if left == seats.LEFT:
         # TODO: send emails asyncronously
         sent_mails = mailer.send_leave_mails(match, player)
         LOGGER.info('%s left %s, sent %i email(s)' % (player, match, sent_mails))
+    seats.notify_promoted(match, promoted)
 
-    messages.success(request, 'Te bajaste del partido, gracias por avisar!')
+    if left == seats.UNQUEUED:
+        messages.success(request, 'Saliste de la lista de espera, gracias por avisar!')
+    else:
+        messages.success(request, 'Te bajaste del partido, gracias por avisar!')
 
     return HttpResponseRedirect(match_url(match, player))
 
@@ -173,6 +285,7 @@ def add_guest(request, match_id):
     Expects the guest data in the POST.
     Returns 404 if the match or the inviting_player can't be foud.
     Returns 400 if the match has already been played.
+    Guests take a seat, they are not added if the match is full.
     Emails are sent to the match players.
     """
     if request.method != 'POST':
@@ -195,8 +308,11 @@ def add_guest(request, match_id):
         messages.error(request, 'Ponga el nombre de su amigo fiera')
         return HttpResponseRedirect(match_url(match, player))
 
-    # all clear, create guest
-    guest = match.guests.create(inviting_player=player, name=request.POST['guest'])
+    # all clear, create guest if there is room
+    guest = seats.add_guest(match, player, request.POST['guest'])
+    if guest == None:
+        messages.error(request, 'El partido está lleno, no hay lugar para tu amigo')
+        return HttpResponseRedirect(match_url(match, player))
     # TODO: send emails asyncronously
     sent_mails = mailer.send_invite_guest_mails(match, player, guest)
     LOGGER.info('%s invited %s to %s, sent %i email(s)' % (player, guest, match, sent_mails))
@@ -209,7 +325,9 @@ def add_guest(request, match_id):
 def remove_guest(request, guest_id):
     """
     View for removing a guest from a match.
-    Removes the given guest from the match, and redirects to the match url.
+    Removes the given guest from the match, giving the seat to the first
+    waiting player, and redirects to the match url.
+    If the guest was removed by a simultaneous request, nothing happens.
     Returns 404 if the match or the guest can't be foud.
     Returns 400 if match has already been played.
     Emails are sent to the match players.
@@ -225,10 +343,12 @@ def remove_guest(request, guest_id):
         # TODO: use model signals and keep validation in one place
         return HttpResponse(status=400, content='El partido ya fue')
 
-    guest.delete()
+    removed, promoted = seats.remove_guest(guest)
 
-    sent_mails = mailer.send_remove_guest_mails(guest)
-    LOGGER.info('%s uninvited %s from %s, sent %i email(s)' % (guest.inviting_player, guest, guest.match, sent_mails))
+    if removed:
+        sent_mails = mailer.send_remove_guest_mails(guest)
+        LOGGER.info('%s uninvited %s from %s, sent %i email(s)' % (guest.inviting_player, guest, guest.match, sent_mails))
+        seats.notify_promoted(guest.match, promoted)
 
     messages.success(request, 'Tu amigo no juega, gracias por avisar!')
 
@@ -241,6 +361,8 @@ def send_mail(request):
     View for sending emails.
     This view is hit daily by the scheduler to create matches when needed,
     and send email notifications to players.
+    The number of emails sent and skipped (already sent that day) are returned
+    in the X-Fobal-Sent and X-Fobal-Skipped headers.
     """
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
@@ -248,9 +370,25 @@ def send_mail(request):
     async = request.POST.get('async', '') == 'true'
     LOGGER.info('Sending daily mails (aync =  %s)' % str(async))
 
-    match = tasks.create_match_or_send_status(date=datetime.now(), async=async)
+    result = tasks.send_daily_mails(date=datetime.now(), async=async)
 
-    if match != None:
-        return HttpResponse(status=201)
-    else:
-        return HttpResponse(status=204)
+    # retried triggers skip players that already got today's email
+    response = HttpResponse(status=201 if result.match != None else 204)
+    response['X-Fobal-Sent'] = result.sent
+    response['X-Fobal-Skipped'] = result.skipped
+    return response
+
+
+@staff_member_required
+def mailer_metrics(request):
+    """
+    Staff only view with the mailer metrics of this process as JSON: timings
+    and counters per kind of email batch, connection pool stats, and the rate
+    limits, concurrency and backlog of its scheduler.
+    """
+    pool = mailer.connection_pool()
+    return JsonResponse({
+        'kinds': mailer.STATS.snapshot(),
+        'pool': pool.stats(),
+        'scheduler': pool.scheduler.stats(),
+    })
@@ -51,6 +51,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'core.currentplayer.CurrentPlayerMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
@@ -67,6 +68,35 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.7/topics/cache/
+# Use a cache shared by all workers (memcached or the database) in production
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+# Data that all workers must agree on is only cached if the cache is shared
+CACHE_IS_SHARED = not CACHES['default']['BACKEND'].endswith(('.LocMemCache', '.DummyCache'))
+
+
+# Sessions and messages
+# Players are remembered in a signed cookie ('cookie') or in the session
+# ('session'), and messages are stored in cookies, so player requests don't
+# read or write the session table. Sessions (used by the admin and the API) and
+# player snapshots are cached if the cache is shared, so renamed or deleted
+# players are not shown by other workers.
+
+SESSION_ENGINE = os.environ.get('DJANGO_SESSION_ENGINE',
+    'django.contrib.sessions.backends.cached_db' if CACHE_IS_SHARED else 'django.contrib.sessions.backends.db')
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+CURRENT_PLAYER_STORAGE = os.environ.get('DJANGO_CURRENT_PLAYER_STORAGE', 'cookie')
+CURRENT_PLAYER_COOKIE_AGE = int(os.environ.get('DJANGO_CURRENT_PLAYER_COOKIE_AGE', 365 * 24 * 3600))
+CURRENT_PLAYER_CACHE_TIMEOUT = int(os.environ.get('DJANGO_CURRENT_PLAYER_CACHE_TIMEOUT', 3600 if CACHE_IS_SHARED else 0))
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -100,12 +130,75 @@ STATICFILES_STORAGE = 'whitenoise.django.GzipManifestStaticFilesStorage'
 
 # Email services
 
-EMAIL_USE_TLS = True
-EMAIL_PORT = 587
+EMAIL_BACKEND = os.environ.get('DJANGO_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+# Implicit TLS instead of STARTTLS, required by the asyncio backend (core.asyncsmtp.EmailBackend)
+EMAIL_USE_SSL = bool(os.environ.get('DJANGO_EMAIL_USE_SSL', False))
+EMAIL_USE_TLS = not EMAIL_USE_SSL
+EMAIL_PORT = int(os.environ.get('DJANGO_EMAIL_PORT', 465 if EMAIL_USE_SSL else 587))
 EMAIL_HOST = os.environ['DJANGO_EMAIL_HOST']
 EMAIL_HOST_USER = os.environ['DJANGO_EMAIL_HOST_USER']
 EMAIL_HOST_PASSWORD = os.environ['DJANGO_EMAIL_HOST_PASSWORD']
 
+# Max number of concurrent SMTP sessions, and seconds before reopening an idle one
+MAILER_POOL_SIZE = int(os.environ.get('DJANGO_MAILER_POOL_SIZE', 2))
+MAILER_CONNECTION_MAX_IDLE = int(os.environ.get('DJANGO_MAILER_CONNECTION_MAX_IDLE', 60))
+
+# Queue async emails in the database for the sendqueuedmail worker instead of
+# sending them from a background thread
+MAILER_QUEUE = bool(os.environ.get('DJANGO_MAILER_QUEUE', False))
+MAILER_RETRY_DELAY = int(os.environ.get('DJANGO_MAILER_RETRY_DELAY', 60))
+MAILER_MAX_ATTEMPTS = int(os.environ.get('DJANGO_MAILER_MAX_ATTEMPTS', 5))
+# Seconds a worker has to send the emails it claimed before others retry them
+MAILER_CLAIM_TIMEOUT = int(os.environ.get('DJANGO_MAILER_CLAIM_TIMEOUT', 600))
+
+# Invite and status emails are rendered and sent in chunks to keep memory flat
+MAILER_CHUNK_SIZE = int(os.environ.get('DJANGO_MAILER_CHUNK_SIZE', 100))
+MAILER_MAX_PENDING_CHUNKS = int(os.environ.get('DJANGO_MAILER_MAX_PENDING_CHUNKS', 2))
+# Number of processes rendering invite and status emails, 0 renders in-process
+MAILER_RENDER_PROCESSES = int(os.environ.get('DJANGO_MAILER_RENDER_PROCESSES', 0))
+# Send invite and status emails as a single message to chunks of players in
+# BCC, with links to a landing page instead of personal links
+MAILER_BROADCAST = bool(os.environ.get('DJANGO_MAILER_BROADCAST', False))
+MAILER_BROADCAST_CHUNK = int(os.environ.get('DJANGO_MAILER_BROADCAST_CHUNK', 50))
+
+# Provider quotas, 0 is unlimited. Sends throttled with a 4xx reply are retried
+# with exponential backoff (seconds), at a lower concurrency.
+# Quotas are shared by all processes through the cache if it is shared,
+# otherwise they are split among MAILER_RATE_PROCESSES sending processes (web
+# workers and the sendqueuedmail worker), and restart with every process.
+MAILER_RATE_PER_SECOND = int(os.environ.get('DJANGO_MAILER_RATE_PER_SECOND', 0))
+MAILER_RATE_PER_HOUR = int(os.environ.get('DJANGO_MAILER_RATE_PER_HOUR', 0))
+MAILER_RATE_PROCESSES = int(os.environ.get('DJANGO_MAILER_RATE_PROCESSES', 1))
+MAILER_THROTTLE_RETRIES = int(os.environ.get('DJANGO_MAILER_THROTTLE_RETRIES', 5))
+MAILER_THROTTLE_BACKOFF = float(os.environ.get('DJANGO_MAILER_THROTTLE_BACKOFF', 1))
+
+# Max number of concurrent SMTP sessions of the asyncio email backend, and
+# seconds to wait for each SMTP command
+MAILER_ASYNC_CONCURRENCY = int(os.environ.get('DJANGO_MAILER_ASYNC_CONCURRENCY', 4))
+MAILER_ASYNC_TIMEOUT = int(os.environ.get('DJANGO_MAILER_ASYNC_TIMEOUT', 30))
+
+# Invite the most frequent players first, in waves of MAILER_INVITE_WAVE_SIZE
+# players every MAILER_INVITE_WAVE_INTERVAL seconds until the match is full.
+# Everybody is invited at once if 0.
+MAILER_INVITE_WAVE_SIZE = int(os.environ.get('DJANGO_MAILER_INVITE_WAVE_SIZE', 0))
+MAILER_INVITE_WAVE_INTERVAL = int(os.environ.get('DJANGO_MAILER_INVITE_WAVE_INTERVAL', 3600))
+
+# Seconds to coalesce join/leave/guest notifications into a single digest per
+# match, sent by the sendqueuedmail worker. Notifications are immediate if 0.
+MAILER_DIGEST_WINDOW = int(os.environ.get('DJANGO_MAILER_DIGEST_WINDOW', 0))
+
+
+# Matches
+
+# Default capacity of new matches, number of players (including guests) for a
+# match to be full. More players wait in the waitlist.
+MATCH_SIZE = int(os.environ.get('DJANGO_MATCH_SIZE', 10))
+# Seconds the roster of a match page is cached (0 disables it, the default
+# unless the cache is shared), and seconds to wait for another worker
+# rendering it
+MATCH_CACHE_TIMEOUT = int(os.environ.get('DJANGO_MATCH_CACHE_TIMEOUT', 600 if CACHE_IS_SHARED else 0))
+MATCH_CACHE_FILL_WAIT = int(os.environ.get('DJANGO_MATCH_CACHE_FILL_WAIT', 5))
+
 
 # Base URL
 
@@ -139,9 +232,14 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
+        # Admin emails are sent from a background thread, at most once every
+        # LOG_DEDUP_WINDOW seconds for errors logged from the same place
         'mail_admins': {
             'level': 'ERROR',
-            'class': 'django.utils.log.AdminEmailHandler',
+            'class': 'core.loghandlers.BackgroundHandler',
+            'target': 'core.loghandlers.AdminEmailHandler',
+            'capacity': int(os.environ.get('DJANGO_LOG_QUEUE_SIZE', 100)),
+            'window': int(os.environ.get('DJANGO_LOG_DEDUP_WINDOW', 300)),
             'formatter': 'verbose',
         }
     },